@@ -0,0 +1,497 @@
+"""Versioned JSON API for Warbler (/api/v1).
+
+The endpoints return the same data as the HTML pages without the page:
+
+- GET /api/v1/feed                       home feed (login required)
+- GET /api/v1/users/<id>                 profile: user, counters, follow state
+                                         and the first page of messages
+- GET /api/v1/users/<id>/messages        a user's messages
+- GET /api/v1/users/<id>/likes           messages the user liked (own only)
+- GET /api/v1/users/<id>/followers       (login required)
+- GET /api/v1/users/<id>/following       (login required)
+- GET /api/v1/search/users?q=            username search
+- GET /api/v1/stream/messages            server-sent events: new messages by
+                                         followed users (login required)
+
+Common query parameters:
+
+- fields=id,text      sparse fieldset; only these columns are queried
+- limit=50            page size, at most MAX_LIMIT
+- cursor=...          the `next` value of the previous page
+
+Rows are selected as flat tuples (no ORM objects) and encoded with orjson
+when it is installed. Every response carries an ETag of its body, so a
+client that sends If-None-Match gets a bodiless 304 when nothing changed.
+"""
+
+import base64
+import hashlib
+import json
+import time
+from datetime import datetime
+from functools import wraps
+
+from flask import Blueprint, Response, current_app, g, request
+from sqlalchemy import and_, or_
+
+from models import db, User, Message, Likes, Follows
+from replicas import replica_reads
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
+
+api = Blueprint("api", __name__, url_prefix="/api/v1")
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+# a comment line goes down an idle stream this often so proxies keep it open
+STREAM_KEEPALIVE_SECONDS = 15
+# messages sent on reconnect, for the ones missed while disconnected
+STREAM_BACKFILL = 50
+
+MESSAGE_FIELDS = {
+    "id": Message.id,
+    "text": Message.text,
+    "timestamp": Message.timestamp,
+    "user_id": Message.user_id,
+    "username": User.username,
+    "image_url": User.image_url,
+}
+
+USER_FIELDS = {
+    "id": User.id,
+    "username": User.username,
+    "image_url": User.image_url,
+    "header_image_url": User.header_image_url,
+    "bio": User.bio,
+    "location": User.location,
+}
+
+
+class APIError(Exception):
+    """An error answered as JSON: {"error": message} with status."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+@api.errorhandler(APIError)
+def handle_api_error(err):
+    return json_response({"error": err.message}, status=err.status,
+                         conditional=False)
+
+
+##############################################################################
+# Encoding
+
+
+def dumps(payload):
+    """Encode payload as JSON bytes, with orjson when it is available."""
+
+    if orjson is not None:
+        return orjson.dumps(payload)
+
+    return json.dumps(payload, separators=(",", ":"),
+                      default=lambda value: value.isoformat()).encode()
+
+
+def json_response(payload, status=200, conditional=True):
+    """ JSON response with an ETag of the body. When the request's
+        If-None-Match matches, the body is dropped and the status is 304.
+    """
+
+    body = dumps(payload)
+    resp = Response(body, status=status, mimetype="application/json")
+
+    if conditional:
+        resp.set_etag(hashlib.blake2b(body, digest_size=16).hexdigest())
+        # per-user data: caches may keep it but must revalidate
+        resp.headers["Cache-Control"] = "private, no-cache"
+        resp.make_conditional(request)
+
+    return resp
+
+
+def encode_cursor(*values):
+    """Opaque pagination cursor from the sort key of the last row."""
+
+    raw = "|".join(value.isoformat() if isinstance(value, datetime) else str(value)
+                   for value in values)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, *types):
+    """Undo encode_cursor; types converts each part back (int or datetime)."""
+
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        parts = raw.decode().split("|")
+        if len(parts) != len(types):
+            raise ValueError(cursor)
+        return [datetime.fromisoformat(part) if kind is datetime else kind(part)
+                for part, kind in zip(parts, types)]
+    except ValueError:
+        raise APIError("invalid cursor")
+
+
+##############################################################################
+# Query helpers
+
+
+def requested_fields(available):
+    """The fields named in ?fields=, in the order of `available` when absent."""
+
+    fields = request.args.get("fields")
+    if not fields:
+        return list(available)
+
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        raise APIError(f"unknown field(s): {', '.join(unknown)}")
+
+    return names
+
+
+def page_limit():
+    """?limit=, bounded to 1..MAX_LIMIT."""
+
+    try:
+        limit = int(request.args.get("limit", DEFAULT_LIMIT))
+    except ValueError:
+        raise APIError("limit must be a number")
+
+    return max(1, min(limit, MAX_LIMIT))
+
+
+def paginate(query, available, fields, sort_columns, sort_types):
+    """ Run query for one page and build the payload. Returns the payload and
+        the sort keys of the page's rows.
+
+        The selected columns are the requested fields followed by the sort key
+        (used for the next cursor but only returned when asked for). Rows stay
+        tuples until they are zipped with the field names.
+    """
+
+    limit = page_limit()
+    columns = [available[name] for name in fields] + list(sort_columns)
+    rows = query.with_entities(*columns).limit(limit + 1).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    width = len(fields)
+
+    data = [dict(zip(fields, row[:width])) for row in rows]
+    keys = [row[width:] for row in rows]
+    next_cursor = encode_cursor(*keys[-1]) if has_more else None
+
+    return {"data": data, "next": next_cursor}, keys
+
+
+def messages_page(query):
+    """Page of messages, newest first, keyed on (timestamp, id). Returns the
+    payload and the ids of the page's messages.
+    """
+
+    fields = requested_fields(MESSAGE_FIELDS)
+    query = (query.join(User, Message.user_id == User.id)
+             .filter(User.deleted_at.is_(None)))
+
+    cursor = request.args.get("cursor")
+    if cursor:
+        timestamp, message_id = decode_cursor(cursor, datetime, int)
+        query = query.filter(or_(
+            Message.timestamp < timestamp,
+            and_(Message.timestamp == timestamp, Message.id < message_id)))
+
+    query = query.order_by(Message.timestamp.desc(), Message.id.desc())
+
+    payload, keys = paginate(query, MESSAGE_FIELDS, fields,
+                             (Message.timestamp, Message.id), (datetime, int))
+
+    return payload, [key[1] for key in keys]
+
+
+def users_page(query):
+    """Page of users in id order."""
+
+    fields = requested_fields(USER_FIELDS)
+    query = query.filter(User.deleted_at.is_(None))
+
+    cursor = request.args.get("cursor")
+    if cursor:
+        user_id, = decode_cursor(cursor, int)
+        query = query.filter(User.id > user_id)
+
+    payload, keys = paginate(query.order_by(User.id), USER_FIELDS, fields,
+                             (User.id,), (int,))
+
+    return payload
+
+
+def liked_ids(user_id, message_ids):
+    """The ones among message_ids that user_id liked."""
+
+    if not message_ids:
+        return []
+
+    return [row.message_id for row in (
+        db.session.query(Likes.message_id)
+        .filter(Likes.user_id == user_id, Likes.message_id.in_(message_ids))
+        .order_by(Likes.message_id))]
+
+
+def active_user_or_404(user_id):
+    """The user, unless missing or deleted."""
+
+    user = (db.session.query(User.id)
+            .filter(User.id == user_id, User.deleted_at.is_(None))
+            .first())
+    if user is None:
+        raise APIError("user not found", 404)
+
+    return user.id
+
+
+def login_required(view):
+    """401 for anonymous requests."""
+
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if not g.user:
+            raise APIError("login required", 401)
+        return view(*args, **kwargs)
+
+    return wrapped
+
+
+##############################################################################
+# Endpoints
+
+
+@api.route('/feed')
+@replica_reads
+@login_required
+def feed():
+    """Messages of the users g.user follows, newest first. `liked` lists the
+    messages of the page that g.user liked.
+    """
+
+    following = (db.session.query(Follows.user_being_followed_id)
+                 .filter(Follows.user_following_id == g.user.id))
+
+    query = db.session.query(Message).filter(Message.user_id.in_(following))
+
+    payload, message_ids = messages_page(query)
+    payload["liked"] = liked_ids(g.user.id, message_ids)
+
+    return json_response(payload)
+
+
+@api.route('/users/<int:user_id>')
+@replica_reads
+def user_profile(user_id):
+    """ Everything the profile page shows: the user, the four counters, whether
+        g.user follows them and the first page of their messages with the ones
+        g.user liked.
+    """
+
+    active_user_or_404(user_id)
+
+    user = (db.session.query(*USER_FIELDS.values())
+            .filter(User.id == user_id).one())
+
+    counts = {
+        "messages": (db.session.query(Message.id)
+                     .filter(Message.user_id == user_id).count()),
+        "following": (db.session.query(Follows.user_being_followed_id)
+                      .filter(Follows.user_following_id == user_id).count()),
+        "followers": (db.session.query(Follows.user_following_id)
+                      .filter(Follows.user_being_followed_id == user_id).count()),
+        "likes": (db.session.query(Likes.id)
+                  .filter(Likes.user_id == user_id).count()),
+    }
+
+    messages, message_ids = messages_page(
+        db.session.query(Message).filter(Message.user_id == user_id))
+
+    profile = {
+        "user": dict(zip(USER_FIELDS, user)),
+        "counts": counts,
+        "is_following": False,
+        "messages": messages,
+        "liked": [],
+    }
+
+    if g.user:
+        profile["is_following"] = (db.session.query(Follows.user_following_id)
+                                   .filter(Follows.user_following_id == g.user.id,
+                                           Follows.user_being_followed_id == user_id)
+                                   .first() is not None)
+        profile["liked"] = liked_ids(g.user.id, message_ids)
+
+    return json_response(profile)
+
+
+@api.route('/users/<int:user_id>/messages')
+@replica_reads
+def user_messages(user_id):
+    """Messages written by user_id, newest first."""
+
+    active_user_or_404(user_id)
+    query = db.session.query(Message).filter(Message.user_id == user_id)
+
+    payload, message_ids = messages_page(query)
+    return json_response(payload)
+
+
+@api.route('/users/<int:user_id>/likes')
+@replica_reads
+@login_required
+def user_likes(user_id):
+    """Messages user_id liked, most recently liked first. Like the HTML page,
+    only the logged in user's own likes can be listed.
+    """
+
+    if user_id != g.user.id:
+        raise APIError("you cannot view the messages another user likes", 403)
+
+    fields = requested_fields(MESSAGE_FIELDS)
+    query = (db.session.query(Likes)
+             .join(Message, Likes.message_id == Message.id)
+             .join(User, Message.user_id == User.id)
+             .filter(Likes.user_id == user_id, User.deleted_at.is_(None)))
+
+    cursor = request.args.get("cursor")
+    if cursor:
+        like_id, = decode_cursor(cursor, int)
+        query = query.filter(Likes.id < like_id)
+
+    query = query.order_by(Likes.id.desc())
+
+    payload, keys = paginate(query, MESSAGE_FIELDS, fields, (Likes.id,), (int,))
+    return json_response(payload)
+
+
+@api.route('/users/<int:user_id>/followers')
+@replica_reads
+@login_required
+def user_followers(user_id):
+    """Users following user_id."""
+
+    active_user_or_404(user_id)
+    query = (db.session.query(User)
+             .join(Follows, Follows.user_following_id == User.id)
+             .filter(Follows.user_being_followed_id == user_id))
+
+    return json_response(users_page(query))
+
+
+@api.route('/users/<int:user_id>/following')
+@replica_reads
+@login_required
+def user_following(user_id):
+    """Users user_id follows."""
+
+    active_user_or_404(user_id)
+    query = (db.session.query(User)
+             .join(Follows, Follows.user_being_followed_id == User.id)
+             .filter(Follows.user_following_id == user_id))
+
+    return json_response(users_page(query))
+
+
+@api.route('/search/users')
+@replica_reads
+def search_users():
+    """Users whose username contains ?q= (every user without q)."""
+
+    query = db.session.query(User)
+
+    search = request.args.get("q")
+    if search:
+        query = query.filter(User.username.like(f"%{search}%"))
+
+    return json_response(users_page(query))
+
+
+def sse_event(event):
+    """Format one notification as a server-sent event; the message id is the
+    event id, so a reconnecting client reports it in Last-Event-ID.
+    """
+
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {dumps(event).decode()}\n\n"
+
+
+@api.route('/stream/messages')
+@login_required
+def stream_messages():
+    """ Server-sent events with a notification for every new message by a user
+        g.user follows. One of these replaces polling the feed.
+
+        The follow set is read when the stream opens; the stream closes after
+        STREAM_MAX_SECONDS and the browser's EventSource reconnects, which
+        picks up follows made in the meantime. On reconnect the messages
+        newer than Last-Event-ID are sent first.
+
+        Each open stream holds a worker thread, so serve it from a threaded
+        or gevent worker.
+    """
+
+    hub = current_app.extensions["pubsub"]
+    max_seconds = current_app.config.get("STREAM_MAX_SECONDS", 300)
+
+    following = [row.user_being_followed_id for row in (
+        db.session.query(Follows.user_being_followed_id)
+        .filter(Follows.user_following_id == g.user.id))]
+
+    backfill = []
+    last_id = request.headers.get("Last-Event-ID", "")
+    if last_id.isdigit() and following:
+        rows = (db.session.query(Message.id, Message.user_id, User.username,
+                                 Message.text, Message.timestamp)
+                .join(User, Message.user_id == User.id)
+                .filter(Message.user_id.in_(following),
+                        Message.id > int(last_id),
+                        User.deleted_at.is_(None))
+                .order_by(Message.id)
+                .limit(STREAM_BACKFILL)
+                .all())
+        backfill = [{"type": "message", "id": row.id, "user_id": row.user_id,
+                     "username": row.username, "text": row.text,
+                     "timestamp": row.timestamp.isoformat()} for row in rows]
+
+    # everything the generator needs is read above; it runs after the
+    #  request context is gone.
+    subscription = hub.subscribe(following)
+
+    def events():
+        try:
+            yield "retry: 3000\n\n"
+            for event in backfill:
+                yield sse_event(event)
+
+            closes_at = time.monotonic() + max_seconds
+            while True:
+                remaining = closes_at - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                event = subscription.get(
+                    timeout=min(STREAM_KEEPALIVE_SECONDS, remaining))
+                if event is None:
+                    yield ": keepalive\n\n"
+                else:
+                    yield sse_event(event)
+        finally:
+            hub.unsubscribe(subscription)
+
+    resp = Response(events(), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
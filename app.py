@@ -1,556 +1,293 @@
-import os
-
-from flask import Flask, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
-from sqlalchemy.exc import IntegrityError
-
-from forms import UserAddForm, UserEditForm, LoginForm, MessageForm
-from models import db, connect_db, User, db_change_user, Message, Likes, Follows
-
-CURR_USER_KEY = "curr_user"
-
-app = Flask(__name__)
-
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgres:///warbler'))
-
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
-
-connect_db(app)
-
-# import pdb
-# pdb.set_trace()
-
-
-##############################################################################
-#
-# Supporting Functions
-
-def get_user_likes(user_id):
-    """ Returns a list of message ids that user_id has liked.
-    """
-
-    # build a list of liked messages
-    db_likes = Likes.query.filter(
-        Likes.user_id == user_id).order_by(Likes.message_id).all()
-    user_likes = []
-    for like in db_likes:
-        user_likes.append(like.message_id)
-
-    return user_likes
-
-
-##############################################################################
-# User signup/login/logout
-
-
-@app.before_request
-def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
-
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
-
-    else:
-
-        g.user = None
-
-
-def do_login(user):
-    """Log in user."""
-
-    session[CURR_USER_KEY] = user.id
-
-
-def do_logout():
-    """Logout user."""
-
-    if CURR_USER_KEY in session:
-        del session[CURR_USER_KEY]
-
-
-@app.route('/signup', methods=["GET", "POST"])
-def signup():
-    """Handle user signup.
-
-    Create new user and add to DB. Redirect to home page.
-
-    If form not valid, present form.
-
-    If the there already is a user with that username: flash message
-    and re-present form.
-    """
-
-    form = UserAddForm()
-
-    if form.validate_on_submit():
-        try:
-            user = User.signup(
-                username=form.username.data.strip().lower(),
-                password=form.password.data,
-                email=form.email.data.strip().lower(),
-                image_url=form.image_url.data.strip() or User.image_url.default.arg.strip(),
-            )
-            db.session.commit()
-
-        except IntegrityError:
-            flash("Username already taken", 'danger')
-            return render_template('users/signup.html', form=form)
-
-        do_login(user)
-
-        return redirect("/")
-
-    else:
-        return render_template('users/signup.html', form=form)
-
-
-@app.route('/login', methods=["GET", "POST"])
-def login():
-    """Handle user login."""
-
-    form = LoginForm()
-
-    if form.validate_on_submit():
-        user = User.authenticate(form.username.data.strip().lower(),
-                                 form.password.data)
-
-        if user:
-            do_login(user)
-            flash(f"Hello, {user.username}!", "success")
-            return redirect("/")
-
-        flash("Invalid credentials.", 'danger')
-
-    return render_template('users/login.html', form=form)
-
-
-@app.route('/logout')
-def logout():
-    """Handle logout of user."""
-
-    do_logout()
-
-    if g.user:
-        flash(f"{g.user.username} successfully logged out.", "success")
-        g.user = None
-    else:
-        flash(f"User was logged out.", "success")
-
-    return redirect("/login")
-
-
-##############################################################################
-# General user routes:
+"""Warbler application factory.
 
-@app.route('/users')
-def list_users():
-    """Page with listing of users.
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "postgresql:///warbler-test"})
 
-    Can take a 'q' param in querystring to search by that username.
-    """
-
-    search = request.args.get('q')
-
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
-
-    return render_template('users/index.html', users=users)
-
-
-@app.route('/users/<int:user_id>')
-def users_show(user_id):
-    """Show user profile."""
-
-    user = User.query.get_or_404(user_id)
-
-    # changed the query to a user join query. Even though all the messages belong to
-    #  user_id in this route, adding the user details about the user to the messages
-    #  means we can use the same (slightly altered) show.html as we do when we show
-    #  all the messages that a user liked.
-
-    messages = (db.session.query(User.username, User.image_url,
-                                 Message.id, Message.text,
-                                 Message.timestamp, Message.user_id)
-                .join(Message)
-                .filter(Message.user_id == user_id)
-                .all())
-
-    # # Legacy query
-    # messages = (Message.query.filter(Message.user_id == user_id).order_by(Message.timestamp.desc())
-    # .limit(100).all())
-
-    if g.user:
-        liked_msgs = get_user_likes(g.user.id)
-    else:
-        liked_msgs = []
-
-    # 'route' helps control where the redirect will take you when you alter a
-    #  like on a message. You should stay on the same page. This gets tricky
-    #  since you can like from 3 different places -- the root page, the user's
-    #  all message page, or the user's like's.
-    return render_template('users/show.html', user=user, messages=messages,
-                           likes=liked_msgs,
-                           route=user_id, logged_in_user_id=g.user.id)
-
-
-@ app.route('/users/<int:user_id>/likes', methods=["GET"])
-def user_likes(user_id):
-    """ Show the user profile page with the messages that user_id has liked. user_id must
-        match the currently logged in user, g.user.id.
-    """
-
-    if g.user:
-        user = User.query.get_or_404(user_id)
-        if (user.id == g.user.id):
-            if (user.username[-1].lower() == "s"):
-                name_possessive = f"{user.username}'"
-            else:
-                name_possessive = f"{user.username}'s"
-
-            liked_msgs = get_user_likes(user_id)
-
-            messages_users = (db.session.query(User.username, User.image_url,
-                                               Message.id, Message.text, Message.timestamp, Message.user_id)
-                              .join(Message)
-                              .filter(Message.id.in_(liked_msgs))
-                              .all())
-
-            # print(f"\n\nusers_show: user = {user}, Flush=True)
-            return render_template('users/show.html', user=user, messages=messages_users,
-                                   list_type=f"{name_possessive} Likes",
-                                   route="MyLikes",
-                                   likes=liked_msgs, logged_in_user_id=g.user.id)
-        else:
-            # for now, block access to another user's likes. I would think that seeing another user's likes
-            #  should be restricted to users that g.user.id is following and users who are following g.user.id.
-            flash(
-                "Access unauthorized - Sorry, but you cannot view the messages another use likes.", "danger")
-            # leave g.user on the other user's 'main' page.
-            return redirect(f"/users/{user_id}")
-
-    else:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-
-@app.route('/users/<int:user_id>/following')
-def show_following(user_id):
-    """Show list of people this user is following."""
-
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
-
-
-@app.route('/users/<int:user_id>/followers')
-def users_followers(user_id):
-    """Show list of followers of this user."""
-
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
-
-
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
-def add_follow(follow_id):
-    """Add a follow for the currently-logged-in user."""
-
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
-
-    return redirect(f"/users/{g.user.id}/following")
-
-
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
-def stop_following(follow_id):
-    """Have currently-logged-in-user stop following this user."""
-
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
-
-    return redirect(f"/users/{g.user.id}/following")
-
-
-@app.route('/users/profile', methods=["GET", "POST"])
-def profile():
-    """Update profile for current user."""
-
-    if g.user:
-
-        user_curr = User.query.get_or_404(g.user.id)
-
-        # remember the values before changes, if any
-        user_archive = {
-            "username": user_curr.username,
-            "email": user_curr.email,
-            "image_url": user_curr.image_url,
-            "header_image_url": user_curr.header_image_url,
-            "location": user_curr.location,
-            "bio": user_curr.bio
-        }
-        form = UserEditForm(obj=user_curr)
-
-        if form.validate_on_submit():
-            # user may have changed their username in the form, but the
-            #  password is associated with the unchanged username. A good
-            #  amount of this logic should move into models, but it is staying
-            #  here for now.
-            db_user = User.authenticate(user_archive["username"],
-                                        form.password.data)
-            if db_user:
-                
-                user_update = {
-                    "username": form.username.data,
-                    "email": form.email.data,
-                    "image_url": form.image_url.data,
-                    "header_image_url": form.header_image_url.data,
-                    "location": form.location.data,
-                    "bio": form.bio.data
-                }
-
-                result = db_change_user(db_user, user_update, user_archive)
-                # 
-                # result = {
-                #     "successful": True no errors, False errors,
-                #     "msg": {
-                #         "msg_type": (3-value tuple for form field values. 0 has the error type
-                #           (error-integrity, error-integrity-catchall, error-unexpected), 
-                #           1 has the field name, 2 has the error message),
-                #         "msg_text": text for flash message,
-                #         "class": class for flash message, success or danger
-                #     }
-                # }
-
-                # flash message values will always exist. 
-                flash(result["msg"]["msg_text"], result["msg"]["class"])
-                
-                if (result["successful"]):
-                    return redirect(f"/users/{g.user.id}")
-                else:
-                    # crap. we need to disect the message structure
-                    if (result["msg"]["msg_type"][0] == "error-integrity"): 
-                        # result["msg"]["msg_type"][1] is either username or email for 
-                        #  "error-integrity"
-                        if (result["msg"]["msg_type"][1] == "username"):
-                            form.username.errors = result["msg"]["msg_type"][2]
-                        else:
-                            # email error
-                            form.email.errors = result["msg"]["msg_type"][2]
-
-                        return render_template("users/edit.html", form=form, user_id=g.user.id)
-
-                    else:
-                        return redirect("/")
-
-            else:
-                # FUTURE CODE - try a few times before bouncing to home?
-                flash(
-                    "DENIED! Password is incorrect. Your profile was NOT updated.", "danger")
-                # redirect to home page when changes were not possible.
-                return redirect("/")
-
-        else:
-            return render_template("users/edit.html", form=form, user_id=g.user.id)
-
-    else:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-
-@ app.route('/users/delete', methods=["POST"])
-def delete_user():
-    """Delete user."""
-
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    do_logout()
-
-    db.session.delete(g.user)
-    db.session.commit()
-
-    return redirect("/signup")
-
-
-##############################################################################
-# Messages routes:
-
-@ app.route('/messages/new', methods=["GET", "POST"])
-def messages_add():
-    """Add a message:
-
-    Show form if GET. If valid, update message and redirect to user page.
-    """
-
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    form = MessageForm()
-
-    if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
-
-        return redirect(f"/users/{g.user.id}")
-
-    return render_template('messages/new.html', form=form)
-
-
-@ app.route('/messages/<int:message_id>', methods=["GET"])
-def messages_show(message_id):
-    """Show a message."""
-
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+create_app() reads its settings from the environment (see load_config) and
+then applies the config passed in, so tests and scripts no longer have to set
+DATABASE_URL before importing anything. Importing this module is cheap: the
+models, forms, views and extensions are only imported when an app is created,
+and the debug toolbar only when the app runs in debug mode.
 
+`from app import app` still works -- the module builds an app from the
+environment the first time `app` is looked up -- so `flask run`, gunicorn's
+`app:app` and the existing tests carry on as before.
 
-@ app.route('/messages/<int:message_id>/likes/<user_id>', methods=["POST"])
-def messages_add_del_like(message_id, user_id):
-    """ Like or unlike a message message.
+How long each startup step took is kept in app.extensions["startup"] and
+shown by /health/ready. For the import cost of the modules themselves:
 
-        message_id is added to the user's like messagelist (liked) when it does not
-        exist in user's list of liked message.
-
-        message_id is deleted from the user's like message list (unliked) when it
-        EXISTS in user's list of liked message.
-
-        user_id servers for redirection -- we should stay on the page where the like
-        or unlike occurred. It will either have:
-        - a user id (integer) when the like occurred from a user page (users/{user_id}),
-        - 'All' when the like/unlike occurred from the all messages (home) page (/), or
-        - 'MyLikes' when the like/unlike occurred from the current user's likes page
-          (/users/{user_id}/likes).
-
-    """
-
-    if g.user:
-        msg_check = Message.query.get_or_404(message_id)
-
-        user_likes = get_user_likes(g.user.id)
-
-        if (message_id in user_likes):
-            # message_id in list means we need to remove the like.
-            like_no_mo = Likes.query.filter(
-                Likes.user_id == g.user.id, Likes.message_id == message_id).one_or_none()
-            db.session.delete(like_no_mo)
-
-        else:
-            # message_id NOT in list means we need to add the like.
-            new_like = Likes(message_id=message_id, user_id=g.user.id)
-            db.session.add(new_like)
-
-        db.session.commit()
-
-        # Did the like/unlike happen on the root page or from a user page? Leave the user where
-        #  they were, don't redirect them somewhere else.
-        if user_id.isnumeric():
-            return redirect(f"/users/{user_id}")
-        else:
-            if (user_id == "MyLikes"):
-                return redirect(f"/users/{g.user.id}/likes")
-
-        return redirect("/")
-
-    else:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-
-@ app.route('/messages/<int:message_id>/delete', methods=["POST"])
-def messages_destroy(message_id):
-    """Delete a message."""
-
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    msg = Message.query.get(message_id)
-    db.session.delete(msg)
-    db.session.commit()
-
-    return redirect(f"/users/{g.user.id}")
+    python -X importtime -c "import app; app.create_app()"
+"""
 
+import os
+import threading
+import time
 
-##############################################################################
-# Homepage and error pages
+from flask import Flask
 
+CURR_USER_KEY = "curr_user"
 
-@ app.route('/')
-def homepage():
-    """Show homepage:
 
-    - anon users: no messages
-    - logged in: 100 most recent messages of followed_users (user_being_followed_id 
-        in 'follows' table.)
+def env_flag(name, default):
+    """Read an on/off environment variable ('1', 'true', 'yes' and 'on' are on)."""
+
+    value = os.environ.get(name)
+    if value is None:
+        return default
+
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def load_config(app):
+    """Settings from the environment, with the development defaults."""
+
+    # Get DB_URI from environ variable (useful for production/testing) or,
+    # if not set there, use development local db.
+    app.config['SQLALCHEMY_DATABASE_URI'] = (
+        os.environ.get('DATABASE_URL', 'postgres:///warbler'))
+
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+    # Connection pool. See engine_options() in models.py for what each one does.
+    #  DB_PGBOUNCER=1 when connecting through pgbouncer in transaction mode.
+    app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+    app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+    app.config['DB_POOL_TIMEOUT'] = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+    app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+    app.config['DB_POOL_PRE_PING'] = env_flag('DB_POOL_PRE_PING', True)
+    app.config['DB_STATEMENT_TIMEOUT_MS'] = int(
+        os.environ.get('DB_STATEMENT_TIMEOUT_MS', 0))
+    app.config['DB_PGBOUNCER'] = env_flag('DB_PGBOUNCER', False)
+
+    # Read replicas for the GET views marked @replica_reads. See replicas.py.
+    app.config['SQLALCHEMY_REPLICA_URIS'] = [
+        uri.strip() for uri in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+        if uri.strip()]
+    app.config['REPLICA_SELECTION'] = os.environ.get(
+        'REPLICA_SELECTION', 'round-robin')
+    app.config['REPLICA_STICKY_SECONDS'] = float(
+        os.environ.get('REPLICA_STICKY_SECONDS', 5))
+
+    # New-message notifications. Without PUBSUB_URL they only reach streams
+    #  served by the same process; see pubsub.py.
+    app.config['PUBSUB_URL'] = os.environ.get('PUBSUB_URL')
+    app.config['STREAM_MAX_SECONDS'] = int(
+        os.environ.get('STREAM_MAX_SECONDS', 300))
+
+    # Threads loading the profile pages' queries side by side (at most half
+    #  the connection pool); 0 loads them one after another. See profiles.py.
+    app.config['PROFILE_LOADER_WORKERS'] = int(
+        os.environ.get('PROFILE_LOADER_WORKERS', 8))
+
+    # Compiled templates are cached on disk and every template is compiled at
+    #  startup; /health/ready says when that is done. See warmup.py.
+    app.config['JINJA_CACHE_DIR'] = os.environ.get('JINJA_CACHE_DIR')
+    app.config['TEMPLATE_WARMUP'] = os.environ.get('TEMPLATE_WARMUP', 'sync')
+
+    # Message permalinks are cached per process and in a table shared by the
+    #  workers on a host (MESSAGE_CACHE_PATH, default in the instance folder;
+    #  off for per process only). See messagecache.py.
+    app.config['MESSAGE_CACHE_SIZE'] = int(
+        os.environ.get('MESSAGE_CACHE_SIZE', 10000))
+    app.config['MESSAGE_CACHE_SLOTS'] = int(
+        os.environ.get('MESSAGE_CACHE_SLOTS', 16384))
+    app.config['MESSAGE_CACHE_PATH'] = os.environ.get('MESSAGE_CACHE_PATH')
+
+    # Who follows whom, cached per process for is_following checks
+    #  (FOLLOW_CACHE_BYTES=0 turns it off). See followcache.py.
+    app.config['FOLLOW_CACHE_BYTES'] = int(
+        os.environ.get('FOLLOW_CACHE_BYTES', 32 * 1024 * 1024))
+    app.config['FOLLOW_CACHE_TTL'] = float(
+        os.environ.get('FOLLOW_CACHE_TTL', 10))
+
+    # Trending hashtags and messages: decayed counts of the last hours,
+    #  snapshotted to the database every TRENDING_SNAPSHOT_SECONDS by the
+    #  serving workers (0, the default: never; set it for the web servers
+    #  only). See trending.py.
+    app.config['TRENDING_TOP_K'] = int(os.environ.get('TRENDING_TOP_K', 20))
+    app.config['TRENDING_HALF_LIFE'] = float(
+        os.environ.get('TRENDING_HALF_LIFE', 3600))
+    app.config['TRENDING_SNAPSHOT_SECONDS'] = float(
+        os.environ.get('TRENDING_SNAPSHOT_SECONDS', 0))
+
+    # Message search: "postgres" (GIN index), "memory" (in-process inverted
+    #  index) or "auto" -- postgres on Postgres. See search.py.
+    app.config['SEARCH_BACKEND'] = os.environ.get('SEARCH_BACKEND', 'auto')
+
+    # The home feed reads the last FEED_WINDOW_DAYS first (0: the whole
+    #  table), so a messages table partitioned by month only scans the recent
+    #  partitions. See partitions.py.
+    app.config['FEED_WINDOW_DAYS'] = int(os.environ.get('FEED_WINDOW_DAYS', 30))
+    app.config['PARTITION_MONTHS_AHEAD'] = int(
+        os.environ.get('PARTITION_MONTHS_AHEAD', 3))
+    # How often a serving process creates the coming months' partitions (0:
+    #  only by cron, partitions.py --maintain).
+    app.config['PARTITION_MAINTAIN_SECONDS'] = int(
+        os.environ.get('PARTITION_MAINTAIN_SECONDS', 24 * 3600))
+
+    # Thumbnails of the users' images, made on a pool of IMAGE_WORKERS
+    #  threads and kept in IMAGE_CACHE_DIR (default: in the instance folder;
+    #  "off" links the originals). See images.py.
+    app.config['IMAGE_CACHE_DIR'] = os.environ.get('IMAGE_CACHE_DIR')
+    app.config['IMAGE_WORKERS'] = int(os.environ.get('IMAGE_WORKERS', 4))
+    app.config['IMAGE_FETCH_TIMEOUT'] = float(
+        os.environ.get('IMAGE_FETCH_TIMEOUT', 5))
+
+    # Where sessions live: "sqlite" (SESSION_PATH, default a file in the
+    #  instance folder), "file" (a directory), "memory" or "cookie" (Flask's
+    #  signed cookie). See sessions.py.
+    app.config['SESSION_STORE'] = os.environ.get('SESSION_STORE', 'sqlite')
+    app.config['SESSION_PATH'] = os.environ.get('SESSION_PATH')
+    app.config['SESSION_TTL'] = int(os.environ.get('SESSION_TTL', 14 * 24 * 3600))
+
+    # Compression of text responses: gzip, or brotli when the brotli package
+    #  is installed, for bodies of at least COMPRESS_MIN_SIZE bytes
+    #  (COMPRESS_LEVEL=0: off). See compress.py.
+    app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+    app.config['COMPRESS_LEVEL'] = int(os.environ.get('COMPRESS_LEVEL', 6))
+    app.config['COMPRESS_BROTLI_QUALITY'] = int(
+        os.environ.get('COMPRESS_BROTLI_QUALITY', 5))
+
+    # Rate limits of the write endpoints (RATE_LIMITS, see ratelimit.py for
+    #  the defaults) and how many writes a process runs at once. Set
+    #  RATE_LIMIT_STORAGE_URL=redis://... to share the limits between workers.
+    app.config['RATE_LIMIT_STORAGE_URL'] = os.environ.get('RATE_LIMIT_STORAGE_URL')
+    app.config['MAX_CONCURRENT_WRITES'] = int(os.environ.get(
+        'MAX_CONCURRENT_WRITES',
+        app.config['DB_POOL_SIZE'] + app.config['DB_MAX_OVERFLOW']))
+    app.config['ADMISSION_TIMEOUT'] = float(
+        os.environ.get('ADMISSION_TIMEOUT', 1.0))
+
+    # Failed passwords per username and per IP before a lockout, and how
+    #  long the lockouts last. See loginthrottle.py.
+    app.config['LOGIN_MAX_FAILURES'] = int(
+        os.environ.get('LOGIN_MAX_FAILURES', 5))
+    app.config['LOGIN_MAX_FAILURES_PER_IP'] = int(
+        os.environ.get('LOGIN_MAX_FAILURES_PER_IP', 20))
+    app.config['LOGIN_FAILURE_WINDOW'] = int(
+        os.environ.get('LOGIN_FAILURE_WINDOW', 900))
+    app.config['LOGIN_LOCKOUT_SECONDS'] = int(
+        os.environ.get('LOGIN_LOCKOUT_SECONDS', 30))
+    app.config['LOGIN_MAX_LOCKOUT_SECONDS'] = int(
+        os.environ.get('LOGIN_MAX_LOCKOUT_SECONDS', 3600))
+
+    # Likes and follows written in batches: off, group (the request waits for
+    #  its batch to commit) or async (it doesn't). See writebatch.py.
+    app.config['WRITE_BATCH'] = os.environ.get('WRITE_BATCH', 'off')
+    app.config['WRITE_BATCH_INTERVAL_MS'] = float(
+        os.environ.get('WRITE_BATCH_INTERVAL_MS', 5))
+    app.config['WRITE_BATCH_MAX'] = int(os.environ.get('WRITE_BATCH_MAX', 500))
+    app.config['WRITE_BATCH_TIMEOUT'] = float(
+        os.environ.get('WRITE_BATCH_TIMEOUT', 5))
+    app.config['WRITE_BATCH_JOURNAL_DIR'] = os.environ.get(
+        'WRITE_BATCH_JOURNAL_DIR')
+
+    # The debug toolbar is only loaded in debug mode (FLASK_ENV=development)
+    app.config['DEBUG_TB_ENABLED'] = env_flag('DEBUG_TB_ENABLED', app.debug)
+
+
+class StartupTimer:
+    """Milliseconds spent in each step of create_app()."""
+
+    def __init__(self):
+        self.started = self.last = time.perf_counter()
+        self.steps_ms = {}
+
+    def step(self, name):
+        now = time.perf_counter()
+        self.steps_ms[name] = round((now - self.last) * 1000, 2)
+        self.last = now
+
+    def report(self):
+        return {"total_ms": round((self.last - self.started) * 1000, 2),
+                "steps_ms": self.steps_ms}
+
+
+def create_app(config=None):
+    """Build the Warbler app; config overrides the environment settings."""
+
+    timer = StartupTimer()
+
+    app = Flask(__name__)
+    load_config(app)
+    app.config.update(config or {})
+    timer.step("config")
+
+    # the first app of a process pays for these imports, later ones don't
+    from models import connect_db
+    from replicas import init_replicas
+    from pubsub import init_pubsub
+    from profiles import init_profiles
+    from messagecache import init_message_cache
+    from followcache import init_follow_cache
+    from trending import init_trending
+    from search import init_search
+    from partitions import init_partitions
+    from images import init_images
+    from sessions import init_sessions
+    from compress import init_compression
+    from ratelimit import init_rate_limits
+    from loginthrottle import init_login_throttle
+    from writebatch import init_write_batch
+    from warmup import init_templates
+    from api import api
+    from views import views
+    timer.step("imports")
+
+    if app.config['DEBUG_TB_ENABLED']:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+        timer.step("debug_toolbar")
+
+    connect_db(app)
+    init_replicas(app)
+    init_sessions(app)
+    timer.step("database")
+
+    init_pubsub(app)
+    init_profiles(app)
+    init_message_cache(app)
+    init_follow_cache(app)
+    init_trending(app)
+    init_search(app)
+    init_partitions(app)
+    init_images(app)
+    init_write_batch(app)
+    # before the views, so throttled requests are turned away first
+    init_rate_limits(app)
+    init_login_throttle(app)
+    app.register_blueprint(views)
+    app.register_blueprint(api)
+    timer.step("views")
+
+    # last, once every filter and global the templates use is registered
+    init_templates(app)
+    timer.step("templates")
+
+    # around everything else, the outermost WSGI layer
+    init_compression(app)
+
+    app.extensions["startup"] = timer.report()
+    app.logger.info("startup took %sms", app.extensions["startup"]["total_ms"])
+
+    return app
+
+
+_app_lock = threading.Lock()
+
+
+def __getattr__(name):
+    """ `from app import app`: the app built from the environment, created the
+        first time it is asked for.
     """
 
-    if g.user:
-
-        # build a list of followed users
-        db_following = (Follows.query.filter(
-            Follows.user_following_id == g.user.id).all())
-
-        following = []
-        for following_user in db_following:
-            following.append(following_user.user_being_followed_id)
-
-        # print(f"\n\nhomepage: following: {following}\n\n", flush=True)
-
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-
-        liked_msgs = get_user_likes(g.user.id)
-        return render_template('home.html', messages=messages, likes=liked_msgs)
-
-    else:
-        return render_template('home-anon.html')
-
-##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
+    if name != "app":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-@ app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
+    with _app_lock:
+        if "app" not in globals():
+            globals()["app"] = create_app()
 
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+    return globals()["app"]
@@ -0,0 +1,454 @@
+"""ASGI entry point for Warbler.
+
+Serves the read-only feed and profile endpoints of the JSON API with async
+handlers and hands everything else -- the HTML pages, the forms, every
+write -- to the regular Flask app through asgiref's WSGI adapter.
+
+The async handlers read Postgres through an asyncpg connection pool. The
+independent queries of a request (the viewer check, the viewer's likes and
+follow set, the feed or profile rows, the counters) each take their own
+pooled connection and run together under asyncio.gather, so a request waits
+for its slowest query instead of the sum of all of them.
+
+Async endpoints (same paths and payloads as api.py):
+
+- GET /api/v1/feed
+- GET /api/v1/users/<id>
+- GET /api/v1/users/<id>/messages
+- GET /api/v1/users/<id>/followers
+- GET /api/v1/users/<id>/following
+
+Run it with any ASGI server:
+
+    uvicorn asgi:app --workers 4
+
+Without a Postgres database (e.g. SQLite locally) every request goes to the
+Flask app. Pool size comes from ASYNC_DB_POOL_MIN / ASYNC_DB_POOL_MAX; the
+statement timeout and pgbouncer settings are the ones app.py reads.
+"""
+
+import asyncio
+import hashlib
+import os
+import re
+from datetime import datetime
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+
+
+from api import (APIError, DEFAULT_LIMIT, MAX_LIMIT, MESSAGE_FIELDS,
+                 USER_FIELDS, decode_cursor, dumps, encode_cursor)
+from app import create_app
+from sessions import cookie_user_id
+
+try:
+    import asyncpg
+except ImportError:  # pragma: no cover - only needed for the async reads
+    asyncpg = None
+
+# SQL for the fields of api.py's MESSAGE_FIELDS / USER_FIELDS
+MESSAGE_COLUMNS = {
+    "id": "m.id",
+    "text": "m.text",
+    "timestamp": "m.timestamp",
+    "user_id": "m.user_id",
+    "username": "u.username",
+    "image_url": "u.image_url",
+}
+
+USER_COLUMNS = {
+    "id": "u.id",
+    "username": "u.username",
+    "image_url": "u.image_url",
+    "header_image_url": "u.header_image_url",
+    "bio": "u.bio",
+    "location": "u.location",
+}
+
+# types of a message cursor: (timestamp, id)
+CURSOR_TYPES = (datetime, int)
+
+assert list(MESSAGE_COLUMNS) == list(MESSAGE_FIELDS)
+assert list(USER_COLUMNS) == list(USER_FIELDS)
+
+
+def asyncpg_dsn(uri):
+    """The asyncpg DSN for a SQLAlchemy URI, or None when it is not Postgres."""
+
+    scheme, sep, rest = uri.partition("://")
+    if not sep or scheme.split("+")[0] not in ("postgres", "postgresql"):
+        return None
+
+    return f"postgresql://{rest}"
+
+
+##############################################################################
+# Request helpers
+
+
+class Request:
+    """The parts of an ASGI http scope the handlers use."""
+
+    def __init__(self, scope):
+        self.path = scope["path"]
+        self.params = {key: values[-1] for key, values in
+                       parse_qs(scope["query_string"].decode()).items()}
+        self.headers = {key.decode().lower(): value.decode()
+                        for key, value in scope["headers"]}
+
+    def viewer_id(self):
+        """The logged in user id from the Flask session cookie, if any."""
+
+        cookie = SimpleCookie(self.headers.get("cookie", ""))
+        name = flask_app.config["SESSION_COOKIE_NAME"]
+        if name not in cookie:
+            return None
+
+        return cookie_user_id(flask_app, cookie[name].value)
+
+    def fields(self, available):
+        fields = self.params.get("fields")
+        if not fields:
+            return list(available)
+
+        names = [name.strip() for name in fields.split(",") if name.strip()]
+        unknown = [name for name in names if name not in available]
+        if unknown:
+            raise APIError(f"unknown field(s): {', '.join(unknown)}")
+
+        return names
+
+    def limit(self):
+        try:
+            limit = int(self.params.get("limit", DEFAULT_LIMIT))
+        except ValueError:
+            raise APIError("limit must be a number")
+
+        return max(1, min(limit, MAX_LIMIT))
+
+
+##############################################################################
+# Async reads
+
+
+class AsyncReads:
+    """The asyncpg pool and the queries of the async endpoints."""
+
+    def __init__(self, dsn, config):
+        self.dsn = dsn
+        self.config = config
+        self.pool = None
+        self._starting = None
+
+    async def start(self):
+        """Create the pool (once, even when requests race to start it)."""
+
+        if self.pool is None:
+            if self._starting is None:
+                self._starting = asyncio.ensure_future(self._create_pool())
+            await self._starting
+
+    async def _create_pool(self):
+        options = {
+            "min_size": int(os.environ.get("ASYNC_DB_POOL_MIN", 2)),
+            "max_size": int(os.environ.get(
+                "ASYNC_DB_POOL_MAX", self.config.get("DB_POOL_SIZE", 5) * 2)),
+        }
+
+        if self.config.get("DB_PGBOUNCER"):
+            # transaction pooling: no prepared statements, no startup settings
+            options["statement_cache_size"] = 0
+        elif self.config.get("DB_STATEMENT_TIMEOUT_MS"):
+            options["server_settings"] = {
+                "statement_timeout": str(self.config["DB_STATEMENT_TIMEOUT_MS"])}
+
+        self.pool = await asyncpg.create_pool(self.dsn, **options)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def fetch(self, sql, *args):
+        """Run one query on its own pooled connection."""
+
+        async with self.pool.acquire() as conn:
+            return await conn.fetch(sql, *args)
+
+    async def fetchval(self, sql, *args):
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval(sql, *args)
+
+    async def active_user(self, user_id):
+        """Is user_id a user who has not deleted their account?"""
+
+        if user_id is None:
+            return False
+
+        return await self.fetchval(
+            "SELECT 1 FROM users WHERE id = $1 AND deleted_at IS NULL",
+            user_id) is not None
+
+    async def liked_ids(self, user_id, message_ids):
+        """Which of message_ids user_id likes -- only the page's, as api.py."""
+
+        if not message_ids:
+            return []
+
+        rows = await self.fetch(
+            "SELECT message_id FROM likes "
+            "WHERE user_id = $1 AND message_id = ANY($2::int[])",
+            user_id, list(message_ids))
+        return sorted(row["message_id"] for row in rows)
+
+    async def is_following(self, user_id, other_id):
+        return await self.fetchval(
+            "SELECT EXISTS (SELECT 1 FROM follows "
+            "WHERE user_following_id = $1 AND user_being_followed_id = $2)",
+            user_id, other_id)
+
+    async def messages_page(self, request, where, args):
+        """Page of messages matching `where`, newest first. Returns the payload
+        and the ids of the page's messages.
+        """
+
+        fields = request.fields(MESSAGE_COLUMNS)
+        limit = request.limit()
+        args = list(args)
+
+        cursor_sql = ""
+        cursor = request.params.get("cursor")
+        if cursor:
+            timestamp, message_id = decode_cursor(cursor, *CURSOR_TYPES)
+            args += [timestamp, message_id]
+            cursor_sql = (f" AND (m.timestamp, m.id) < "
+                          f"(${len(args) - 1}, ${len(args)})")
+
+        columns = ", ".join(MESSAGE_COLUMNS[name] for name in fields)
+        rows = await self.fetch(
+            f"SELECT {columns}, m.timestamp AS sort_ts, m.id AS sort_id "
+            f"FROM messages m JOIN users u ON u.id = m.user_id "
+            f"WHERE {where} AND u.deleted_at IS NULL{cursor_sql} "
+            f"ORDER BY m.timestamp DESC, m.id DESC LIMIT {limit + 1}", *args)
+
+        return page_payload(rows, fields, limit), \
+            [row["sort_id"] for row in rows[:limit]]
+
+    async def users_page(self, request, join, where, args):
+        """Page of users in id order."""
+
+        fields = request.fields(USER_COLUMNS)
+        limit = request.limit()
+        args = list(args)
+
+        cursor_sql = ""
+        cursor = request.params.get("cursor")
+        if cursor:
+            user_id, = decode_cursor(cursor, int)
+            args.append(user_id)
+            cursor_sql = f" AND u.id > ${len(args)}"
+
+        columns = ", ".join(USER_COLUMNS[name] for name in fields)
+        rows = await self.fetch(
+            f"SELECT {columns}, u.id AS sort_id FROM users u {join} "
+            f"WHERE {where} AND u.deleted_at IS NULL{cursor_sql} "
+            f"ORDER BY u.id LIMIT {limit + 1}", *args)
+
+        return page_payload(rows, fields, limit)
+
+
+def page_payload(rows, fields, limit):
+    """{"data", "next"} from rows that end in the sort_* columns."""
+
+    width = len(fields)
+    data = [dict(zip(fields, tuple(row)[:width])) for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = encode_cursor(*tuple(rows[limit - 1])[width:])
+
+    return {"data": data, "next": next_cursor}
+
+
+
+##############################################################################
+# Handlers
+
+
+async def feed(reads, request):
+    viewer_id = request.viewer_id()
+
+    viewer_ok, (payload, message_ids) = await asyncio.gather(
+        reads.active_user(viewer_id),
+        reads.messages_page(
+            request,
+            "m.user_id IN (SELECT user_being_followed_id FROM follows "
+            "WHERE user_following_id = $1)", [viewer_id or 0]))
+
+    if not viewer_ok:
+        raise APIError("login required", 401)
+
+    payload["liked"] = await reads.liked_ids(viewer_id, message_ids)
+    return payload
+
+
+async def profile(reads, request, user_id):
+    viewer_id = request.viewer_id()
+    columns = ", ".join(USER_COLUMNS.values())
+
+    (user, counts, (messages, message_ids), following,
+     viewer_ok) = await asyncio.gather(
+        reads.fetch(f"SELECT {columns} FROM users u "
+                    f"WHERE u.id = $1 AND u.deleted_at IS NULL", user_id),
+        reads.fetch(
+            "SELECT (SELECT count(*) FROM messages WHERE user_id = $1) AS messages, "
+            "(SELECT count(*) FROM follows WHERE user_following_id = $1) AS following, "
+            "(SELECT count(*) FROM follows WHERE user_being_followed_id = $1) AS followers, "
+            "(SELECT count(*) FROM likes WHERE user_id = $1) AS likes", user_id),
+        reads.messages_page(request, "m.user_id = $1", [user_id]),
+        reads.is_following(viewer_id or 0, user_id),
+        reads.active_user(viewer_id))
+
+    if not user:
+        raise APIError("user not found", 404)
+
+    liked = await reads.liked_ids(viewer_id, message_ids) if viewer_ok else []
+
+    return {
+        "user": dict(zip(USER_COLUMNS, tuple(user[0]))),
+        "counts": dict(counts[0]),
+        "is_following": bool(viewer_ok and following),
+        "messages": messages,
+        "liked": liked,
+    }
+
+
+async def user_messages(reads, request, user_id):
+    exists, (payload, _) = await asyncio.gather(
+        reads.active_user(user_id),
+        reads.messages_page(request, "m.user_id = $1", [user_id]))
+
+    if not exists:
+        raise APIError("user not found", 404)
+
+    return payload
+
+
+async def user_followers(reads, request, user_id):
+    viewer_ok, exists, payload = await asyncio.gather(
+        reads.active_user(request.viewer_id()),
+        reads.active_user(user_id),
+        reads.users_page(
+            request, "JOIN follows f ON f.user_following_id = u.id",
+            "f.user_being_followed_id = $1", [user_id]))
+
+    if not viewer_ok:
+        raise APIError("login required", 401)
+    if not exists:
+        raise APIError("user not found", 404)
+
+    return payload
+
+
+async def user_following(reads, request, user_id):
+    viewer_ok, exists, payload = await asyncio.gather(
+        reads.active_user(request.viewer_id()),
+        reads.active_user(user_id),
+        reads.users_page(
+            request, "JOIN follows f ON f.user_being_followed_id = u.id",
+            "f.user_following_id = $1", [user_id]))
+
+    if not viewer_ok:
+        raise APIError("login required", 401)
+    if not exists:
+        raise APIError("user not found", 404)
+
+    return payload
+
+
+ROUTES = [
+    (re.compile(r"^/api/v1/feed$"), feed),
+    (re.compile(r"^/api/v1/users/(\d+)$"), profile),
+    (re.compile(r"^/api/v1/users/(\d+)/messages$"), user_messages),
+    (re.compile(r"^/api/v1/users/(\d+)/followers$"), user_followers),
+    (re.compile(r"^/api/v1/users/(\d+)/following$"), user_following),
+]
+
+
+##############################################################################
+# ASGI application
+
+
+class WarblerASGI:
+    """Async handlers for ROUTES, the Flask app for everything else."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi = WsgiToAsgi(wsgi_app)
+
+        dsn = asyncpg_dsn(wsgi_app.config["SQLALCHEMY_DATABASE_URI"])
+        self.reads = AsyncReads(dsn, wsgi_app.config) \
+            if dsn and asyncpg is not None else None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+
+        if (scope["type"] == "http" and self.reads is not None
+                and scope["method"] in ("GET", "HEAD")):
+            for pattern, handler in ROUTES:
+                match = pattern.match(scope["path"])
+                if match:
+                    await self.respond(handler, match.groups(), scope, send)
+                    return
+
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                if self.reads is not None:
+                    await self.reads.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.reads is not None:
+                    await self.reads.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def respond(self, handler, args, scope, send):
+        """Run a handler and send its JSON, or a 304 when the ETag matches."""
+
+        request = Request(scope)
+        await self.reads.start()
+
+        try:
+            payload = await handler(self.reads, request, *map(int, args))
+            status = 200
+        except APIError as err:
+            payload = {"error": err.message}
+            status = err.status
+
+        body = dumps(payload)
+        headers = [(b"content-type", b"application/json")]
+
+        if status == 200:
+            etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+            headers += [(b"etag", etag.encode()),
+                        (b"cache-control", b"private, no-cache")]
+            if etag in request.headers.get("if-none-match", ""):
+                status, body = 304, b""
+
+        if scope["method"] == "HEAD":
+            body = b""
+
+        headers.append((b"content-length", str(len(body)).encode()))
+        await send({"type": "http.response.start", "status": status,
+                    "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+
+flask_app = create_app()
+app = WarblerASGI(flask_app)
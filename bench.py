@@ -0,0 +1,487 @@
+"""Benchmark every route in app.py against a reproducible dataset.
+
+The dataset is built with the row generators in generator/helpers.py from a
+fixed seed, so two runs of the same size see the same users, messages,
+follows and likes. Each route is then driven through the Flask test client
+by `--concurrency` threads (one client, and so one cookie jar, per thread).
+
+For every route the results record p50/p95/p99/mean latency, SQL statements
+per request, the resident set size after the route ran and how much it grew
+while the route ran (the process peak is in the meta section). Results are
+written as JSON; pass a previous results file as --baseline to flag routes
+that got slower or issue more SQL.
+
+Run it like:
+
+    python bench.py --size small --output bench.json
+    python bench.py --size medium --baseline bench.json --output bench-new.json
+
+The database in --database (BENCH_DATABASE_URL) is dropped and re-created.
+"""
+
+import argparse
+import contextvars
+import csv
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+DATASETS = {
+    "small": {"users": 50, "messages": 300, "follows": 500, "likes": 100},
+    "medium": {"users": 300, "messages": 1000, "follows": 5000, "likes": 500},
+    "large": {"users": 3000, "messages": 30000, "follows": 60000, "likes": 10000},
+}
+
+BENCH_PASSWORD = "benchpassword"
+
+# the messages are dated in the two years before this, so every run has the
+#  same timestamps (and the same messages inside the feed window)
+DATASET_NOW = datetime(2024, 1, 1)
+
+# a route is a regression when p95 grows by more than this fraction
+DEFAULT_THRESHOLD = 0.25
+
+
+##############################################################################
+# Statistics
+
+
+def percentile(samples, pct):
+    """Linear-interpolated percentile of samples (pct from 0 to 100)."""
+
+    if not samples:
+        return 0.0
+
+    ordered = sorted(samples)
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def latency_summary(seconds):
+    """p50/p95/p99/mean/max in milliseconds for a list of latencies in seconds."""
+
+    ms = [s * 1000 for s in seconds]
+    return {
+        "count": len(ms),
+        "p50_ms": round(percentile(ms, 50), 3),
+        "p95_ms": round(percentile(ms, 95), 3),
+        "p99_ms": round(percentile(ms, 99), 3),
+        "mean_ms": round(sum(ms) / len(ms), 3) if ms else 0.0,
+        "max_ms": round(max(ms), 3) if ms else 0.0,
+    }
+
+
+def peak_rss_kb():
+    """Peak resident set size of this process in KB."""
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux KB
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def current_rss_kb():
+    """Resident set size of this process right now in KB (the peak where
+    /proc isn't there to ask).
+    """
+
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+    except OSError:
+        return peak_rss_kb()
+    return pages * os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+##############################################################################
+# Dataset
+
+
+def seed_dataset(size, seed):
+    """Drop and re-create the tables and load a `size` dataset. Returns the
+    dataset counts.
+    """
+
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "generator"))
+    from faker import Faker
+    from helpers import (seed_faker, generate_users, generate_messages,
+                         generate_follows, generate_likes)
+    from models import db, User, Message, Follows, Likes
+
+    counts = DATASETS[size]
+    rng = random.Random(seed)
+    fake = Faker()
+    seed_faker(fake, seed)
+
+    # header images from the checked-in CSV, so seeding needs no network
+    with open(os.path.join("generator", "users.csv")) as users_csv:
+        header_image_urls = sorted(
+            {row["header_image_url"] for row in csv.DictReader(users_csv)})
+
+    users = list(generate_users(fake, counts["users"], header_image_urls, rng))
+    messages = list(generate_messages(
+        fake, counts["messages"], counts["users"], rng, now=DATASET_NOW))
+    follows = list(generate_follows(counts["follows"], counts["users"], rng))
+    likes = list(generate_likes(
+        counts["likes"], messages, counts["users"], rng))
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.bulk_insert_mappings(User, users)
+    db.session.bulk_insert_mappings(Message, messages)
+    db.session.bulk_insert_mappings(Follows, follows)
+    db.session.bulk_insert_mappings(Likes, likes)
+    db.session.commit()
+
+    return counts
+
+
+##############################################################################
+# Routes
+
+
+class BenchContext:
+    """State the route definitions share: the bench user and pools of rows
+    for the routes that use rows up (follows, messages, accounts).
+    """
+
+    def __init__(self, counts):
+        from models import db, User, Follows
+
+        self.counts = counts
+        user = User.signup(username="benchuser", email="bench@bench.com",
+                           password=BENCH_PASSWORD, image_url=None)
+        db.session.commit()
+        self.user_id = user.id
+
+        following = {row.user_being_followed_id for row in
+                     Follows.query.filter(Follows.user_following_id == user.id)}
+        self.not_followed = [i for i in range(1, counts["users"] + 1)
+                             if i not in following]
+        self.followed = []
+        self.signed_up = []
+        self.own_messages = None
+
+        # a signed thumbnail URL of the default picture (a static file, so
+        #  the proxy needs no network)
+        from images import thumbnail_url
+        with db.get_app().test_request_context():
+            self.thumbnail = thumbnail_url(User.image_url.default.arg, "card")
+
+    def followed_user(self):
+        """A user the bench user follows, following one when needed."""
+
+        from models import db, Follows
+
+        if not self.followed:
+            user_id = self.not_followed.pop()
+            db.session.add(Follows(user_being_followed_id=user_id,
+                                   user_following_id=self.user_id))
+            db.session.commit()
+            self.followed.append(user_id)
+
+        return self.followed.pop()
+
+    def own_message(self):
+        """Id of a message by the bench user, adding one when needed."""
+
+        from models import db, Message
+
+        if self.own_messages is None:
+            self.own_messages = [row.id for row in (
+                Message.query.with_entities(Message.id)
+                .filter(Message.user_id == self.user_id))]
+
+        if not self.own_messages:
+            msg = Message(text="bench warble", user_id=self.user_id)
+            db.session.add(msg)
+            db.session.commit()
+            return msg.id
+
+        return self.own_messages.pop()
+
+    def throwaway_user(self):
+        """Id of a user that may be deleted, from the signups when possible."""
+
+        from models import db, User
+
+        if self.signed_up:
+            return User.query.filter_by(username=self.signed_up.pop()).one().id
+
+        stamp = time.time_ns()
+        user = User(username=f"benchdelete{stamp}",
+                    email=f"{stamp}@benchdelete.com",
+                    password=BENCH_PASSWORD)
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+
+
+def _follow(ctx, i):
+    user_id = ctx.not_followed.pop()
+    ctx.followed.append(user_id)
+    return f"/users/follow/{user_id}", None
+
+
+def _stop_following(ctx, i):
+    return f"/users/stop-following/{ctx.followed_user()}", None
+
+
+def _signup(ctx, i):
+    username = f"benchsignup{i}"
+    ctx.signed_up.append(username)
+    return "/signup", {"username": username, "email": f"{username}@bench.com",
+                       "password": BENCH_PASSWORD, "image_url": ""}
+
+
+def _message_delete(ctx, i):
+    return f"/messages/{ctx.own_message()}/delete", None
+
+
+def _delete_user(ctx, i):
+    return "/users/delete", None, ctx.throwaway_user()
+
+
+# name, method, path or callable(ctx, i) -> (path, data[, login user id]),
+#  form data, logged in. Routes run in this order; the ones that use rows up
+#  run after the ones that create them (follows before stop-following, new
+#  messages before deletes, signups before account deletion) and BenchContext
+#  fills in when a route runs on its own.
+ROUTES = [
+    ("homepage_anon", "GET", "/", None, False),
+    ("homepage", "GET", "/", None, True),
+    ("signup_form", "GET", "/signup", None, False),
+    ("signup", "POST", _signup, None, False),
+    ("login_form", "GET", "/login", None, False),
+    ("login", "POST", "/login",
+     {"username": "benchuser", "password": BENCH_PASSWORD}, False),
+    ("logout", "GET", "/logout", None, True),
+    ("list_users", "GET", "/users", None, True),
+    ("search_users", "GET", "/users?q=a", None, True),
+    ("users_show", "GET", lambda ctx, i: (f"/users/{i % ctx.counts['users'] + 1}", None), None, True),
+    ("user_likes", "GET", lambda ctx, i: (f"/users/{ctx.user_id}/likes", None), None, True),
+    ("show_following", "GET", lambda ctx, i: (f"/users/{i % ctx.counts['users'] + 1}/following", None), None, True),
+    ("users_followers", "GET", lambda ctx, i: (f"/users/{i % ctx.counts['users'] + 1}/followers", None), None, True),
+    ("add_follow", "POST", _follow, None, True),
+    ("homepage_following", "GET", "/", None, True),
+    ("stop_following", "POST", _stop_following, None, True),
+    ("profile_form", "GET", "/users/profile", None, True),
+    ("profile", "POST", "/users/profile",
+     {"username": "benchuser", "email": "bench@bench.com",
+      "password": BENCH_PASSWORD, "image_url": "", "header_image_url": "",
+      "location": "Bench", "bio": "benchmarking"}, True),
+    ("messages_form", "GET", "/messages/new", None, True),
+    ("messages_add", "POST", lambda ctx, i: ("/messages/new", {"text": f"bench warble {i}"}), None, True),
+    ("messages_show", "GET", lambda ctx, i: (f"/messages/{i % ctx.counts['messages'] + 1}", None), None, True),
+    ("messages_like", "POST", lambda ctx, i: (f"/messages/{i % ctx.counts['messages'] + 1}/likes/all", None), None, True),
+    ("messages_destroy", "POST", _message_delete, None, True),
+    ("delete_user", "POST", _delete_user, None, True),
+    ("trending", "GET", "/trending", None, True),
+    ("search", "GET", lambda ctx, i: (f"/search?q=bench+warble&page={i % 3 + 1}", None), None, True),
+    ("export_user", "GET", "/users/export?format=ndjson", None, True),
+    ("image_thumbnail", "GET", lambda ctx, i: (ctx.thumbnail, None), None, False),
+    ("health_db", "GET", "/health/db", None, False),
+]
+
+
+##############################################################################
+# Runner
+
+
+class StatementCounter:
+    """ Counts SQL statements per request through an engine event. The count
+        lives in a context variable, so statements that a request hands to
+        other threads (the profile loader) are counted too.
+    """
+
+    def __init__(self):
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+
+        self.current = contextvars.ContextVar("bench_statements", default=None)
+        event.listen(Engine, "before_cursor_execute", self._count)
+
+    def _count(self, conn, cursor, statement, params, context, many):
+        counts = self.current.get()
+        if counts is not None:
+            counts[0] += 1
+
+    def reset(self):
+        self.current.set([0])
+
+    @property
+    def count(self):
+        counts = self.current.get()
+        return counts[0] if counts else 0
+
+
+def run_route(app, ctx, counter, route, iterations, concurrency):
+    """Run one route `iterations` times and summarise it."""
+
+    from app import CURR_USER_KEY
+
+    name, method, path, data, logged_in = route
+
+    # build every request up front so the timed part only sends requests
+    requests = []
+    for i in range(iterations):
+        login_id = ctx.user_id if logged_in else None
+        if callable(path):
+            built = path(ctx, i)
+            if len(built) == 3:
+                login_id = built[2]
+            requests.append((built[0], built[1] or data, login_id))
+        else:
+            requests.append((path, data, login_id))
+
+    local = threading.local()
+
+    def send(request):
+        req_path, req_data, login_id = request
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = app.test_client()
+
+        with client.session_transaction() as sess:
+            sess.clear()
+            if login_id:
+                sess[CURR_USER_KEY] = login_id
+
+        counter.reset()
+        start = time.perf_counter()
+        resp = client.open(req_path, method=method, data=req_data)
+        # streamed pages and exports do their work as the body is read
+        resp.get_data()
+        resp.close()
+        elapsed = time.perf_counter() - start
+
+        return elapsed, counter.count, resp.status_code
+
+    rss_before = current_rss_kb()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(send, requests))
+    rss_after = current_rss_kb()
+
+    summary = latency_summary([r[0] for r in results])
+    summary["sql_per_request"] = round(
+        sum(r[1] for r in results) / len(results), 2)
+    summary["errors"] = sum(1 for r in results if r[2] >= 500)
+    summary["statuses"] = sorted({r[2] for r in results})
+    summary["rss_kb"] = rss_after
+    summary["rss_delta_kb"] = rss_after - rss_before
+
+    return summary
+
+
+def compare(results, baseline, threshold):
+    """Routes that regressed against baseline: p95 beyond threshold, more SQL
+    per request, or new server errors.
+    """
+
+    regressions = []
+
+    for name, now in results["routes"].items():
+        before = baseline.get("routes", {}).get(name)
+        if before is None:
+            continue
+
+        if before["p95_ms"] and now["p95_ms"] > before["p95_ms"] * (1 + threshold):
+            regressions.append(
+                f"{name}: p95 {before['p95_ms']}ms -> {now['p95_ms']}ms")
+        if now["sql_per_request"] > before["sql_per_request"]:
+            regressions.append(
+                f"{name}: SQL/request {before['sql_per_request']} -> {now['sql_per_request']}")
+        if now["errors"] > before["errors"]:
+            regressions.append(
+                f"{name}: server errors {before['errors']} -> {now['errors']}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Warbler routes.")
+    parser.add_argument("--size", choices=sorted(DATASETS), default="small")
+    parser.add_argument("--iterations", type=int, default=50,
+                        help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="client threads per route")
+    parser.add_argument("--seed", type=int, default=26)
+    parser.add_argument("--database", default=os.environ.get(
+        "BENCH_DATABASE_URL", "postgresql:///warbler-bench"))
+    parser.add_argument("--routes", help="comma separated route names to run")
+    parser.add_argument("--output", help="write the JSON results here")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args()
+
+    from app import create_app
+
+    # every request comes from one client, so the rate limits are off
+    app = create_app({"SQLALCHEMY_DATABASE_URI": args.database,
+                      "WTF_CSRF_ENABLED": False,
+                      "RATE_LIMITS": {},
+                      # thumbnails start from an empty cache on every run
+                      "IMAGE_CACHE_DIR": tempfile.mkdtemp(prefix="bench-images-"),
+                      "TRENDING_SNAPSHOT_SECONDS": 0})
+
+    counts = seed_dataset(args.size, args.seed)
+    ctx = BenchContext(counts)
+    counter = StatementCounter()
+
+    selected = set(args.routes.split(",")) if args.routes else None
+    results = {
+        "meta": {
+            "size": args.size,
+            "dataset": counts,
+            "iterations": args.iterations,
+            "concurrency": args.concurrency,
+            "seed": args.seed,
+            "dataset_now": DATASET_NOW.isoformat(),
+            "python": platform.python_version(),
+            "started": datetime.utcnow().isoformat(),
+        },
+        "routes": {},
+    }
+
+    for route in ROUTES:
+        if selected and route[0] not in selected:
+            continue
+
+        summary = run_route(app, ctx, counter, route,
+                            args.iterations, args.concurrency)
+        results["routes"][route[0]] = summary
+        print(f"{route[0]:20} p50 {summary['p50_ms']:9.2f}ms  "
+              f"p95 {summary['p95_ms']:9.2f}ms  p99 {summary['p99_ms']:9.2f}ms  "
+              f"sql {summary['sql_per_request']:6.1f}  "
+              f"rss {summary['rss_kb']}KB ({summary['rss_delta_kb']:+}KB)",
+              flush=True)
+
+    results["meta"]["peak_rss_kb"] = peak_rss_kb()
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file),
+                                  args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""Response compression, as WSGI middleware around the Flask app.
+
+HTML and JSON went out uncompressed: /users with every user card is a few
+hundred KB of very repetitive markup. The middleware compresses responses
+for clients that accept it:
+
+- brotli (when the `brotli` package is installed) or gzip, whichever the
+  client's Accept-Encoding prefers, brotli winning ties;
+- only text, JSON, JavaScript, XML and SVG -- images, zips and server-sent
+  event streams go through as they are;
+- only bodies of at least COMPRESS_MIN_SIZE bytes. Whether a response is
+  compressible is decided from its status and headers; only then are a
+  compressible body's first bytes held until that many have arrived (or
+  the body ended), so a streamed page with no Content-Length is measured
+  the same way. Everything else goes through unbuffered;
+- at COMPRESS_LEVEL (gzip, 1-9) and COMPRESS_BROTLI_QUALITY (0-11).
+  COMPRESS_LEVEL=0 turns compression off.
+
+Streamed pages (stream_template in views.py) stay streamed: the compressor
+is flushed once after the first chunk, so the <head> with the stylesheets
+gets to the browser straight away, and after that sends whatever the
+compressor emits as it fills.
+
+A compressed response's ETag becomes weak (W/"..."): the bytes differ from
+the uncompressed ones, but If-None-Match compares weakly, so 304s still
+work.
+"""
+
+import zlib
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+COMPRESSIBLE = ("text/", "application/json", "application/javascript",
+                "application/xml", "image/svg+xml")
+
+# streams that must reach the client event by event
+NEVER = ("text/event-stream",)
+
+
+def accepted_encodings(header):
+    """{encoding: q} from an Accept-Encoding header."""
+
+    encodings = {}
+    for part in (header or "").split(","):
+        name, _, params = part.strip().partition(";")
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        encodings[name.strip().lower()] = q
+    return encodings
+
+
+def choose_encoding(header):
+    """ "br", "gzip" or None for an Accept-Encoding header. """
+
+    accepted = accepted_encodings(header)
+    wildcard = accepted.get("*", 0.0)
+
+    best, best_q = None, 0.0
+    for encoding in (("br", "gzip") if brotli is not None else ("gzip",)):
+        q = accepted.get(encoding, wildcard)
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+class Compressor:
+    """Streaming gzip or brotli with the same three calls."""
+
+    def __init__(self, encoding, level, brotli_quality):
+        self.encoding = encoding
+        if encoding == "br":
+            self.brotli = brotli.Compressor(quality=brotli_quality)
+        else:
+            # wbits 31: a gzip header and trailer around the deflate stream
+            self.zlib = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        if self.encoding == "br":
+            return self.brotli.process(data)
+        return self.zlib.compress(data)
+
+    def flush(self):
+        if self.encoding == "br":
+            return self.brotli.flush()
+        return self.zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == "br":
+            return self.brotli.finish()
+        return self.zlib.flush()
+
+
+class CompressionMiddleware:
+    """Compress the wrapped WSGI app's responses (see the module docstring)."""
+
+    def __init__(self, app, min_size=1024, level=6, brotli_quality=5):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+        self.brotli_quality = brotli_quality
+
+    def __call__(self, environ, start_response):
+        encoding = choose_encoding(environ.get("HTTP_ACCEPT_ENCODING"))
+        if not self.level or environ["REQUEST_METHOD"] == "HEAD":
+            encoding = None
+
+        captured = {}
+
+        def capture(status, headers, exc_info=None):
+            captured["status"] = status
+            captured["headers"] = headers
+            captured["exc_info"] = exc_info
+            # the app's write() callable; nothing here uses it
+            return lambda data: None
+
+        body = self.app(environ, capture)
+        try:
+            yield from self.respond(body, captured, encoding, start_response)
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+
+    def compressible(self, captured):
+        status = int(captured["status"].split(" ", 1)[0])
+        headers = {name.lower(): value for name, value in captured["headers"]}
+        mimetype = headers.get("content-type", "").split(";")[0].strip()
+
+        if status < 200 or status in (204, 206, 304):
+            return False
+        if "content-encoding" in headers:
+            return False
+        if mimetype.startswith(NEVER) or not mimetype.startswith(COMPRESSIBLE):
+            return False
+        length = headers.get("content-length")
+        if length is not None and length.isdigit() and int(length) < self.min_size:
+            return False
+        return True
+
+    def respond(self, body, captured, encoding, start_response):
+        chunks = iter(body)
+        held, size = [], 0
+
+        if "status" not in captured:
+            # an app that only calls start_response with its first chunk
+            #  (Flask's responses call it before they're iterated)
+            for chunk in chunks:
+                held.append(chunk)
+                size += len(chunk)
+                break
+            if "status" not in captured:
+                start_response("500 INTERNAL SERVER ERROR", [])
+                return
+
+        # decided from the status and headers alone, so event streams and
+        #  everything else that won't be compressed go out unbuffered
+        if not self.compressible(captured):
+            start_response(captured["status"], captured["headers"],
+                           captured["exc_info"])
+            yield from held
+            yield from chunks
+            return
+
+        headers = [(name, value) for name, value in captured["headers"]
+                   if name.lower() != "vary"]
+        vary = [value for name, value in captured["headers"]
+                if name.lower() == "vary"]
+        headers.append(("Vary", ", ".join(vary + ["Accept-Encoding"])))
+
+        if encoding is None:
+            start_response(captured["status"], headers, captured["exc_info"])
+            yield from held
+            yield from chunks
+            return
+
+        # a compressible body: held until it is known to be big enough
+        if size < self.min_size:
+            for chunk in chunks:
+                held.append(chunk)
+                size += len(chunk)
+                if size >= self.min_size:
+                    break
+
+        if size < self.min_size:
+            # the whole body, and too small to be worth it
+            start_response(captured["status"], headers, captured["exc_info"])
+            yield from held
+            return
+
+        compressor = Compressor(encoding, self.level, self.brotli_quality)
+        headers = [(name, value if name.lower() != "etag" or
+                    value.startswith("W/") else "W/" + value)
+                   for name, value in headers
+                   if name.lower() != "content-length"]
+        headers.append(("Content-Encoding", encoding))
+        start_response(captured["status"], headers, captured["exc_info"])
+
+        # the first part right away, then as the compressor fills
+        yield compressor.compress(b"".join(held)) + compressor.flush()
+        for chunk in chunks:
+            out = compressor.compress(chunk)
+            if out:
+                yield out
+        yield compressor.finish()
+
+
+def init_compression(app):
+    """Wrap the app's WSGI callable in the compression middleware."""
+
+    app.config.setdefault("COMPRESS_MIN_SIZE", 1024)
+    app.config.setdefault("COMPRESS_LEVEL", 6)
+    app.config.setdefault("COMPRESS_BROTLI_QUALITY", 5)
+
+    if not app.config["COMPRESS_LEVEL"]:
+        return None
+
+    middleware = CompressionMiddleware(
+        app.wsgi_app, min_size=app.config["COMPRESS_MIN_SIZE"],
+        level=app.config["COMPRESS_LEVEL"],
+        brotli_quality=app.config["COMPRESS_BROTLI_QUALITY"])
+    app.wsgi_app = middleware
+    return middleware
@@ -0,0 +1,163 @@
+"""Export of an account's data as a zip, streamed as it is written.
+
+The zip holds:
+
+- profile.json     the user row (no password hash)
+- messages         the user's messages
+- likes            the messages the user liked, with their authors
+- following        the users the user follows
+- followers        the users following the user
+
+each as NDJSON (one JSON object per line) or CSV. Rows are read in
+EXPORT_CHUNK-row chunks with yield_per (a server-side cursor on Postgres),
+and the zip is written to a sink that hands its bytes on after every
+chunk, so memory stays flat whatever the size of the account and the
+first bytes go out before the last rows are read. The zip entries use data
+descriptors and zip64, since their sizes aren't known up front.
+
+    GET /users/export?format=csv     the logged in user's own data
+    python export.py --user-id 42 --format csv -o user42.zip
+"""
+
+import argparse
+import csv
+import io
+import json
+import sys
+import zipfile
+from datetime import datetime
+
+from models import db, User, Message, Likes, Follows
+
+EXPORT_CHUNK = 1000
+
+FORMATS = ("ndjson", "csv")
+
+PROFILE_COLUMNS = (User.id, User.username, User.email, User.image_url,
+                   User.header_image_url, User.bio, User.location)
+
+
+class ZipSink:
+    """Write-only file for ZipFile; take() returns what was written since."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def to_json(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def encode(rows, columns, fmt):
+    """A chunk of rows as NDJSON lines or CSV rows."""
+
+    if fmt == "csv":
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerows([to_json(value) for value in row] for row in rows)
+        return out.getvalue().encode()
+
+    return "".join(json.dumps(dict(zip(columns, map(to_json, row)))) + "\n"
+                   for row in rows).encode()
+
+
+def tables(user_id):
+    """(name, column names, query) of each file in the export."""
+
+    def users(id_column, filter_column):
+        return (db.session.query(User.id, User.username)
+                .join(Follows, id_column == User.id)
+                .filter(filter_column == user_id, User.deleted_at.is_(None))
+                .order_by(User.id))
+
+    return [
+        ("messages", ("id", "text", "timestamp"),
+         db.session.query(Message.id, Message.text, Message.timestamp)
+         .filter(Message.user_id == user_id)
+         .order_by(Message.id)),
+        ("likes", ("message_id", "text", "timestamp", "author"),
+         db.session.query(Message.id, Message.text, Message.timestamp,
+                          User.username)
+         .join(Likes, Likes.message_id == Message.id)
+         .join(User, Message.user_id == User.id)
+         .filter(Likes.user_id == user_id)
+         .order_by(Likes.id)),
+        ("following", ("id", "username"),
+         users(Follows.user_being_followed_id, Follows.user_following_id)),
+        ("followers", ("id", "username"),
+         users(Follows.user_following_id, Follows.user_being_followed_id)),
+    ]
+
+
+def export_archive(user_id, fmt="ndjson", chunk_size=EXPORT_CHUNK):
+    """Generate the bytes of the zip of user_id's data, chunk by chunk."""
+
+    profile = db.session.query(*PROFILE_COLUMNS).filter(User.id == user_id).one()
+
+    sink = ZipSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("profile.json", json.dumps(
+            {column.key: value for column, value in zip(PROFILE_COLUMNS, profile)},
+            indent=2))
+
+        for name, columns, query in tables(user_id):
+            with archive.open(f"{name}.{fmt}", "w",
+                              force_zip64=True) as entry:
+                if fmt == "csv":
+                    entry.write(encode([columns], columns, fmt))
+
+                rows = []
+                for row in query.yield_per(chunk_size):
+                    rows.append(row)
+                    if len(rows) == chunk_size:
+                        entry.write(encode(rows, columns, fmt))
+                        rows = []
+                        yield sink.take()
+                entry.write(encode(rows, columns, fmt))
+
+            yield sink.take()
+
+    # the central directory
+    yield sink.take()
+
+
+def export_filename(username, fmt):
+    return f"warbler-{username}-{datetime.utcnow():%Y%m%d}-{fmt}.zip"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export a Warbler account's data as a zip.")
+    parser.add_argument("--user-id", type=int, required=True)
+    parser.add_argument("--format", choices=sorted(FORMATS), default="ndjson")
+    parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK)
+    parser.add_argument("-o", "--output",
+                        help="file to write (default: standard output)")
+    args = parser.parse_args()
+
+    from app import create_app
+    create_app({"TEMPLATE_WARMUP": "off"})
+
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for data in export_archive(args.user_id, args.format, args.chunk_size):
+            out.write(data)
+    finally:
+        if args.output:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+"""Process-wide cache of who follows whom.
+
+User.is_following / is_followed_by used to load the whole `following` or
+`followers` collection through the ORM and scan it, once per user per
+request -- the users list asks for every user on the page. This keeps each
+user's followees as a sorted array of 4-byte ids instead, so "does A follow
+B?" is a binary search with no query once A is cached.
+
+- Entries load lazily, from the primary (a lagging replica would otherwise
+  be remembered for the whole TTL).
+- Committed follows and unfollows update the cached arrays: session events
+  see the ORM changes (Follows rows and the User.following / followers
+  collections), writebatch.py reports the batched ones, and a bulk DELETE of
+  follows or users clears the cache.
+- The arrays, plus a fixed per-entry overhead, are kept under
+  FOLLOW_CACHE_BYTES; the least recently used users go first.
+  FOLLOW_CACHE_BYTES=0 turns the cache off.
+
+Other workers' changes arrive through the pubsub hub when it has a
+cross-process backend (PUBSUB_URL). Without one, entries are reloaded after
+FOLLOW_CACHE_TTL seconds, which bounds how stale another worker's follow can
+be.
+"""
+
+import os
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import attributes
+
+# dict slot, key, timestamp and tuple per cached user, on top of the array
+ENTRY_OVERHEAD = 200
+
+
+class FollowCache:
+    """LRU of user id -> sorted array of the ids they follow."""
+
+    def __init__(self, budget_bytes, ttl, loader):
+        self.budget = budget_bytes
+        self.ttl = ttl
+        self.loader = loader
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        # bumped by every change, so a load that raced one isn't stored
+        self.epoch = 0
+        self.counts = {"hits": 0, "misses": 0, "evictions": 0, "changes": 0,
+                       "clears": 0}
+
+    def following(self, user_id):
+        """Sorted array of the ids user_id follows."""
+
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and now - entry[1] < self.ttl:
+                self.entries.move_to_end(user_id)
+                self.counts["hits"] += 1
+                return entry[0]
+            epoch = self.epoch
+
+        self.counts["misses"] += 1
+        followees = array("i", self.loader(user_id))
+
+        with self.lock:
+            if self.epoch == epoch:
+                self._store(user_id, followees, now)
+        return followees
+
+    def is_following(self, user_id, other_id):
+        followees = self.following(user_id)
+        i = bisect_left(followees, other_id)
+        return i < len(followees) and followees[i] == other_id
+
+    def apply(self, changes):
+        """Committed changes: (follower id, followed id, "add" or "remove")."""
+
+        with self.lock:
+            self.epoch += 1
+            for follower_id, followed_id, op in changes:
+                self.counts["changes"] += 1
+                entry = self.entries.get(follower_id)
+                if entry is None:
+                    continue
+
+                followees = entry[0]
+                i = bisect_left(followees, followed_id)
+                present = i < len(followees) and followees[i] == followed_id
+                if op == "add" and not present:
+                    insort(followees, followed_id)
+                    self.bytes += followees.itemsize
+                elif op == "remove" and present:
+                    del followees[i]
+                    self.bytes -= followees.itemsize
+
+            self._evict()
+
+    def clear(self):
+        with self.lock:
+            self.epoch += 1
+            self.entries.clear()
+            self.bytes = 0
+            self.counts["clears"] += 1
+
+    def stats(self):
+        return dict(self.counts, users=len(self.entries), bytes=self.bytes,
+                    budget=self.budget)
+
+    def _store(self, user_id, followees, now):
+        old = self.entries.pop(user_id, None)
+        if old is not None:
+            self.bytes -= entry_size(old[0])
+        self.entries[user_id] = (followees, now)
+        self.bytes += entry_size(followees)
+        self._evict()
+
+    def _evict(self):
+        while self.bytes > self.budget and self.entries:
+            _, (followees, _) = self.entries.popitem(last=False)
+            self.bytes -= entry_size(followees)
+            self.counts["evictions"] += 1
+
+
+def entry_size(followees):
+    return sys.getsizeof(followees) + ENTRY_OVERHEAD
+
+
+def load_following(user_id):
+    from models import db, Follows
+
+    with db.engine.connect() as conn:
+        return [row[0] for row in conn.execute(
+            Follows.__table__.select()
+            .with_only_columns([Follows.user_being_followed_id])
+            .where(Follows.user_following_id == user_id)
+            .order_by(Follows.user_being_followed_id))]
+
+
+def follow_cache():
+    """The current app's FollowCache, or None when it is off (or there is no
+    app context).
+    """
+
+    if not has_app_context():
+        return None
+    return current_app.extensions.get("follow_cache")
+
+
+##############################################################################
+# Keeping it current
+
+
+def follows_committed(changes):
+    """ Tell this process's cache, and through the hub the other workers',
+        about committed follow changes.
+    """
+
+    cache = follow_cache()
+    if cache is None or not changes:
+        return
+
+    cache.apply(changes)
+
+    hub = current_app.extensions.get("pubsub")
+    if hub is not None:
+        hub.publish({"type": "follow", "pid": os.getpid(),
+                     "changes": [list(change) for change in changes]})
+
+
+def _pair(user, other, reverse):
+    return (other.id, user.id) if reverse else (user.id, other.id)
+
+
+def _after_flush(session, context):
+    """Collect the follow rows this flush wrote; they apply on commit."""
+
+    from models import User, Follows
+
+    changes = session.info.setdefault("follow_changes", [])
+
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Follows) and obj in session.new:
+            changes.append((obj.user_following_id, obj.user_being_followed_id,
+                            "add"))
+
+        elif isinstance(obj, User):
+            for name, reverse in (("following", False), ("followers", True)):
+                history = attributes.get_history(
+                    obj, name, passive=attributes.PASSIVE_NO_INITIALIZE)
+                changes.extend((*_pair(obj, other, reverse), "add")
+                               for other in history.added or ())
+                changes.extend((*_pair(obj, other, reverse), "remove")
+                               for other in history.deleted or ())
+
+    for obj in session.deleted:
+        if isinstance(obj, Follows):
+            changes.append((obj.user_following_id, obj.user_being_followed_id,
+                            "remove"))
+
+
+def _after_bulk_delete(delete_context):
+    from models import User, Follows
+
+    if delete_context.mapper.class_ in (User, Follows):
+        delete_context.session.info["follow_cache_clear"] = True
+
+
+def _after_commit(session):
+    changes = session.info.pop("follow_changes", None)
+    clear = session.info.pop("follow_cache_clear", False)
+
+    cache = follow_cache()
+    if cache is None:
+        return
+    if clear:
+        cache.clear()
+    elif changes:
+        follows_committed(changes)
+
+
+def _after_rollback(session):
+    session.info.pop("follow_changes", None)
+    session.info.pop("follow_cache_clear", None)
+
+
+def listen_to_sessions():
+    from models import RoutingSession
+
+    if event.contains(RoutingSession, "after_commit", _after_commit):
+        return
+
+    event.listen(RoutingSession, "after_flush", _after_flush)
+    event.listen(RoutingSession, "after_bulk_delete", _after_bulk_delete)
+    event.listen(RoutingSession, "after_commit", _after_commit)
+    event.listen(RoutingSession, "after_rollback", _after_rollback)
+
+
+def init_follow_cache(app):
+    """ Create the app's follow cache (after init_pubsub, so other workers'
+        changes reach it).
+    """
+
+    app.config.setdefault("FOLLOW_CACHE_BYTES", 32 * 1024 * 1024)
+    app.config.setdefault("FOLLOW_CACHE_TTL", 10)
+
+    if not app.config["FOLLOW_CACHE_BYTES"]:
+        app.extensions["follow_cache"] = None
+        return None
+
+    cache = FollowCache(app.config["FOLLOW_CACHE_BYTES"],
+                        app.config["FOLLOW_CACHE_TTL"], load_following)
+    app.extensions["follow_cache"] = cache
+    listen_to_sessions()
+
+    def changed_elsewhere(event):
+        if event.get("pid") != os.getpid():
+            cache.apply([tuple(change) for change in event["changes"]])
+
+    hub = app.extensions.get("pubsub")
+    if hub is not None:
+        hub.listen("follow", changed_elsewhere)
+
+    return cache
@@ -0,0 +1,283 @@
+"""Offline "who to follow" suggestions from the follow graph.
+
+Walking User.following / followers for friends-of-friends on every request
+is far too slow, so suggestions are computed here, in a job, and stored in
+follow_suggestions; the pages read them with suggestions.py.
+
+The job loads `follows` (between users that aren't deleted) into compressed
+sparse row arrays: user ids are mapped to dense indexes 0..n-1, and the users
+row i follows are indices[indptr[i]:indptr[i + 1]], sorted. Followers get the
+same layout from the reversed edges. That is 4 bytes per follow and direction
+plus 8 bytes per user, so a few million follows fit in tens of megabytes.
+
+For a user u the candidates are the users followed by the users u follows,
+minus u and the users u already follows. A candidate's score is how many of
+the users u follows follow it -- the size of the intersection of u's
+following and the candidate's followers, computed for all candidates at
+once by gathering the rows and counting with np.unique. The top k (by score,
+then lowest id) are kept, each with a few of those mutual follows.
+
+Incremental runs: with --snapshot, the sorted edge list is saved after each
+run. The next run diffs the new edges against it; the users whose following
+changed, and the users following them, are the only ones whose suggestions
+can have changed, so only they are recomputed.
+
+    python followgraph.py                         # every user
+    python followgraph.py --snapshot graph.npy    # only what changed since
+    python followgraph.py --user-id 42            # one user
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+from sqlalchemy import select
+
+from models import db, User, Follows, FollowSuggestion
+
+TOP_K = 20
+
+# mutual follows stored per suggestion
+MUTUALS = 3
+
+# users whose rows are rewritten per transaction
+CHUNK = 500
+
+EMPTY = np.zeros(0, dtype=np.int32)
+
+
+def csr(rows, cols, n):
+    """(indptr, indices) of the edges rows[i] -> cols[i], each row sorted."""
+
+    order = np.lexsort((cols, rows))
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+    return indptr, cols[order].astype(np.int32)
+
+
+def gather(indptr, indices, nodes):
+    """The rows of `nodes`, concatenated, without a Python loop."""
+
+    starts = indptr[nodes]
+    lengths = indptr[nodes + 1] - starts
+    total = int(lengths.sum())
+    if not total:
+        return EMPTY
+
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return indices[offsets + np.arange(total)]
+
+
+class FollowGraph:
+    """The follows between active users as CSR arrays, both directions."""
+
+    def __init__(self, edges):
+        """ edges: int64 array of (follower id, followed id) rows. """
+
+        edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+        self.ids = np.unique(edges)
+        n = len(self.ids)
+
+        src = np.searchsorted(self.ids, edges[:, 0])
+        dst = np.searchsorted(self.ids, edges[:, 1])
+        self.out_ptr, self.out_idx = csr(src, dst, n)
+        self.in_ptr, self.in_idx = csr(dst, src, n)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def index(self, user_id):
+        """Dense index of user_id, or None if they have no follows at all."""
+
+        i = int(np.searchsorted(self.ids, user_id))
+        if i < len(self.ids) and self.ids[i] == user_id:
+            return i
+        return None
+
+    def following(self, i):
+        return self.out_idx[self.out_ptr[i]:self.out_ptr[i + 1]]
+
+    def followers(self, i):
+        return self.in_idx[self.in_ptr[i]:self.in_ptr[i + 1]]
+
+    def suggest(self, user_id, k=TOP_K):
+        """[(suggested id, score, [mutual ids])], best first."""
+
+        i = self.index(user_id)
+        if i is None:
+            return []
+
+        followed = self.following(i)
+        candidates, scores = np.unique(
+            gather(self.out_ptr, self.out_idx, followed), return_counts=True)
+
+        keep = ((candidates != i)
+                & ~np.isin(candidates, followed, assume_unique=True))
+        candidates, scores = candidates[keep], scores[keep]
+
+        if len(candidates) > k:
+            # everyone scoring at least the k-th best, ties included, so the
+            #  sort below -- not the partition -- picks among equal scores
+            kth = -np.partition(-scores, k - 1)[k - 1]
+            top = scores >= kth
+            candidates, scores = candidates[top], scores[top]
+
+        # by score, then by id (the dense index sorts like the user id)
+        order = np.lexsort((candidates, -scores))[:k]
+
+        return [(int(self.ids[c]), int(score),
+                 [int(m) for m in self.ids[np.intersect1d(
+                     followed, self.followers(c), assume_unique=True)[:MUTUALS]]])
+                for c, score in zip(candidates[order], scores[order])]
+
+    def affected_by(self, changed_ids):
+        """ The users whose suggestions depend on the following of
+            changed_ids: those users themselves and their followers.
+        """
+
+        changed_ids = np.asarray(changed_ids, dtype=np.int64)
+        present = np.isin(changed_ids, self.ids)
+        nodes = np.searchsorted(self.ids, changed_ids[present])
+        followers = self.ids[gather(self.in_ptr, self.in_idx, nodes)]
+        return np.union1d(changed_ids, followers)
+
+
+##############################################################################
+# Edges and snapshots
+#
+# An edge list is kept as one sorted int64 per follow, follower << 32 |
+# followed, so two of them diff with one setxor.
+
+
+def load_edges(conn):
+    """The follows between users that aren't deleted, as encoded edges."""
+
+    follower = User.__table__.alias("follower")
+    followed = User.__table__.alias("followed")
+    query = (select([Follows.user_following_id, Follows.user_being_followed_id])
+             .select_from(Follows.__table__
+                          .join(follower, follower.c.id == Follows.user_following_id)
+                          .join(followed, followed.c.id == Follows.user_being_followed_id))
+             .where(follower.c.deleted_at.is_(None))
+             .where(followed.c.deleted_at.is_(None)))
+
+    result = conn.execution_options(stream_results=True).execute(query)
+    parts = []
+    while True:
+        rows = result.fetchmany(100000)
+        if not rows:
+            break
+        pairs = np.array(rows, dtype=np.int64)
+        parts.append((pairs[:, 0] << 32) | pairs[:, 1])
+
+    return np.sort(np.concatenate(parts)) if parts else np.zeros(0, np.int64)
+
+
+def decode(edges):
+    return np.column_stack((edges >> 32, edges & 0xFFFFFFFF))
+
+
+def changed_followers(old_edges, new_edges):
+    """Ids of the users who followed or unfollowed someone between the two."""
+
+    return np.unique(np.setxor1d(old_edges, new_edges, assume_unique=True) >> 32)
+
+
+def load_snapshot(path):
+    if path and os.path.exists(path):
+        return np.load(path)
+    return None
+
+
+def save_snapshot(path, edges):
+    # write and rename, so a crash never leaves half a snapshot
+    tmp = f"{path}.tmp.npy"
+    np.save(tmp, edges)
+    os.replace(tmp, path)
+
+
+##############################################################################
+# Writing suggestions
+
+
+def write_suggestions(graph, user_ids, k=TOP_K, report=None):
+    """Recompute and replace the stored suggestions of user_ids."""
+
+    user_ids = [int(user_id) for user_id in user_ids]
+
+    for start in range(0, len(user_ids), CHUNK):
+        chunk = user_ids[start:start + CHUNK]
+        rows = [{"user_id": user_id, "suggested_id": suggested_id,
+                 "rank": rank, "score": score, "mutual_ids": mutual_ids}
+                for user_id in chunk
+                for rank, (suggested_id, score, mutual_ids)
+                in enumerate(graph.suggest(user_id, k))]
+
+        FollowSuggestion.query.filter(
+            FollowSuggestion.user_id.in_(chunk)).delete(synchronize_session=False)
+        db.session.bulk_insert_mappings(FollowSuggestion, rows)
+        db.session.commit()
+
+        if report:
+            report(start + len(chunk), len(user_ids))
+
+
+def refresh(snapshot=None, user_ids=None, k=TOP_K, report=None):
+    """ Load the graph and rewrite the suggestions that may have changed:
+        user_ids if given, else the users affected since `snapshot`, else
+        everyone. Returns (graph, users recomputed).
+    """
+
+    with db.engine.connect() as conn:
+        edges = load_edges(conn)
+    graph = FollowGraph(decode(edges))
+
+    # a snapshot only describes the stored suggestions after a full or
+    #  incremental run, not after recomputing a few users
+    partial = user_ids is not None
+
+    if not partial:
+        old_edges = load_snapshot(snapshot)
+        if old_edges is None:
+            # everyone, including users left with no follows at all
+            user_ids = np.union1d(
+                graph.ids,
+                [row[0] for row in db.session.query(FollowSuggestion.user_id)
+                 .distinct()])
+        else:
+            user_ids = graph.affected_by(changed_followers(old_edges, edges))
+
+    write_suggestions(graph, user_ids, k, report)
+
+    if snapshot and not partial:
+        save_snapshot(snapshot, edges)
+
+    return graph, len(user_ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Precompute who-to-follow suggestions from the follows table.")
+    parser.add_argument("--snapshot",
+                        help="edge list of the last run; only users affected "
+                             "by follows since then are recomputed")
+    parser.add_argument("--user-id", type=int, action="append",
+                        help="recompute just these users (repeatable)")
+    parser.add_argument("--top-k", type=int, default=TOP_K)
+    args = parser.parse_args()
+
+    from app import create_app
+    create_app({"TEMPLATE_WARMUP": "off"})
+    db.create_all()
+
+    started = time.perf_counter()
+    graph, users = refresh(args.snapshot, args.user_id, args.top_k,
+                           report=lambda done, total: print(
+                               f"\r{done}/{total} users", end="", flush=True))
+    print(f"\n{len(graph)} users in the graph, {users} recomputed "
+          f"in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
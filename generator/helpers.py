@@ -1,14 +1,98 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+import random
+from datetime import datetime, timedelta
+from itertools import permutations
 
+MAX_WARBLER_LENGTH = 140
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+# bcrypt hash that the generated users share.
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+# Random profile image URLs to use for users
+IMAGE_URLS = [
+    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
+    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
+    for i in range(count)
+]
 
-    return datetime.fromtimestamp(random_timestamp)
+
+def get_random_datetime(year_gap=2, rng=random, now=None):
+    """Get a random datetime within the few years before `now` (default: the
+    current time). Pass a fixed `now` for the same datetimes on every run.
+    """
+
+    now = now or datetime.now()
+    span = timedelta(days=365 * year_gap)
+
+    return now - span + timedelta(seconds=rng.uniform(0, span.total_seconds()))
+
+
+def seed_faker(fake, seed):
+    """Seed a Faker instance (the call changed between Faker versions)."""
+
+    if hasattr(fake, "seed_instance"):
+        fake.seed_instance(seed)
+    else:
+        fake.seed(seed)
+
+
+def generate_users(fake, count, header_image_urls, rng=random):
+    """Rows for users.csv. Usernames and emails get the row number appended
+    so large datasets stay unique.
+    """
+
+    for i in range(count):
+        yield dict(
+            email=f"{i}.{fake.email()}",
+            username=f"{fake.user_name()}{i}",
+            image_url=rng.choice(IMAGE_URLS),
+            password=PASSWORD_HASH,
+            bio=fake.sentence(),
+            header_image_url=rng.choice(header_image_urls),
+            location=fake.city()
+        )
+
+
+def generate_messages(fake, count, num_users, rng=random, now=None):
+    """Rows for messages.csv, spread over users 1..num_users, dated in the
+    two years before `now`.
+    """
+
+    for i in range(count):
+        yield dict(
+            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
+            timestamp=get_random_datetime(rng=rng, now=now),
+            user_id=rng.randint(1, num_users)
+        )
+
+
+def generate_follows(count, num_users, rng=random):
+    """Rows for follows.csv from random pairings of users 1..num_users."""
+
+    if num_users <= 2000:
+        all_pairs = list(permutations(range(1, num_users + 1), 2))
+        pairs = rng.sample(all_pairs, count)
+    else:
+        # too many users to list every pair -- draw until we have enough
+        pairs = set()
+        while len(pairs) < count:
+            followed_user, follower = rng.sample(range(1, num_users + 1), 2)
+            pairs.add((followed_user, follower))
+
+    for followed_user, follower in pairs:
+        yield dict(user_being_followed_id=followed_user, user_following_id=follower)
+
+
+def generate_likes(count, messages, num_users, rng=random):
+    """Rows for likes. messages is the list of message rows (message ids are
+    their 1-based position); a user never likes their own message.
+    """
+
+    for message_id in rng.sample(range(1, len(messages) + 1), count):
+        author = messages[message_id - 1]["user_id"]
+        user_id = rng.randint(1, num_users)
+        while user_id == author:
+            user_id = rng.randint(1, num_users)
+
+        yield dict(user_id=user_id, message_id=message_id)
@@ -0,0 +1,372 @@
+"""Thumbnails of the users' profile and header images.
+
+image_url and header_image_url are whatever a user typed in (or the
+generator made up), and the pages used to hot-link those originals at full
+size: /users with 300 cards pulled 600 of them. Templates now ask for
+
+    {{ user.image_url|thumbnail("card") }}
+
+which is /images/card/<signed url>, and the proxy behind it:
+
+1. fetches the original once (http(s) with IMAGE_FETCH_TIMEOUT and
+   IMAGE_MAX_BYTES, or a /static/ file from disk) and remembers which
+   content the URL had;
+2. makes every size in SIZES from it in one pass on a pool of
+   IMAGE_WORKERS threads (Pillow lets go of the GIL while it decodes and
+   resizes) -- a burst of requests for one image waits on the same job;
+3. stores originals and thumbnails in IMAGE_CACHE_DIR (by default in the
+   instance folder; it must belong to this user) under the SHA-256 of
+   their content, so a picture used by many accounts is kept once;
+4. serves the thumbnails with a year-long, immutable Cache-Control and an
+   ETag.
+
+The URL in the path is signed with the SECRET_KEY, so the proxy only
+fetches images that the app itself linked -- but those are whatever users
+typed in, so the fetcher only connects to public addresses: private,
+loopback, link-local and reserved ones are refused, at the first request
+and after every redirect, and the answer has to be an image/* type. An
+image that can't be fetched or read redirects to its original URL. Without Pillow installed the filter
+returns the original URLs and nothing changes.
+"""
+
+import hashlib
+import http.client
+import io
+import ipaddress
+import os
+import socket
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as JobTimeout
+
+from flask import current_app, url_for
+from itsdangerous import URLSafeSerializer, BadSignature
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # thumbnails need Pillow
+    Image = None
+
+# name -> (width, height): twice the CSS size, for high density screens
+SIZES = {
+    "timeline": (96, 96),
+    "card": (140, 140),
+    "avatar": (400, 400),
+    "hero": (640, 320),
+    "header": (1280, 400),
+}
+
+JPEG_QUALITY = 85
+
+CACHE_SECONDS = 365 * 24 * 3600
+
+# an image that couldn't be fetched or read isn't tried again for this long
+RETRY_SECONDS = 300
+
+
+class ImageError(Exception):
+    """The original couldn't be fetched or isn't an image."""
+
+
+def public_address(address):
+    """Is the IP address one on the internet (not private, loopback, ...)?"""
+
+    ip = ipaddress.ip_address(address.split("%")[0])
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def check_url(url):
+    """Raise ImageError unless url is http(s) on a host with public addresses."""
+
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ImageError(f"can't fetch {url!r}")
+
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    for *_, sockaddr in socket.getaddrinfo(parts.hostname, port,
+                                           proto=socket.IPPROTO_TCP):
+        if not public_address(sockaddr[0]):
+            raise ImageError(f"{url} is not on a public address")
+
+
+def public_connection(address, *args, **kwargs):
+    """ socket.create_connection that refuses a non-public peer -- the
+        address actually connected to, whatever DNS says by then.
+    """
+
+    sock = socket.create_connection(address, *args, **kwargs)
+    if not public_address(sock.getpeername()[0]):
+        sock.close()
+        raise ImageError(f"{address[0]} is not on a public address")
+    return sock
+
+
+class _PublicOnly:
+    """Connections of a urllib handler go through public_connection."""
+
+    def do_open(self, http_class, req, **kwargs):
+        def connection(*args, **kw):
+            conn = http_class(*args, **kw)
+            conn._create_connection = public_connection
+            return conn
+
+        return super().do_open(connection, req, **kwargs)
+
+
+class _PublicHTTPHandler(_PublicOnly, urllib.request.HTTPHandler):
+    pass
+
+
+class _PublicHTTPSHandler(_PublicOnly, urllib.request.HTTPSHandler):
+    pass
+
+
+class _PublicRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Follow redirects only to http(s) URLs on public hosts."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        check_url(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+def fetch_url(url, timeout=5, max_bytes=10 * 1024 * 1024):
+    """The bytes of an http(s) image on a public host."""
+
+    # no proxies: the address connected to is the one that is checked
+    opener = urllib.request.build_opener(
+        urllib.request.ProxyHandler({}), _PublicHTTPHandler,
+        _PublicHTTPSHandler, _PublicRedirectHandler)
+    request = urllib.request.Request(url, headers={"User-Agent": "warbler"})
+    try:
+        check_url(url)
+        with opener.open(request, timeout=timeout) as resp:
+            content_type = resp.headers.get_content_type()
+            if not content_type.startswith("image/"):
+                raise ImageError(f"{url} is {content_type}, not an image")
+            data = resp.read(max_bytes + 1)
+    except (OSError, ValueError, http.client.HTTPException) as err:
+        # ValueError: a URL urllib can't even parse (a bad port, a space)
+        raise ImageError(f"fetching {url}: {err}")
+
+    if len(data) > max_bytes:
+        raise ImageError(f"{url} is over {max_bytes} bytes")
+    return data
+
+
+def make_thumbnails(data):
+    """{size name: JPEG bytes} of every size, decoding data once."""
+
+    try:
+        original = Image.open(io.BytesIO(data))
+        # JPEGs can decode at a fraction of their size straight away
+        original.draft("RGB", max(SIZES.values()))
+        original = ImageOps.exif_transpose(original).convert("RGB")
+    except Exception as err:
+        raise ImageError(f"not an image: {err}")
+
+    thumbnails = {}
+    for name, size in SIZES.items():
+        out = io.BytesIO()
+        ImageOps.fit(original, size, Image.LANCZOS).save(
+            out, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+        thumbnails[name] = out.getvalue()
+    return thumbnails
+
+
+def digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class ImageProxy:
+    """Fetches, resizes and caches images on disk, content-addressed."""
+
+    def __init__(self, cache_dir, workers=4, fetch=fetch_url, static_dir=None):
+        self.cache_dir = cache_dir
+        self.fetch = fetch
+        self.static_dir = static_dir
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="images")
+        # url -> the job making its thumbnails, so concurrent misses share one
+        self.running = {}
+        # url -> when it last failed; not tried again for RETRY_SECONDS
+        self.failed = {}
+        self.lock = threading.Lock()
+        self.counts = {"hits": 0, "misses": 0, "fetches": 0, "errors": 0}
+
+        # whoever can write here picks the thumbnails we serve, cached for
+        #  a year: only a directory of our own
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        if os.stat(cache_dir).st_uid != os.getuid():
+            raise PermissionError(f"{cache_dir} is owned by another user")
+        for sub in ("urls", "originals", "thumbnails"):
+            os.makedirs(os.path.join(cache_dir, sub), mode=0o700,
+                        exist_ok=True)
+
+    def _path(self, sub, name):
+        return os.path.join(self.cache_dir, sub, name[:2], name)
+
+    def _read(self, sub, name):
+        try:
+            with open(self._path(sub, name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write(self, sub, name, data):
+        path = self._path(sub, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _thumbnail_name(self, content, size):
+        return f"{content}-{size}.jpg"
+
+    def cached(self, url, size):
+        """(etag, JPEG bytes) of a thumbnail made before, or None."""
+
+        content = self._read("urls", digest(url.encode()))
+        if content is None:
+            return None
+
+        name = self._thumbnail_name(content.decode(), size)
+        data = self._read("thumbnails", name)
+        return (name, data) if data is not None else None
+
+    def thumbnail(self, url, size, timeout=None):
+        """(etag, JPEG bytes) of url at size; raises ImageError."""
+
+        found = self.cached(url, size)
+        if found:
+            self.counts["hits"] += 1
+            return found
+
+        self.counts["misses"] += 1
+        failed = self.failed.get(url)
+        if failed is not None and time.monotonic() - failed < RETRY_SECONDS:
+            raise ImageError(f"{url} failed lately")
+
+        with self.lock:
+            job = self.running.get(url)
+            if job is None:
+                job = self.running[url] = self.pool.submit(self._make, url)
+        job.add_done_callback(lambda job: self._done(url, job))
+
+        try:
+            job.result(timeout)
+        except JobTimeout:
+            raise ImageError(f"{url} is taking too long")
+        return self.cached(url, size)
+
+    def _done(self, url, job):
+        with self.lock:
+            if self.running.get(url) is job:
+                del self.running[url]
+
+    def _load(self, url):
+        if url.startswith("/static/") and self.static_dir:
+            path = os.path.normpath(os.path.join(self.static_dir,
+                                                 url[len("/static/"):]))
+            if not path.startswith(self.static_dir + os.sep):
+                raise ImageError(f"{url} is outside the static folder")
+            try:
+                with open(path, "rb") as f:
+                    return f.read()
+            except OSError as err:
+                raise ImageError(str(err))
+        return self.fetch(url)
+
+    def _make(self, url):
+        try:
+            self.counts["fetches"] += 1
+            data = self._load(url)
+            content = digest(data)
+
+            if not os.path.exists(self._path("originals", content)):
+                self._write("originals", content, data)
+            for size, thumbnail in make_thumbnails(data).items():
+                self._write("thumbnails", self._thumbnail_name(content, size),
+                            thumbnail)
+
+            # last: a url entry means its thumbnails are all there
+            self._write("urls", digest(url.encode()), content.encode())
+        except Exception:
+            self.counts["errors"] += 1
+            self.failed[url] = time.monotonic()
+            raise
+
+    def stats(self):
+        return dict(self.counts, running=len(self.running),
+                    cache_dir=self.cache_dir)
+
+
+##############################################################################
+# In the app
+
+
+def signer():
+    return URLSafeSerializer(current_app.config["SECRET_KEY"],
+                             salt="image-proxy")
+
+
+def image_proxy():
+    """The app's ImageProxy, or None when thumbnails are off."""
+
+    return current_app.extensions.get("images")
+
+
+def thumbnail_url(url, size):
+    """Template filter: the proxy URL of url's thumbnail at size."""
+
+    if not url or image_proxy() is None:
+        return url
+    if size not in SIZES:
+        raise ValueError(f"no thumbnail size {size!r}")
+
+    return url_for("views.image_thumbnail", size=size,
+                   token=signer().dumps(url))
+
+
+def image_source(token):
+    """The original URL a proxy token was made for, or None."""
+
+    try:
+        return signer().loads(token)
+    except BadSignature:
+        return None
+
+
+def init_images(app):
+    """ Create the app's image proxy and register the thumbnail filter
+        (before init_templates).
+    """
+
+    app.config.setdefault("IMAGE_CACHE_DIR", None)
+    app.config.setdefault("IMAGE_WORKERS", 4)
+    app.config.setdefault("IMAGE_FETCH_TIMEOUT", 5)
+    app.config.setdefault("IMAGE_MAX_BYTES", 10 * 1024 * 1024)
+
+    app.add_template_filter(thumbnail_url, "thumbnail")
+
+    cache_dir = app.config["IMAGE_CACHE_DIR"]
+    if Image is None or cache_dir == "off":
+        app.extensions["images"] = None
+        return None
+
+    if cache_dir is None:
+        os.makedirs(app.instance_path, mode=0o700, exist_ok=True)
+        cache_dir = os.path.join(app.instance_path, "images")
+
+    timeout = app.config["IMAGE_FETCH_TIMEOUT"]
+    max_bytes = app.config["IMAGE_MAX_BYTES"]
+
+    proxy = ImageProxy(cache_dir, app.config["IMAGE_WORKERS"],
+                       fetch=lambda url: fetch_url(url, timeout, max_bytes),
+                       static_dir=os.path.abspath(app.static_folder))
+    app.extensions["images"] = proxy
+    return proxy
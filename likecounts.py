@@ -0,0 +1,153 @@
+"""Per-message like counts kept in sharded counter rows.
+
+Counting a message's likes with COUNT(*) on every feed render gets expensive,
+and a single counter column on the message would make every like of a viral
+warble wait on the same row lock. So each message has up to SHARDS rows in
+like_counts, (message_id, shard, count):
+
+- a like adds 1 to the shard picked by the liker's id, an unlike takes it
+  back from the same shard, in the transaction that writes the likes row;
+- a message's count is the sum of its shards;
+- like_counts() reads the counts of a whole page of messages in one
+  GROUP BY query.
+
+Every code path that adds or removes likes rows has to call bump() -- the
+like toggle in views.py, apply_batch in writebatch.py and the purge. Rows
+removed by the ON DELETE CASCADE of a message take its counters with them.
+
+Existing databases need the likes constraint changed and the counters
+filled once:
+
+    python likecounts.py --migrate      # Postgres: swap the unique constraint
+    python likecounts.py                # recount every message from likes
+
+Recounting is also how to repair counters that drifted (e.g. after likes
+were deleted by hand). It isn't atomic with likes made while it runs, so run
+it when the site is quiet.
+"""
+
+import argparse
+
+from sqlalchemy import func, text
+
+# counter rows per message; more shards spread the writes of a popular
+#  message over more rows, at the price of summing more rows per read
+SHARDS = 8
+
+UPSERT = text("""
+    INSERT INTO like_counts (message_id, shard, count)
+    VALUES (:message_id, :shard, :delta)
+    ON CONFLICT (message_id, shard)
+    DO UPDATE SET count = like_counts.count + excluded.count
+""")
+
+
+def shard_for(user_id):
+    return user_id % SHARDS
+
+
+def bump(conn, changes):
+    """ Apply like count changes. `changes` is an iterable of
+        (user_id, message_id, +1 or -1); `conn` is a Connection or the
+        session, so the counters commit along with the likes rows.
+    """
+
+    deltas = {}
+    for user_id, message_id, delta in changes:
+        key = (message_id, shard_for(user_id))
+        deltas[key] = deltas.get(key, 0) + delta
+
+    # a consistent order, so two batches bumping the same counters can't
+    #  deadlock on each other's row locks
+    params = [{"message_id": message_id, "shard": shard, "delta": delta}
+              for (message_id, shard), delta in sorted(deltas.items())
+              if delta]
+
+    if params:
+        conn.execute(UPSERT, params)
+
+
+def like_counts(message_ids):
+    """{message id: like count} for message_ids, in one query. Messages
+    without likes are left out.
+    """
+
+    from models import db, LikeCount
+
+    message_ids = list(message_ids)
+    if not message_ids:
+        return {}
+
+    rows = (db.session.query(LikeCount.message_id, func.sum(LikeCount.count))
+            .filter(LikeCount.message_id.in_(message_ids))
+            .group_by(LikeCount.message_id))
+
+    return {message_id: int(count) for message_id, count in rows if count}
+
+
+##############################################################################
+# Migration / repair
+
+
+def migrate_likes_constraint():
+    """ Postgres databases created before the remodel have UNIQUE on
+        likes.message_id alone; replace it with UNIQUE (user_id, message_id).
+    """
+
+    from models import db
+
+    if db.engine.dialect.name != "postgresql":
+        raise SystemExit("--migrate only knows Postgres; recreate other "
+                         "databases with db.create_all()")
+
+    db.session.execute(
+        "ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_key")
+    db.session.execute(
+        "ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_user_id_message_id_key")
+    db.session.execute("ALTER TABLE likes ADD CONSTRAINT "
+                       "likes_user_id_message_id_key UNIQUE (user_id, message_id)")
+    db.session.commit()
+
+
+def rebuild():
+    """Recount every message's likes from the likes table. Returns the
+    number of counter rows written.
+    """
+
+    from models import db, Likes, LikeCount
+
+    shard = (Likes.user_id % SHARDS).label("shard")
+    counts = (db.session.query(Likes.message_id, shard, func.count())
+              .group_by(Likes.message_id, shard))
+
+    LikeCount.query.delete()
+    rows = [{"message_id": message_id, "shard": shard, "count": count}
+            for message_id, shard, count in counts]
+    db.session.bulk_insert_mappings(LikeCount, rows)
+    db.session.commit()
+
+    return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Recount the sharded like counters from the likes table.")
+    parser.add_argument("--migrate", action="store_true",
+                        help="first replace the old unique constraint on "
+                             "likes.message_id (Postgres)")
+    args = parser.parse_args()
+
+    from app import create_app
+    from models import db
+    create_app({"TEMPLATE_WARMUP": "off"})
+
+    if args.migrate:
+        migrate_likes_constraint()
+
+    # creates like_counts if it isn't there yet
+    db.create_all()
+    print(f"{rebuild()} counter rows written")
+
+
+if __name__ == "__main__":
+    main()
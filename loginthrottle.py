@@ -0,0 +1,140 @@
+"""Failed-login tracking, so password guessing can't keep bcrypt busy.
+
+Every failed password check -- at login and at the password re-check of the
+profile edit form -- is counted against the username and against the
+client IP in a sliding window (LOGIN_FAILURE_WINDOW seconds). Reaching
+LOGIN_MAX_FAILURES for a username, or LOGIN_MAX_FAILURES_PER_IP for an IP,
+locks it out:
+
+- the first lockout lasts LOGIN_LOCKOUT_SECONDS,
+- each lockout after that doubles, up to LOGIN_MAX_LOCKOUT_SECONDS,
+- a successful login clears the username's record; an IP's record only
+  clears by not failing for a window, so one good account doesn't reset an
+  IP that is guessing at others.
+
+While a username or IP is locked out the attempt is refused before the user
+lookup and before bcrypt, so an attack costs a dict lookup per request
+instead of a hash.
+
+Records are kept per process. With several workers an attacker gets that many
+times the allowance, which still bounds the bcrypt work.
+"""
+
+import threading
+import time
+from collections import deque
+
+
+class AttemptRecord:
+    """Recent failures and the lockout state of one username or IP."""
+
+    __slots__ = ("failures", "locked_until", "lockouts", "last_failure")
+
+    def __init__(self):
+        self.failures = deque()
+        self.locked_until = 0.0
+        self.lockouts = 0
+        self.last_failure = 0.0
+
+
+class LoginThrottle:
+    """Sliding-window failure counters with exponential lockout."""
+
+    def __init__(self, max_failures=5, max_failures_per_ip=20, window=900,
+                 lockout=30, max_lockout=3600):
+        self.limits = {"user": max_failures, "ip": max_failures_per_ip}
+        self.window = window
+        self.lockout = lockout
+        self.max_lockout = max_lockout
+        self.records = {}
+        self.lock = threading.Lock()
+        self.counts = {"failures": 0, "lockouts": 0, "refused": 0}
+
+    def _keys(self, username, ip):
+        keys = []
+        if username:
+            keys.append(("user", username.lower()))
+        if ip:
+            keys.append(("ip", ip))
+        return keys
+
+    def locked_for(self, username, ip, now=None):
+        """Seconds until the username and the IP may try again (0: now)."""
+
+        now = time.monotonic() if now is None else now
+
+        with self.lock:
+            wait = max([self.records[key].locked_until - now
+                        for key in self._keys(username, ip)
+                        if key in self.records] + [0])
+
+        if wait > 0:
+            self.counts["refused"] += 1
+        return wait
+
+    def failure(self, username, ip, now=None):
+        """Count a failed password; locks out whoever reaches their limit."""
+
+        now = time.monotonic() if now is None else now
+        self.counts["failures"] += 1
+
+        with self.lock:
+            for key in self._keys(username, ip):
+                record = self.records.setdefault(key, AttemptRecord())
+
+                # a long quiet spell forgives the earlier lockouts
+                if now - record.last_failure > self.max_lockout + self.window:
+                    record.lockouts = 0
+                record.last_failure = now
+
+                record.failures.append(now)
+                while record.failures and record.failures[0] <= now - self.window:
+                    record.failures.popleft()
+
+                if len(record.failures) >= self.limits[key[0]]:
+                    seconds = min(self.lockout * 2 ** record.lockouts,
+                                  self.max_lockout)
+                    record.locked_until = now + seconds
+                    record.lockouts += 1
+                    record.failures.clear()
+                    self.counts["lockouts"] += 1
+
+            self._prune(now)
+
+    def success(self, username):
+        """A correct password clears the username's record."""
+
+        with self.lock:
+            self.records.pop(("user", username.lower()), None)
+
+    def stats(self):
+        return dict(self.counts, tracked=len(self.records))
+
+    def _prune(self, now):
+        # records with nothing left to remember
+        if len(self.records) < 10000:
+            return
+
+        self.records = {
+            key: record for key, record in self.records.items()
+            if record.locked_until > now
+            or now - record.last_failure < self.max_lockout + self.window}
+
+
+def init_login_throttle(app):
+    """Create the app's login throttle from the LOGIN_* settings."""
+
+    app.config.setdefault("LOGIN_MAX_FAILURES", 5)
+    app.config.setdefault("LOGIN_MAX_FAILURES_PER_IP", 20)
+    app.config.setdefault("LOGIN_FAILURE_WINDOW", 900)
+    app.config.setdefault("LOGIN_LOCKOUT_SECONDS", 30)
+    app.config.setdefault("LOGIN_MAX_LOCKOUT_SECONDS", 3600)
+
+    throttle = LoginThrottle(
+        max_failures=app.config["LOGIN_MAX_FAILURES"],
+        max_failures_per_ip=app.config["LOGIN_MAX_FAILURES_PER_IP"],
+        window=app.config["LOGIN_FAILURE_WINDOW"],
+        lockout=app.config["LOGIN_LOCKOUT_SECONDS"],
+        max_lockout=app.config["LOGIN_MAX_LOCKOUT_SECONDS"])
+    app.extensions["login_throttle"] = throttle
+    return throttle
@@ -0,0 +1,431 @@
+"""Read-through cache for single messages (the /messages/<id> permalink).
+
+Messages never change once written -- they are only ever deleted -- so a
+popular warble can be served without going to the database at all:
+
+1. a per-process LRU (MESSAGE_CACHE_SIZE entries);
+2. a table in a memory-mapped file that every worker on the host maps, so
+   one worker's database read fills the cache for all of them
+   (MESSAGE_CACHE_PATH, by default in the instance folder;
+   MESSAGE_CACHE_SLOTS; MESSAGE_CACHE_PATH=off keeps the cache per
+   process);
+3. the database.
+
+The shared table is a fixed array of slots, hashed by message id. Writers
+take a file lock; readers never lock. Each slot has a sequence number that a
+writer makes odd while it changes the slot and even again when it is done,
+so a reader that sees an odd number, or a different number before and after
+reading, knows the slot changed under it and treats it as a miss.
+
+Invalidation is per key. A message delete forgets that message; a deleted
+account, or an author changing their username or image, forgets that
+user's messages. forget_message/forget_user clear the matching slots of
+the table and append the key to a ring of recent invalidations after the
+header; every process reads the ring entries it hasn't seen yet and drops
+those keys from its LRU. A process that fell more than LOG_SIZE entries
+behind drops its whole LRU.
+
+Bulk changes (archiving a month of messages) use invalidate(), which bumps
+a generation number in the header instead: slots written under an older
+generation stop counting, and every process drops its LRU the next time it
+sees the generation move.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # no shared table without file locks
+    fcntl = None
+
+from flask import current_app
+
+CachedMessage = namedtuple("CachedMessage", [
+    "id", "text", "timestamp", "user_id", "username", "image_url"])
+
+MAGIC = b"WRBLMSG2"
+
+# header: magic, slot count, generation, invalidations logged so far
+HEADER = struct.Struct("<8sQQQ")
+HEADER_SIZE = 64
+
+# the invalidation log: a ring of the last LOG_SIZE keys, a message id or
+#  minus a user id
+LOG_SIZE = 512
+LOG_ENTRY = struct.Struct("<q")
+SLOTS_START = HEADER_SIZE + LOG_SIZE * LOG_ENTRY.size
+
+# slot: sequence, message id, author id, generation, payload length, then
+#  the payload
+SLOT = struct.Struct("<IqqQI")
+SLOT_SIZE = 1024
+MAX_PAYLOAD = SLOT_SIZE - SLOT.size
+
+# slots looked at for a message id before the first one is overwritten
+PROBES = 4
+
+
+class SharedTable:
+    """The memory-mapped slot table shared by the workers on a host."""
+
+    def __init__(self, path, slots):
+        self.path = path
+        self.slots = slots
+        size = SLOTS_START + slots * SLOT_SIZE
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        # whoever can write the table serves the permalinks: only our own
+        if os.fstat(self.fd).st_uid != os.getuid():
+            os.close(self.fd)
+            raise PermissionError(f"{path} is owned by another user")
+
+        with self.locked():
+            magic, file_slots, _, _ = HEADER.unpack(
+                os.pread(self.fd, HEADER.size, 0).ljust(HEADER.size, b"\0"))
+            if magic != MAGIC or file_slots != slots:
+                # new file, or one laid out for another slot count: start over
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, size)
+                os.pwrite(self.fd, HEADER.pack(MAGIC, slots, 1, 0), 0)
+
+        self.map = mmap.mmap(self.fd, size)
+
+    def locked(self):
+        return _FileLock(self.fd)
+
+    @property
+    def generation(self):
+        return HEADER.unpack_from(self.map, 0)[2]
+
+    @property
+    def logged(self):
+        """How many invalidations were ever logged (the ring's write position)."""
+
+        return HEADER.unpack_from(self.map, 0)[3]
+
+    def version(self):
+        """(generation, logged): a put read under an older one is dropped."""
+
+        return HEADER.unpack_from(self.map, 0)[2:]
+
+    def log_since(self, seen):
+        """The keys logged after the first `seen`, or None if the ring has
+        been written over since.
+        """
+
+        logged = self.logged
+        if logged - seen > LOG_SIZE:
+            return None
+
+        keys = [LOG_ENTRY.unpack_from(
+                    self.map, HEADER_SIZE + (i % LOG_SIZE) * LOG_ENTRY.size)[0]
+                for i in range(seen, logged)]
+
+        # entries overwritten while we read them
+        if self.logged - seen > LOG_SIZE:
+            return None
+        return keys
+
+    def _offsets(self, message_id):
+        start = message_id % self.slots
+        for probe in range(PROBES):
+            yield SLOTS_START + ((start + probe) % self.slots) * SLOT_SIZE
+
+    def get(self, message_id):
+        """The payload stored for message_id, or None."""
+
+        generation = self.generation
+        for offset in self._offsets(message_id):
+            seq, key, _, slot_generation, length = SLOT.unpack_from(self.map, offset)
+            if key != message_id:
+                continue
+            if seq % 2 or slot_generation != generation or length > MAX_PAYLOAD:
+                return None
+
+            start = offset + SLOT.size
+            payload = self.map[start:start + length]
+
+            # the slot was rewritten while we read it
+            if SLOT.unpack_from(self.map, offset)[0] != seq:
+                return None
+            return payload
+
+        return None
+
+    def put(self, message_id, user_id, payload, version):
+        """ Store a payload read under `version` (skipped if anything was
+            invalidated since).
+        """
+
+        if len(payload) > MAX_PAYLOAD:
+            return False
+
+        with self.locked():
+            if tuple(version) != self.version():
+                return False
+            generation = version[0]
+
+            offsets = list(self._offsets(message_id))
+            target = offsets[0]
+            for offset in offsets:
+                seq, key, _, slot_generation, _ = SLOT.unpack_from(self.map, offset)
+                if key == message_id or key == 0 or slot_generation != generation:
+                    target = offset
+                    break
+
+            seq = SLOT.unpack_from(self.map, target)[0]
+            struct.pack_into("<I", self.map, target, seq + 1)
+            SLOT.pack_into(self.map, target, seq + 1, message_id, user_id,
+                           generation, len(payload))
+            start = target + SLOT.size
+            self.map[start:start + len(payload)] = payload
+            struct.pack_into("<I", self.map, target, seq + 2)
+
+        return True
+
+    def bump_generation(self):
+        with self.locked():
+            magic, slots, generation, logged = HEADER.unpack_from(self.map, 0)
+            HEADER.pack_into(self.map, 0, magic, slots, generation + 1, logged)
+            return generation + 1
+
+    def _clear(self, offset):
+        seq = SLOT.unpack_from(self.map, offset)[0]
+        struct.pack_into("<I", self.map, offset, seq + 1)
+        SLOT.pack_into(self.map, offset, seq + 2, 0, 0, 0, 0)
+
+    def forget(self, key):
+        """ Clear the slots of a message id (key > 0) or of a user's messages
+            (key = -user id), and log the key for the other processes.
+        """
+
+        with self.locked():
+            if key > 0:
+                offsets = self._offsets(key)
+            else:
+                offsets = range(SLOTS_START, SLOTS_START + self.slots * SLOT_SIZE,
+                                SLOT_SIZE)
+            for offset in offsets:
+                _, message_id, user_id, _, _ = SLOT.unpack_from(self.map, offset)
+                if message_id and (message_id == key or -user_id == key):
+                    self._clear(offset)
+
+            magic, slots, generation, logged = HEADER.unpack_from(self.map, 0)
+            LOG_ENTRY.pack_into(self.map,
+                                HEADER_SIZE + (logged % LOG_SIZE) * LOG_ENTRY.size,
+                                key)
+            HEADER.pack_into(self.map, 0, magic, slots, generation, logged + 1)
+
+
+class _FileLock:
+    """flock() held for a with block."""
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def __enter__(self):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+class MessageCache:
+    """Per-process LRU in front of the shared table in front of the database."""
+
+    def __init__(self, size, shared=None):
+        self.size = size
+        self.shared = shared
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation, self.logged = shared.version() if shared else (0, 0)
+        self.counts = {"local_hits": 0, "shared_hits": 0, "misses": 0,
+                       "invalidations": 0, "forgotten": 0}
+
+    def get(self, message_id):
+        """The CachedMessage for message_id, or None if it doesn't exist (or
+        its author deleted their account).
+        """
+
+        self._check_shared()
+
+        with self.lock:
+            cached = self.entries.get(message_id)
+            if cached is not None:
+                self.entries.move_to_end(message_id)
+                self.counts["local_hits"] += 1
+                return cached
+
+        if self.shared is not None:
+            payload = self.shared.get(message_id)
+            if payload is not None:
+                cached = decode(message_id, payload)
+                self._remember(cached)
+                self.counts["shared_hits"] += 1
+                return cached
+
+        self.counts["misses"] += 1
+
+        # read the version before the database, so a delete that lands while
+        #  we read makes the store below a no-op (and the entry remembered
+        #  here is dropped by the next get's _check_shared)
+        version = self.shared.version() if self.shared else None
+        cached = load_message(message_id)
+        if cached is None:
+            return None
+
+        if self.shared is not None:
+            self.shared.put(message_id, cached.user_id, encode(cached), version)
+        self._remember(cached)
+        return cached
+
+    def forget_message(self, message_id):
+        """Forget one message (deleted), in every process."""
+
+        self._forget(message_id)
+
+    def forget_user(self, user_id):
+        """ Forget a user's messages (account deleted, or the username or
+            image they carry changed), in every process.
+        """
+
+        self._forget(-user_id)
+
+    def _forget(self, key):
+        self.counts["forgotten"] += 1
+        if self.shared is not None:
+            self.shared.forget(key)
+        self._drop([key])
+
+    def invalidate(self):
+        """ Forget every cached message, in every process -- for bulk
+            changes; a single message or user has forget_message/forget_user.
+        """
+
+        self.counts["invalidations"] += 1
+        if self.shared is not None:
+            self.generation = self.shared.bump_generation()
+        else:
+            self.generation += 1
+
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        lookups = (self.counts["local_hits"] + self.counts["shared_hits"]
+                   + self.counts["misses"])
+        hits = lookups - self.counts["misses"]
+        stats = dict(self.counts)
+        stats.update({"entries": len(self.entries),
+                      "hit_ratio": round(hits / lookups, 3) if lookups else None,
+                      "shared": self.shared.path if self.shared else None,
+                      "generation": self.generation})
+        return stats
+
+    def _check_shared(self):
+        """Catch up with the invalidations other processes made."""
+
+        if self.shared is None:
+            return
+
+        generation, logged = self.shared.version()
+        if generation != self.generation:
+            with self.lock:
+                self.entries.clear()
+            self.generation, self.logged = generation, logged
+            return
+
+        if logged != self.logged:
+            keys = self.shared.log_since(self.logged)
+            if keys is None:
+                # too far behind to know what changed
+                with self.lock:
+                    self.entries.clear()
+            else:
+                self._drop(keys)
+            self.logged = logged
+
+    def _drop(self, keys):
+        """Drop message ids (> 0) and users' messages (-user id) from the LRU."""
+
+        message_ids = {key for key in keys if key > 0}
+        user_ids = {-key for key in keys if key < 0}
+
+        with self.lock:
+            for message_id in message_ids:
+                self.entries.pop(message_id, None)
+            if user_ids:
+                for message_id in [cached.id for cached in self.entries.values()
+                                   if cached.user_id in user_ids]:
+                    del self.entries[message_id]
+
+    def _remember(self, cached):
+        with self.lock:
+            self.entries[cached.id] = cached
+            self.entries.move_to_end(cached.id)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+def encode(cached):
+    return json.dumps([cached.text, cached.timestamp.isoformat(), cached.user_id,
+                       cached.username, cached.image_url]).encode()
+
+
+def decode(message_id, payload):
+    text, timestamp, user_id, username, image_url = json.loads(payload)
+    return CachedMessage(message_id, text, datetime.fromisoformat(timestamp),
+                         user_id, username, image_url)
+
+
+def load_message(message_id):
+    """The message and its author's name and image from the database."""
+
+    from models import db, User, Message
+
+    row = (db.session.query(Message.id, Message.text, Message.timestamp,
+                            Message.user_id, User.username, User.image_url)
+           .join(User, Message.user_id == User.id)
+           .filter(Message.id == message_id, User.deleted_at.is_(None))
+           .first())
+
+    return CachedMessage(*row) if row else None
+
+
+def message_cache():
+    """The current app's message cache."""
+
+    return current_app.extensions["message_cache"]
+
+
+def init_message_cache(app):
+    """Create the app's cache, sharing the table of the app's database."""
+
+    app.config.setdefault("MESSAGE_CACHE_SIZE", 10000)
+    app.config.setdefault("MESSAGE_CACHE_SLOTS", 16384)
+    app.config.setdefault("MESSAGE_CACHE_PATH", None)
+
+    path = app.config["MESSAGE_CACHE_PATH"]
+    if path is None:
+        # one table per database, so two apps on a host don't mix messages;
+        #  in the instance folder, like the sessions, where no other user
+        #  can make or write it
+        uri = app.config["SQLALCHEMY_DATABASE_URI"].encode()
+        os.makedirs(app.instance_path, mode=0o700, exist_ok=True)
+        path = os.path.join(app.instance_path, "messages-"
+                            f"{hashlib.blake2b(uri, digest_size=6).hexdigest()}.cache")
+
+    shared = None
+    if path != "off" and fcntl is not None:
+        shared = SharedTable(path, app.config["MESSAGE_CACHE_SLOTS"])
+
+    cache = MessageCache(app.config["MESSAGE_CACHE_SIZE"], shared)
+    app.extensions["message_cache"] = cache
+    return cache
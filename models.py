@@ -1,13 +1,211 @@
 """SQLAlchemy models for Warbler."""
 
+import threading
+import time
 from datetime import datetime
 
+from flask import g, has_app_context
 from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import NullPool, QueuePool
+
+from followcache import follow_cache
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+
+
+##############################################################################
+# Engine / connection pool
+
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool that keeps saturation numbers for pool_status().
+
+    _do_get is where a checkout blocks when every connection is in use, so the
+    time spent in it is the time a request waited on the pool.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._metrics_lock = threading.Lock()
+        self.checkouts = 0
+        self.peak_checked_out = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.timeouts = 0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except Exception:
+            with self._metrics_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self._metrics_lock:
+                self.checkouts += 1
+                self.wait_seconds_total += waited
+                self.wait_seconds_max = max(self.wait_seconds_max, waited)
+                self.peak_checked_out = max(self.peak_checked_out,
+                                            self.checkedout())
+
+    def recreate(self):
+        # keep the counters when the pool is rebuilt after a failover
+        pool = super().recreate()
+        pool.checkouts = self.checkouts
+        pool.peak_checked_out = self.peak_checked_out
+        pool.wait_seconds_total = self.wait_seconds_total
+        pool.wait_seconds_max = self.wait_seconds_max
+        pool.timeouts = self.timeouts
+        return pool
+
+
+def engine_options(config, sa_url):
+    """ Build the create_engine() keyword arguments from the DB_* settings in
+        the app config (app.py fills those from the environment).
+
+        - DB_POOL_SIZE / DB_MAX_OVERFLOW / DB_POOL_TIMEOUT / DB_POOL_RECYCLE size
+          the pool and recycle connections before the server or a load
+          balancer drops them.
+        - DB_POOL_PRE_PING tests a connection on checkout so the first request
+          after a failover gets a fresh connection instead of an error.
+        - DB_STATEMENT_TIMEOUT_MS caps statement run time. It is sent as a
+          connection option, so every connection of the engine (primary or
+          replica, request or profile-loader thread) has it from the start,
+          except in pgbouncer mode where it has to be set per transaction --
+          see set_statement_timeout().
+        - DB_PGBOUNCER turns off app-side pooling (pgbouncer does the pooling)
+          and leaves out startup parameters pgbouncer would reject.
+
+        SQLite keeps Flask-SQLAlchemy's own pool choices.
+    """
+
+    if sa_url.drivername.startswith("sqlite"):
+        return {}
+
+    options = {"pool_pre_ping": config.get("DB_POOL_PRE_PING", True)}
+
+    if config.get("DB_PGBOUNCER"):
+        options["poolclass"] = NullPool
+        return options
+
+    options.update({
+        "poolclass": MeteredQueuePool,
+        "pool_size": config.get("DB_POOL_SIZE", 5),
+        "max_overflow": config.get("DB_MAX_OVERFLOW", 10),
+        "pool_timeout": config.get("DB_POOL_TIMEOUT", 30),
+        "pool_recycle": config.get("DB_POOL_RECYCLE", 1800),
+    })
+
+    timeout_ms = config.get("DB_STATEMENT_TIMEOUT_MS")
+    if timeout_ms and sa_url.drivername.startswith("postgres"):
+        options["connect_args"] = {
+            "options": f"-c statement_timeout={int(timeout_ms)}"}
+
+    return options
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends the reads of replica-routed requests to a replica.
+
+    replicas.py decides per request whether reads may go to a replica (it
+    sets g.db_read_replica) and which replica serves the request. Anything
+    flushed -- every write -- always goes to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if (not self._flushing and has_app_context()
+                and g.get("db_read_replica")):
+            replicas = self.app.extensions.get("replicas")
+            engine = replicas.engine_for_request() if replicas else None
+            if engine is not None:
+                return engine
+
+        return super().get_bind(mapper, clause)
+
+
+class WarblerSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with the pool built from engine_options() and reads
+    routed by RoutingSession.
+    """
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        rv = super().apply_driver_hacks(app, sa_url, options)
+        options.update(engine_options(app.config, sa_url))
+        return rv
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = WarblerSQLAlchemy()
+
+
+def pool_status(engine=None):
+    """ Saturation numbers for the pool behind engine (the app's engine by
+        default): checked-out connections, overflow in use and the time
+        requests spent waiting for a connection.
+    """
+
+    pool = (engine or db.engine).pool
+    status = {"pool": type(pool).__name__}
+
+    if isinstance(pool, QueuePool):
+        status.update({
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "overflow": pool.overflow(),
+        })
+
+    if isinstance(pool, MeteredQueuePool):
+        with pool._metrics_lock:
+            status.update({
+                "checkouts": pool.checkouts,
+                "peak_checked_out": pool.peak_checked_out,
+                "timeouts": pool.timeouts,
+                "wait_ms_total": round(pool.wait_seconds_total * 1000, 3),
+                "wait_ms_max": round(pool.wait_seconds_max * 1000, 3),
+                "wait_ms_avg": round(pool.wait_seconds_total * 1000 /
+                                     pool.checkouts, 3) if pool.checkouts else 0.0,
+            })
+
+    return status
+
+
+# databases that know SET LOCAL statement_timeout
+STATEMENT_TIMEOUT_DIALECTS = ("postgresql",)
+
+
+def set_statement_timeout(connection, timeout_ms):
+    """ Cap the run time of every statement in the connection's current
+        transaction. SET LOCAL ends with the transaction, so it is safe behind
+        pgbouncer. Does nothing on databases other than Postgres.
+    """
+
+    if timeout_ms and connection.dialect.name in STATEMENT_TIMEOUT_DIALECTS:
+        connection.execute(f"SET LOCAL statement_timeout = {int(timeout_ms)}")
+
+
+@event.listens_for(RoutingSession, "after_begin")
+def limit_statement_time(session, transaction, connection):
+    """ Behind pgbouncer the statement timeout can't be a connection setting,
+        so it is set again at the start of every transaction of the session --
+        after each commit, and on whichever bind (primary or replica) the
+        transaction is on.
+    """
+
+    config = session.app.config
+    if config.get("DB_PGBOUNCER"):
+        set_statement_timeout(connection, config.get("DB_STATEMENT_TIMEOUT_MS"))
+
+
+##############################################################################
+# Models
 
 
 class Follows(db.Model):
@@ -43,10 +241,43 @@ class Likes(db.Model):
         db.ForeignKey('users.id', ondelete='cascade')
     )
 
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade')
+    )
+
+    # many users can like a message, each of them once
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id'),
+    )
+
+
+class LikeCount(db.Model):
+    """One shard of a message's like count -- see likecounts.py.
+
+    A message's count is the sum of its shards. Likes bump the shard picked by
+    the user id, so many users liking one message at the same time update
+    different rows instead of queueing on one.
+    """
+
+    __tablename__ = 'like_counts'
+
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True,
+    )
+
+    shard = db.Column(
+        db.SmallInteger,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
     )
 
 
@@ -95,6 +326,12 @@ class User(db.Model):
         nullable=False,
     )
 
+    # set when the user deletes their account. The rows that belong to the user
+    #  are purged later, in batches, by purge.py -- see UserPurge.
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -119,18 +356,34 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    @property
+    def is_deleted(self):
+        """Has this user deleted their account (purge may still be pending)?"""
+
+        return self.deleted_at is not None
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
+        cache = follow_cache()
+        if cache is not None:
+            return cache.is_following(other_user.id, self.id)
+
+        # by id: other_user may be g.user, a SessionUser rather than a row
         found_user_list = [
-            user for user in self.followers if user == other_user]
+            user for user in self.followers if user.id == other_user.id]
         return len(found_user_list) == 1
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
+        # a binary search in the cached followees instead of loading them all
+        cache = follow_cache()
+        if cache is not None:
+            return cache.is_following(self.id, other_user.id)
+
         found_user_list = [
-            user for user in self.following if user == other_user]
+            user for user in self.following if user.id == other_user.id]
         return len(found_user_list) == 1
 
     @classmethod
@@ -163,7 +416,7 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username, deleted_at=None).first()
 
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
@@ -191,7 +444,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -203,6 +456,172 @@ class Message(db.Model):
     user = db.relationship('User')
 
 
+class UserPurge(db.Model):
+    """Progress of the chunked purge of a deleted user's rows.
+
+    One row per deleted user. `stage` moves through PURGE_STAGES as each kind
+    of row is removed; the counters are updated with every committed batch so
+    the purge can be watched while it runs and resumed where it stopped.
+
+    user_id is intentionally not a foreign key -- the users row is the last
+    thing the purge removes and the progress row outlives it.
+    """
+
+    __tablename__ = 'user_purges'
+
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    stage = db.Column(
+        db.Text,
+        nullable=False,
+        default="likes",
+    )
+
+    likes_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    messages_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    follows_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    requested_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    # set when a batch kept failing and the purge gave up; the next
+    #  `purge.py --user-id` clears it and tries again.
+    failed_at = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    def __repr__(self):
+        return (f"<UserPurge #{self.user_id}: {self.stage}, "
+                f"likes={self.likes_deleted}, messages={self.messages_deleted}, "
+                f"follows={self.follows_deleted}>")
+
+
+class TrendingSnapshot(db.Model):
+    """The last saved state of one worker's trending tracker -- see
+    trending.py.
+
+    `worker` is the host and pid that wrote it. `counts` is the Count-Min
+    Sketch as packed doubles, `top` the tracked keys with their scores; both
+    are relative to `epoch` (unix time).
+    """
+
+    __tablename__ = 'trending_snapshots'
+
+    kind = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    worker = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    taken_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    epoch = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    width = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    depth = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    counts = db.Column(
+        db.LargeBinary,
+        nullable=False,
+    )
+
+    top = db.Column(
+        db.JSON,
+        nullable=False,
+    )
+
+
+class FollowSuggestion(db.Model):
+    """A precomputed "who to follow" suggestion -- see followgraph.py.
+
+    `score` is how many of the users user_id follows follow suggested_id;
+    `mutual_ids` are a few of them, for "followed by ..." under the
+    suggestion. Rows are rewritten by the offline job, so a suggestion can
+    be someone user_id followed since; suggestions.py filters those out.
+    """
+
+    __tablename__ = 'follow_suggestions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    suggested_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    rank = db.Column(
+        db.SmallInteger,
+        nullable=False,
+    )
+
+    score = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    mutual_ids = db.Column(
+        db.JSON,
+        nullable=False,
+        default=list,
+    )
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -303,3 +722,16 @@ def db_change_user(user_obj, user_update_in, user_archive):
 
         
     return result
+
+
+def db_soft_delete_user(user_obj):
+    """ Mark user_obj as deleted and queue the purge of the rows that belong to
+        the user. Nothing else is removed here -- the user disappears from the
+        site immediately and purge.py removes messages, likes and follows later
+        in small batches. The caller commits.
+    """
+
+    user_obj.deleted_at = datetime.utcnow()
+
+    if UserPurge.query.get(user_obj.id) is None:
+        db.session.add(UserPurge(user_id=user_obj.id))
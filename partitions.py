@@ -0,0 +1,500 @@
+"""Monthly partitions of the messages table, and their archive.
+
+On Postgres `messages` can be range-partitioned by month of `timestamp`
+(one table per month, messages_y2024m01 and so on). Feed queries that
+bound the timestamp only touch the partitions of the months they ask for,
+the per-partition indexes stay small, and an old month leaves the database
+by dropping its table instead of deleting its rows.
+
+    python partitions.py --migrate
+        turn an existing, plain messages table into a partitioned one. It
+        copies every message, so run it in a maintenance window.
+    python partitions.py --maintain
+        create the partitions of this month and the next
+        PARTITION_MONTHS_AHEAD (inserts into a month without a partition
+        fail). The web servers also do it when they start serving and every
+        PARTITION_MAINTAIN_SECONDS after (daily; 0 leaves it to cron).
+    python partitions.py --archive-before 2023-01 --archive-dir archive/
+        detach each month before 2023-01, write it to
+        archive/messages_y2022m12.parquet (zstd; --format arrow writes Arrow
+        IPC files instead) and drop it. A month whose export failed stays
+        detached and is picked up again by the next run.
+    python partitions.py --query --archive-dir archive/ --user-id 42
+        read archived messages back (--since / --until YYYY-MM, --text).
+
+A partitioned table's unique keys have to include the partition column, so
+the primary key becomes (id, timestamp) and likes / like_counts can no
+longer have a foreign key to messages.id; a trigger on messages deletes
+their rows instead. Archiving drops a month's likes too (the archive keeps
+each message's like count).
+
+The archive needs pyarrow, which is only imported when archiving or
+querying. Everything but recent_first() is Postgres only.
+"""
+
+import argparse
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import text
+
+from models import db, Message
+
+MONTHS_AHEAD = 3
+
+# pg_advisory_xact_lock key: one process creates partitions at a time
+MAINTAIN_LOCK = 0x7761726d
+
+# rows per record batch (and per fetch from the server-side cursor)
+ARCHIVE_BATCH = 10000
+
+PARTITION = "messages_y{:04d}m{:02d}"
+PARTITION_NAME = re.compile(r"^messages_y(\d{4})m(\d{2})$")
+
+FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+
+ARCHIVE_COLUMNS = ("id", "text", "timestamp", "user_id", "likes")
+
+MIGRATION = """
+LOCK TABLE messages IN ACCESS EXCLUSIVE MODE;
+
+ALTER TABLE messages RENAME TO messages_unpartitioned;
+ALTER INDEX messages_pkey RENAME TO messages_unpartitioned_pkey;
+ALTER SEQUENCE messages_id_seq OWNED BY NONE;
+
+ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_fkey;
+ALTER TABLE IF EXISTS like_counts
+    DROP CONSTRAINT IF EXISTS like_counts_message_id_fkey;
+
+CREATE TABLE messages (
+    id INTEGER NOT NULL DEFAULT nextval('messages_id_seq'),
+    text VARCHAR(140) NOT NULL,
+    timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    PRIMARY KEY (id, timestamp)
+) PARTITION BY RANGE (timestamp);
+
+ALTER SEQUENCE messages_id_seq OWNED BY messages.id;
+
+CREATE OR REPLACE FUNCTION messages_delete_likes() RETURNS trigger AS $$
+BEGIN
+    DELETE FROM likes WHERE message_id = OLD.id;
+    -- like_counts (likecounts.py) may be created after the migration
+    IF to_regclass('like_counts') IS NOT NULL THEN
+        EXECUTE 'DELETE FROM like_counts WHERE message_id = $1' USING OLD.id;
+    END IF;
+    RETURN OLD;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER messages_delete_likes AFTER DELETE ON messages
+    FOR EACH ROW EXECUTE PROCEDURE messages_delete_likes();
+"""
+
+# after the copy; created on every partition, present and future
+MIGRATION_INDEXES = """
+DROP TABLE messages_unpartitioned;
+
+CREATE INDEX messages_user_id_timestamp ON messages (user_id, timestamp DESC);
+CREATE INDEX messages_timestamp ON messages (timestamp DESC);
+CREATE INDEX IF NOT EXISTS messages_text_search
+    ON messages USING GIN (to_tsvector('english', text));
+"""
+
+
+##############################################################################
+# Months
+
+
+def month_of(when):
+    return datetime(when.year, when.month, 1)
+
+
+def add_months(month, count):
+    year, month0 = divmod(month.year * 12 + month.month - 1 + count, 12)
+    return datetime(year, month0 + 1, 1)
+
+
+def parse_month(value):
+    """YYYY-MM -> the first of that month."""
+
+    return datetime.strptime(value, "%Y-%m")
+
+
+def partition_name(month):
+    return PARTITION.format(month.year, month.month)
+
+
+def partition_month(name):
+    """The month of a partition's name, or None for other tables."""
+
+    match = PARTITION_NAME.match(name)
+    return datetime(int(match.group(1)), int(match.group(2)), 1) \
+        if match else None
+
+
+def partition_ddl(month):
+    return (f"CREATE TABLE IF NOT EXISTS {partition_name(month)} "
+            f"PARTITION OF messages FOR VALUES FROM ('{month:%Y-%m-%d}') "
+            f"TO ('{add_months(month, 1):%Y-%m-%d}')")
+
+
+##############################################################################
+# Feed queries
+
+
+def recent_first(query, limit):
+    """ The first `limit` messages of query, newest first.
+
+        Looks at the last FEED_WINDOW_DAYS first, which on a partitioned
+        table only scans this month's partition and maybe last month's; only
+        a feed with fewer than `limit` messages in the window goes on to the
+        older ones. FEED_WINDOW_DAYS=0 always reads the whole table.
+    """
+
+    query = query.order_by(Message.timestamp.desc(), Message.id.desc())
+
+    days = current_app.config["FEED_WINDOW_DAYS"]
+    if not days:
+        return query.limit(limit).all()
+
+    since = datetime.utcnow() - timedelta(days=days)
+    messages = query.filter(Message.timestamp >= since).limit(limit).all()
+    if len(messages) < limit:
+        messages += (query.filter(Message.timestamp < since)
+                     .limit(limit - len(messages))
+                     .all())
+    return messages
+
+
+def init_partitions(app):
+    app.config.setdefault("FEED_WINDOW_DAYS", 30)
+    app.config.setdefault("PARTITION_MONTHS_AHEAD", MONTHS_AHEAD)
+    app.config.setdefault("PARTITION_MAINTAIN_SECONDS", 24 * 3600)
+
+    interval = app.config["PARTITION_MAINTAIN_SECONDS"]
+    if interval:
+        # only in a process that serves, not in every CLI
+        @app.before_first_request
+        def start_partition_maintenance():
+            threading.Thread(target=run_maintenance, args=(app, interval),
+                             daemon=True, name="partition-maintenance").start()
+
+
+##############################################################################
+# Partition maintenance (Postgres)
+
+
+def is_partitioned():
+    return db.session.execute(text(
+        "SELECT 1 FROM pg_partitioned_table "
+        "WHERE partrelid = 'messages'::regclass")).first() is not None
+
+
+def partitions():
+    """{month: name} of the partitions attached to messages."""
+
+    rows = db.session.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'messages'::regclass"))
+    return {partition_month(row[0]): row[0] for row in rows
+            if partition_month(row[0])}
+
+
+def detached_partitions():
+    """{month: name} of detached partitions whose archive didn't finish."""
+
+    rows = db.session.execute(text(
+        "SELECT c.relname FROM pg_class c "
+        "JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE c.relkind = 'r' AND n.nspname = current_schema() "
+        "AND NOT c.relispartition AND c.relname LIKE 'messages_y%'"))
+    return {partition_month(row[0]): row[0] for row in rows
+            if partition_month(row[0])}
+
+
+def ensure_partitions(months_ahead=MONTHS_AHEAD, now=None):
+    """ Create the partitions of this month and the months_ahead after it.
+        Returns the names of the ones created.
+    """
+
+    # workers starting together would race to create the same tables
+    db.session.execute(text("SELECT pg_advisory_xact_lock(:key)"),
+                       {"key": MAINTAIN_LOCK})
+
+    this_month = month_of(now or datetime.utcnow())
+    existing = partitions()
+
+    created = []
+    for i in range(months_ahead + 1):
+        month = add_months(this_month, i)
+        if month not in existing:
+            db.session.execute(text(partition_ddl(month)))
+            created.append(partition_name(month))
+    db.session.commit()
+    return created
+
+
+def run_maintenance(app, interval):
+    """ ensure_partitions() now and every interval seconds, as long as
+        messages is a partitioned table on Postgres.
+    """
+
+    while True:
+        with app.app_context():
+            try:
+                if db.engine.dialect.name != "postgresql" or \
+                        not is_partitioned():
+                    return
+                created = ensure_partitions(app.config["PARTITION_MONTHS_AHEAD"])
+                if created:
+                    app.logger.info("created partitions %s", ", ".join(created))
+            except Exception:
+                app.logger.exception("partition maintenance failed")
+                try:
+                    db.session.rollback()
+                except Exception:
+                    pass
+            finally:
+                try:
+                    db.session.remove()
+                except Exception:
+                    pass
+
+        time.sleep(interval)
+
+
+def migrate(months_ahead=MONTHS_AHEAD, report=print):
+    """Partition an existing messages table, copying every message over."""
+
+    if is_partitioned():
+        report("messages is already partitioned")
+        return
+
+    first = db.session.execute(text(
+        "SELECT min(timestamp) FROM messages")).scalar()
+    this_month = month_of(datetime.utcnow())
+    month = month_of(first) if first else this_month
+
+    db.session.execute(text(MIGRATION))
+    while month <= add_months(this_month, months_ahead):
+        db.session.execute(text(partition_ddl(month)))
+        month = add_months(month, 1)
+
+    copied = db.session.execute(text(
+        "INSERT INTO messages (id, text, timestamp, user_id) "
+        "SELECT id, text, timestamp, user_id FROM messages_unpartitioned"))
+    db.session.execute(text(MIGRATION_INDEXES))
+    db.session.commit()
+
+    report(f"messages partitioned by month: {copied.rowcount} messages, "
+           f"{len(partitions())} partitions")
+
+
+##############################################################################
+# Archive
+
+
+def archive_path(directory, name, fmt):
+    return os.path.join(directory, name + FORMATS[fmt])
+
+
+def write_archive(batches, path, fmt="parquet"):
+    """ Write batches of (id, text, timestamp, user_id, likes) rows to a
+        zstd-compressed Parquet or Arrow IPC file. The file appears under
+        `path` only once it is complete. Returns the number of rows.
+    """
+
+    import pyarrow as pa
+
+    schema = pa.schema([("id", pa.int32()), ("text", pa.string()),
+                        ("timestamp", pa.timestamp("us")),
+                        ("user_id", pa.int32()), ("likes", pa.int32())])
+
+    partial = path + ".partial"
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(partial, schema, compression="zstd")
+        write = writer.write_table
+    else:
+        writer = pa.ipc.new_file(
+            partial, schema,
+            options=pa.ipc.IpcWriteOptions(compression="zstd"))
+        write = writer.write_table
+
+    rows = 0
+    try:
+        for batch in batches:
+            columns = list(zip(*batch)) if batch else [[]] * len(schema)
+            write(pa.Table.from_arrays(
+                [pa.array(column, type=field.type)
+                 for column, field in zip(columns, schema)], schema=schema))
+            rows += len(batch)
+    except BaseException:
+        writer.close()
+        os.remove(partial)
+        raise
+
+    writer.close()
+    os.replace(partial, path)
+    return rows
+
+
+def partition_rows(name, batch_size=ARCHIVE_BATCH):
+    """The rows of partition `name`, in batches, from a server-side cursor."""
+
+    with db.engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(text(
+            f"SELECT m.id, m.text, m.timestamp, m.user_id, "
+            f"  coalesce((SELECT sum(lc.count) FROM like_counts lc "
+            f"            WHERE lc.message_id = m.id), 0) "
+            f"FROM {name} m ORDER BY m.timestamp, m.id"))
+        while True:
+            batch = result.fetchmany(batch_size)
+            if not batch:
+                break
+            yield [tuple(row) for row in batch]
+
+
+def archive(before, directory, fmt="parquet", report=print):
+    """ Move every month before `before` (the first of a month) out of the
+        database into `directory`. Returns the paths written.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+
+    # detach first, so the month's messages stop showing at once and a
+    #  failed export leaves it to the next run
+    for month, name in sorted(partitions().items()):
+        if month < before:
+            db.session.execute(text(
+                f"ALTER TABLE messages DETACH PARTITION {name}"))
+            db.session.commit()
+
+    written = []
+    for month, name in sorted(detached_partitions().items()):
+        path = archive_path(directory, name, fmt)
+        rows = write_archive(partition_rows(name), path, fmt)
+
+        db.session.execute(text(
+            f"DELETE FROM likes USING {name} m WHERE likes.message_id = m.id"))
+        db.session.execute(text(
+            f"DELETE FROM like_counts USING {name} m "
+            f"WHERE like_counts.message_id = m.id"))
+        db.session.execute(text(f"DROP TABLE {name}"))
+        db.session.commit()
+
+        written.append(path)
+        report(f"{name}: {rows} messages -> {path}")
+
+    if written:
+        from messagecache import message_cache
+        message_cache().invalidate()
+
+    return written
+
+
+def query_archive(directory, user_id=None, since=None, until=None,
+                  contains=None, limit=100):
+    """ Archived messages, newest first, as dicts. since / until are months
+        (datetimes); only the files of the months in between are read.
+    """
+
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+
+    paths = []
+    for filename in sorted(os.listdir(directory)):
+        name, extension = os.path.splitext(filename)
+        month = partition_month(name)
+        if month is None or extension not in FORMATS.values():
+            continue
+        if (since and add_months(month, 1) <= since) \
+                or (until and month >= until):
+            continue
+        paths.append((os.path.join(directory, filename), extension))
+
+    conditions = []
+    if user_id is not None:
+        conditions.append(pc.field("user_id") == user_id)
+    if since:
+        conditions.append(pc.field("timestamp") >= since)
+    if until:
+        conditions.append(pc.field("timestamp") < until)
+    condition = None
+    for part in conditions:
+        condition = part if condition is None else condition & part
+
+    rows = []
+    for fmt in FORMATS:
+        files = [path for path, extension in paths
+                 if extension == FORMATS[fmt]]
+        if not files:
+            continue
+        dataset = ds.dataset(files, format="ipc" if fmt == "arrow" else fmt)
+        rows += dataset.to_table(filter=condition).to_pylist()
+
+    if contains:
+        rows = [row for row in rows if contains.lower() in row["text"].lower()]
+
+    rows.sort(key=lambda row: (row["timestamp"], row["id"]), reverse=True)
+    return rows[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Monthly partitions of the messages table.")
+    parser.add_argument("--migrate", action="store_true",
+                        help="partition an existing messages table")
+    parser.add_argument("--maintain", action="store_true",
+                        help="create this month's and the coming months' "
+                             "partitions")
+    parser.add_argument("--archive-before", type=parse_month, metavar="YYYY-MM",
+                        help="archive and drop the months before this one")
+    parser.add_argument("--archive-dir", default="archive")
+    parser.add_argument("--format", choices=sorted(FORMATS), default="parquet")
+    parser.add_argument("--query", action="store_true",
+                        help="print archived messages")
+    parser.add_argument("--user-id", type=int)
+    parser.add_argument("--since", type=parse_month, metavar="YYYY-MM")
+    parser.add_argument("--until", type=parse_month, metavar="YYYY-MM")
+    parser.add_argument("--text", help="only messages containing this")
+    parser.add_argument("--limit", type=int, default=100)
+    args = parser.parse_args()
+
+    if args.query:
+        for row in query_archive(args.archive_dir, args.user_id, args.since,
+                                 args.until, args.text, args.limit):
+            print(f"{row['timestamp']:%Y-%m-%d %H:%M} #{row['id']} "
+                  f"user {row['user_id']} ({row['likes']} likes): "
+                  f"{row['text']}")
+        return
+
+    from app import create_app
+    app = create_app({"TEMPLATE_WARMUP": "off"})
+
+    with app.app_context():
+        if db.engine.dialect.name != "postgresql":
+            raise SystemExit("partitioning needs Postgres")
+
+        if args.migrate:
+            migrate(app.config["PARTITION_MONTHS_AHEAD"])
+
+        if args.maintain:
+            created = ensure_partitions(app.config["PARTITION_MONTHS_AHEAD"])
+            print(f"created {', '.join(created)}" if created
+                  else "every partition is there")
+
+        if args.archive_before:
+            if not is_partitioned():
+                raise SystemExit("messages isn't partitioned; run --migrate")
+            archive(args.archive_before, args.archive_dir, args.format)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""Profile page loader.
+
+The profile pages (a user's messages, their likes, following and followers)
+need the user, four counters, whether g.user follows them, g.user's likes,
+which of g.user's follows follow them and a list of messages or users. None
+of those queries depend on each other, so load_profile() runs them at the
+same time on a thread pool, each on its own pooled connection, and hands the
+template one read-only ProfileView. The page then waits for the slowest query
+instead of the sum of all of them, and the template has nothing left to lazy
+load.
+
+PROFILE_LOADER_WORKERS sets the pool size; 0 runs the queries one after
+another on the request's connection (handy for SQLite). The loader's
+connections come from the same connection pool as the requests' own, so it
+gets at most half of it (DB_POOL_SIZE + DB_MAX_OVERFLOW): the thread pool is
+shared by the process, so however many profiles are viewed at once the rest
+stays for the requests.
+"""
+
+import contextvars
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import abort, current_app
+from sqlalchemy import func, select
+
+from models import db, User, Message, Follows, Likes, set_statement_timeout
+
+ProfileView = namedtuple("ProfileView", [
+    "user",               # id, username, image_url, header_image_url, bio, location
+    "messages_count",
+    "following_count",
+    "followers_count",
+    "likes_count",
+    "is_following",       # g.user follows user
+    "liked_ids",          # message ids g.user liked
+    "viewer_following",   # user ids g.user follows
+    "messages",           # rows for users/show.html, or ()
+    "users",              # rows for the following/followers cards, or ()
+    "known_followers",    # a few users g.user follows who follow user, or ()
+])
+
+# "followed by ..." names shown on a profile
+KNOWN_FOLLOWERS_SHOWN = 3
+
+USER_COLUMNS = [User.id, User.username, User.image_url, User.header_image_url,
+                User.bio, User.location]
+
+MESSAGE_COLUMNS = [User.username, User.image_url, Message.id, Message.text,
+                   Message.timestamp, Message.user_id]
+
+
+##############################################################################
+# Queries
+#
+# Each one is a select() run on whatever connection the loader hands it.
+
+
+def user_query(user_id):
+    return (select(USER_COLUMNS)
+            .where(User.id == user_id)
+            .where(User.deleted_at.is_(None)))
+
+
+def counts_query(user_id):
+    """The four counters in one statement."""
+
+    def count(column, condition):
+        return select([func.count(column)]).where(condition).as_scalar()
+
+    return select([
+        count(Message.id, Message.user_id == user_id),
+        count(Follows.user_being_followed_id,
+              Follows.user_following_id == user_id),
+        count(Follows.user_following_id,
+              Follows.user_being_followed_id == user_id),
+        count(Likes.id, Likes.user_id == user_id),
+    ])
+
+
+def following_ids_query(user_id):
+    return (select([Follows.user_being_followed_id])
+            .where(Follows.user_following_id == user_id))
+
+
+def liked_ids_query(user_id):
+    return (select([Likes.message_id])
+            .where(Likes.user_id == user_id)
+            .order_by(Likes.message_id))
+
+
+def messages_query(user_id, kind):
+    """ "own": the messages user_id wrote; "liked": the ones they liked. """
+
+    query = select(MESSAGE_COLUMNS).select_from(
+        Message.__table__.join(User.__table__, Message.user_id == User.id))
+
+    if kind == "liked":
+        liked = select([Likes.message_id]).where(Likes.user_id == user_id)
+        # not the messages of authors who deleted their account
+        return (query.where(Message.id.in_(liked))
+                .where(User.deleted_at.is_(None)))
+
+    return query.where(Message.user_id == user_id)
+
+
+def users_query(user_id, kind):
+    """ "following": users user_id follows; "followers": users following them. """
+
+    if kind == "following":
+        on = Follows.user_being_followed_id == User.id
+        condition = Follows.user_following_id == user_id
+    else:
+        on = Follows.user_following_id == User.id
+        condition = Follows.user_being_followed_id == user_id
+
+    return (select(USER_COLUMNS)
+            .select_from(User.__table__.join(Follows.__table__, on))
+            .where(condition)
+            .where(User.deleted_at.is_(None))
+            .order_by(User.id))
+
+
+def known_followers_query(user_id, viewer_id):
+    """ Users viewer_id follows who follow user_id: the first few rows, each
+        with the total count.
+    """
+
+    viewer_following = following_ids_query(viewer_id)
+
+    return (select([User.id, User.username, func.count().over().label("total")])
+            .select_from(User.__table__.join(
+                Follows.__table__, Follows.user_following_id == User.id))
+            .where(Follows.user_being_followed_id == user_id)
+            .where(User.id.in_(viewer_following))
+            .where(User.deleted_at.is_(None))
+            .order_by(User.id)
+            .limit(KNOWN_FOLLOWERS_SHOWN))
+
+
+##############################################################################
+# Loader
+
+
+class ProfileLoader:
+    """Runs the profile queries concurrently on a thread pool."""
+
+    def __init__(self, workers, statement_timeout_ms=None):
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="profile") if workers else None
+        # pgbouncer mode: the timeout has to be set in each query's transaction
+        self.statement_timeout_ms = statement_timeout_ms
+
+    def run(self, engine, queries):
+        """Execute a dict of name -> select and return name -> rows."""
+
+        if self.executor is None:
+            return {name: db.session.execute(query).fetchall()
+                    for name, query in queries.items()}
+
+        def fetch(query):
+            with engine.connect() as conn:
+                if not self.statement_timeout_ms:
+                    return conn.execute(query).fetchall()
+                with conn.begin():
+                    set_statement_timeout(conn, self.statement_timeout_ms)
+                    return conn.execute(query).fetchall()
+
+        # each query runs in a copy of the request's context, so context
+        #  variables (e.g. bench.py's statement counter) follow it
+        futures = {name: self.executor.submit(
+                       contextvars.copy_context().run, fetch, query)
+                   for name, query in queries.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+    def load(self, user_id, viewer_id=None, messages=None, users=None):
+        """ProfileView for user_id as seen by viewer_id; 404 when the user is
+        missing or deleted. messages is "own" or "liked", users is "following"
+        or "followers" -- leave them out when the page doesn't list them.
+        """
+
+        queries = {"user": user_query(user_id),
+                   "counts": counts_query(user_id)}
+        if viewer_id is not None:
+            queries["viewer_following"] = following_ids_query(viewer_id)
+            queries["liked_ids"] = liked_ids_query(viewer_id)
+            if viewer_id != user_id:
+                queries["known_followers"] = known_followers_query(user_id,
+                                                                   viewer_id)
+        if messages:
+            queries["messages"] = messages_query(user_id, messages)
+        if users:
+            queries["users"] = users_query(user_id, users)
+
+        # the session picks the engine: primary or, for replica reads, a replica
+        rows = self.run(db.session.get_bind(), queries)
+
+        if not rows["user"]:
+            abort(404)
+
+        viewer_following = frozenset(row[0] for row in
+                                     rows.get("viewer_following", ()))
+        messages_count, following_count, followers_count, likes_count = \
+            rows["counts"][0]
+
+        return ProfileView(
+            user=rows["user"][0],
+            messages_count=messages_count,
+            following_count=following_count,
+            followers_count=followers_count,
+            likes_count=likes_count,
+            is_following=user_id in viewer_following,
+            liked_ids=[row[0] for row in rows.get("liked_ids", ())],
+            viewer_following=viewer_following,
+            messages=tuple(rows.get("messages", ())),
+            users=tuple(rows.get("users", ())),
+            known_followers=tuple(rows.get("known_followers", ())),
+        )
+
+
+def load_profile(user_id, viewer_id=None, messages=None, users=None):
+    """Load a ProfileView with the app's loader."""
+
+    return current_app.extensions["profiles"].load(
+        user_id, viewer_id, messages=messages, users=users)
+
+
+def loader_workers(config):
+    """ PROFILE_LOADER_WORKERS, capped at half the connection pool. Through
+        pgbouncer (no app-side pool) and on SQLite there is nothing to cap.
+    """
+
+    workers = config["PROFILE_LOADER_WORKERS"]
+    if config.get("DB_PGBOUNCER") or \
+            config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+        return workers
+
+    pool = config.get("DB_POOL_SIZE", 5) + config.get("DB_MAX_OVERFLOW", 10)
+    return min(workers, pool // 2)
+
+
+def init_profiles(app):
+    """Create the app's profile loader."""
+
+    app.config.setdefault("PROFILE_LOADER_WORKERS", 8)
+    timeout_ms = app.config.get("DB_STATEMENT_TIMEOUT_MS") \
+        if app.config.get("DB_PGBOUNCER") else None
+    loader = ProfileLoader(loader_workers(app.config), timeout_ms)
+    app.extensions["profiles"] = loader
+    return loader
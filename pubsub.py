@@ -0,0 +1,196 @@
+"""Publish/subscribe hub for new-message notifications.
+
+messages_add() publishes every new message; the server-sent events stream in
+api.py subscribes to the authors the viewer follows and pushes each
+notification down one long-lived connection, so clients don't have to keep
+reloading the whole feed.
+
+The hub delivers to subscribers in this process. Publishing goes through a
+backend so notifications can cross processes:
+
+- LocalBackend (default): delivers straight to this process's hub.
+- RedisBackend (PUBSUB_URL=redis://...): publishes to a Redis channel; every
+  process listens on it and delivers to its own subscribers. Needs the
+  `redis` package.
+
+Other kinds of events ride the same channel to callbacks registered with
+Hub.listen() -- followcache.py uses it to tell the other workers about
+follows, trending.py to count messages and likes.
+
+Each subscriber has a bounded queue. A subscriber that stops reading loses
+the oldest notifications rather than growing without limit -- the stream
+backfills from the database on reconnect anyway.
+"""
+
+import json
+import queue
+import threading
+from collections import defaultdict
+
+CHANNEL = "warbler:messages"
+SUBSCRIBER_QUEUE_SIZE = 100
+
+
+class Subscription:
+    """A subscriber's queue and the authors it listens to."""
+
+    def __init__(self, author_ids, maxsize=SUBSCRIBER_QUEUE_SIZE):
+        self.author_ids = set(author_ids)
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.dropped = 0
+
+    def put(self, event):
+        """Queue an event, dropping the oldest one when the queue is full."""
+
+        while True:
+            try:
+                self.queue.put_nowait(event)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout):
+        """Next event, or None after timeout seconds without one."""
+
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class Hub:
+    """Fan-out of published events to the subscriptions in this process."""
+
+    def __init__(self):
+        self.subscriptions = defaultdict(set)
+        self.listeners = defaultdict(list)
+        self.lock = threading.Lock()
+        self.backend = LocalBackend(self)
+        self.published = 0
+        self.delivered = 0
+
+    def subscribe(self, author_ids):
+        """Subscribe to the messages of author_ids."""
+
+        subscription = Subscription(author_ids)
+        with self.lock:
+            for author_id in subscription.author_ids:
+                self.subscriptions[author_id].add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for author_id in subscription.author_ids:
+                subscribers = self.subscriptions.get(author_id)
+                if subscribers:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self.subscriptions[author_id]
+
+    def listen(self, event_type, callback):
+        """ Call callback(event) for every event of event_type (e.g.
+            followcache.py's "follow" events, or trending.py's "message" and
+            "like"), in the thread that dispatches it.
+        """
+
+        self.listeners[event_type].append(callback)
+
+    def publish(self, event):
+        """ Publish an event through the backend: a "message" event (a dict
+            with at least user_id), or one of a type somebody listens to.
+        """
+
+        self.published += 1
+        self.backend.publish(event)
+
+    def dispatch(self, event):
+        """Deliver an event to the local subscribers of its author."""
+
+        event_type = event.get("type", "message")
+        for callback in self.listeners.get(event_type, ()):
+            callback(event)
+        if event_type != "message":
+            return
+
+        with self.lock:
+            subscribers = list(self.subscriptions.get(event["user_id"], ()))
+
+        for subscription in subscribers:
+            subscription.put(event)
+        self.delivered += len(subscribers)
+
+    def stats(self):
+        with self.lock:
+            subscriptions = {sub for subs in self.subscriptions.values()
+                             for sub in subs}
+        return {"backend": type(self.backend).__name__,
+                "subscribers": len(subscriptions),
+                "published": self.published,
+                "delivered": self.delivered}
+
+
+class LocalBackend:
+    """Single-process backend: publishing is delivering."""
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def publish(self, event):
+        self.hub.dispatch(event)
+
+
+class RedisBackend:
+    """Cross-process backend over a Redis pub/sub channel.
+
+    A daemon thread listens on CHANNEL and hands every event to the local hub,
+    including the events this process published.
+    """
+
+    def __init__(self, hub, url):
+        import redis
+
+        self.hub = hub
+        self.redis = redis.Redis.from_url(url)
+        self.listener = threading.Thread(target=self._listen, daemon=True,
+                                         name="pubsub-redis")
+        self.listener.start()
+
+    def publish(self, event):
+        self.redis.publish(CHANNEL, json.dumps(event))
+
+    def _listen(self):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(CHANNEL)
+        for message in pubsub.listen():
+            try:
+                self.hub.dispatch(json.loads(message["data"]))
+            except (ValueError, KeyError):
+                continue
+
+
+def init_pubsub(app):
+    """Create the app's hub, with the Redis backend when PUBSUB_URL is set."""
+
+    hub = Hub()
+    url = app.config.get("PUBSUB_URL")
+    if url:
+        hub.backend = RedisBackend(hub, url)
+
+    app.extensions["pubsub"] = hub
+    return hub
+
+
+def message_event(msg, username):
+    """The notification published for a new message."""
+
+    return {"type": "message",
+            "id": msg.id,
+            "user_id": msg.user_id,
+            "username": username,
+            "text": msg.text,
+            "timestamp": msg.timestamp.isoformat()}
@@ -0,0 +1,279 @@
+"""Chunked, throttled purge of deleted accounts.
+
+Deleting an account in the app only soft-deletes the user (see
+db_soft_delete_user in models.py) and queues a UserPurge row. This module
+removes the rows that belong to those users:
+
+- the user's likes
+- likes other users made on the user's messages
+- the user's messages
+- follows in both directions
+- finally the users row itself
+
+Every batch is its own short transaction (at most `batch_size` rows), so no
+lock on `messages` or `likes` is held for longer than one batch. On Postgres
+each batch also sets a lock_timeout; a batch that cannot get its locks quickly
+is rolled back and retried after a pause instead of queueing behind other
+writers. The pause doubles with every failure, up to MAX_RETRY_SECONDS; after
+MAX_ATTEMPTS failures in a row the error is recorded on the user_purges row
+(failed_at, last_error) and the purge moves on to the next user. Failed purges
+are left out of the pending ones until they are run again with --user-id.
+Between batches the purge sleeps long enough to stay under `rows_per_second`.
+
+Progress is committed to the user_purges table along with every batch, so an
+interrupted purge picks up where it stopped the next time this runs.
+
+Run it like:
+
+    python purge.py                       # every pending purge
+    python purge.py --user-id 42          # a single user
+    python purge.py --batch-size 200 --rows-per-second 1000
+"""
+
+import argparse
+import time
+from datetime import datetime
+
+from sqlalchemy.exc import OperationalError
+
+from models import db, User, Message, Likes, Follows, UserPurge
+from likecounts import bump as bump_like_counts
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_ROWS_PER_SECOND = 2000
+LOCK_TIMEOUT_MS = 2000
+LOCK_RETRY_SECONDS = 1.0
+MAX_RETRY_SECONDS = 30.0
+MAX_ATTEMPTS = 6
+
+# order matters: likes on the user's messages have to be gone before the
+#  messages so the FK cascade never fans out inside a message batch.
+PURGE_STAGES = ("likes", "message_likes", "messages",
+                "follows_out", "follows_in", "user", "done")
+
+
+class Throttle:
+    """Sleep between batches to stay under `rows_per_second`."""
+
+    def __init__(self, rows_per_second):
+        self.rows_per_second = rows_per_second
+        self.started = time.monotonic()
+        self.rows = 0
+
+    def wait(self, rows):
+        """Account for `rows` just removed and sleep if we are ahead of the rate."""
+
+        self.rows += rows
+        if not self.rows_per_second:
+            return
+
+        ahead = self.rows / self.rows_per_second - \
+            (time.monotonic() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def _set_lock_timeout():
+    """ Keep a batch from waiting on locks held by someone else. SET LOCAL only
+        lasts until the batch commits.
+    """
+
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute(f"SET LOCAL lock_timeout = {LOCK_TIMEOUT_MS}")
+
+
+def _delete_batch(stage, user_id, batch_size):
+    """ Delete up to batch_size rows for `stage`. Returns the number of rows
+        removed. The ids are selected first so each DELETE only touches the
+        rows of this batch.
+    """
+
+    if stage == "likes":
+        rows = (db.session.query(Likes.id, Likes.message_id)
+                .filter(Likes.user_id == user_id)
+                .limit(batch_size)
+                .all())
+        ids = [row.id for row in rows]
+        query = Likes.query.filter(Likes.id.in_(ids))
+
+        # every like the user made: the liked messages stay, so their like
+        #  counts come down. (Likes other users made on this user's messages
+        #  are the message_likes stage, and aren't counted down -- those
+        #  counters are deleted with the messages.)
+        bump_like_counts(db.session, [(user_id, row.message_id, -1)
+                                      for row in rows])
+
+    elif stage == "message_likes":
+        user_msgs = db.session.query(Message.id).filter(
+            Message.user_id == user_id)
+        ids = [row.id for row in (db.session.query(Likes.id)
+                                  .filter(Likes.message_id.in_(user_msgs))
+                                  .limit(batch_size))]
+        query = Likes.query.filter(Likes.id.in_(ids))
+
+    elif stage == "messages":
+        ids = [row.id for row in (db.session.query(Message.id)
+                                  .filter(Message.user_id == user_id)
+                                  .limit(batch_size))]
+        query = Message.query.filter(Message.id.in_(ids))
+
+    elif stage == "follows_out":
+        ids = [row.user_being_followed_id for row in (
+            db.session.query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user_id)
+            .limit(batch_size))]
+        query = Follows.query.filter(Follows.user_following_id == user_id,
+                                     Follows.user_being_followed_id.in_(ids))
+
+    elif stage == "follows_in":
+        ids = [row.user_following_id for row in (
+            db.session.query(Follows.user_following_id)
+            .filter(Follows.user_being_followed_id == user_id)
+            .limit(batch_size))]
+        query = Follows.query.filter(Follows.user_being_followed_id == user_id,
+                                     Follows.user_following_id.in_(ids))
+
+    else:
+        raise ValueError(f"no batch delete for stage '{stage}'")
+
+    if not ids:
+        return 0
+
+    return query.delete(synchronize_session=False)
+
+
+def _record(purge, stage, count):
+    """Add count to the counter that belongs to stage."""
+
+    if stage in ("likes", "message_likes"):
+        purge.likes_deleted += count
+    elif stage == "messages":
+        purge.messages_deleted += count
+    else:
+        purge.follows_deleted += count
+
+
+def _give_up(user_id, err):
+    """Record on the purge row that its batches keep failing."""
+
+    db.session.rollback()
+    purge = UserPurge.query.get(user_id)
+    purge.failed_at = datetime.utcnow()
+    purge.last_error = str(err)[:2000]
+    try:
+        db.session.commit()
+    except OperationalError:
+        # the database is gone altogether; nothing to record it in
+        db.session.rollback()
+    return purge
+
+
+def purge_user(user_id, batch_size=DEFAULT_BATCH_SIZE,
+               rows_per_second=DEFAULT_ROWS_PER_SECOND, report=print,
+               max_attempts=MAX_ATTEMPTS, retry_seconds=LOCK_RETRY_SECONDS):
+    """ Run (or resume) the purge for user_id. Returns the UserPurge row --
+        with failed_at set if a batch failed max_attempts times in a row.
+
+        `report` is called with the UserPurge row after every committed batch;
+        pass None for a quiet purge.
+    """
+
+    purge = UserPurge.query.get(user_id)
+    if purge is None:
+        raise ValueError(f"no purge has been requested for user #{user_id}")
+
+    if purge.failed_at is not None:
+        # asked for again: start with a clean slate
+        purge.failed_at = None
+        purge.last_error = None
+        db.session.commit()
+
+    throttle = Throttle(rows_per_second)
+    failures = 0
+
+    while purge.stage != "done":
+        stage = purge.stage
+
+        try:
+            _set_lock_timeout()
+
+            if stage == "user":
+                count = User.query.filter(User.id == user_id).delete(
+                    synchronize_session=False)
+                purge.finished_at = datetime.utcnow()
+            else:
+                count = _delete_batch(stage, user_id, batch_size)
+                _record(purge, stage, count)
+
+            # a short batch means the stage is drained.
+            if stage == "user" or count < batch_size:
+                purge.stage = PURGE_STAGES[PURGE_STAGES.index(stage) + 1]
+
+            purge.updated_at = datetime.utcnow()
+            db.session.commit()
+
+        except OperationalError as err:
+            # most likely the lock_timeout -- somebody else holds the rows.
+            #  Back off and try the same batch again, for a while: a dropped
+            #  connection or a statement that always times out won't pass.
+            failures += 1
+            if failures >= max_attempts:
+                return _give_up(user_id, err)
+
+            db.session.rollback()
+            purge = UserPurge.query.get(user_id)
+            time.sleep(min(retry_seconds * 2 ** (failures - 1),
+                           MAX_RETRY_SECONDS))
+            continue
+
+        failures = 0
+        if report:
+            report(purge)
+
+        throttle.wait(count)
+
+    return purge
+
+
+def pending_purges():
+    """ User ids with a purge that has not finished (or failed), oldest
+        request first.
+    """
+
+    return [row.user_id for row in (db.session.query(UserPurge.user_id)
+                                    .filter(UserPurge.stage != "done",
+                                            UserPurge.failed_at.is_(None))
+                                    .order_by(UserPurge.requested_at))]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Purge the rows of deleted Warbler accounts.")
+    parser.add_argument("--user-id", type=int,
+                        help="purge a single user instead of every pending purge")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--rows-per-second", type=float,
+                        default=DEFAULT_ROWS_PER_SECOND,
+                        help="0 turns the throttle off")
+    args = parser.parse_args()
+
+    # the app binds the db to the configured DATABASE_URL
+    from app import create_app
+    create_app({"TEMPLATE_WARMUP": "off"})
+
+    user_ids = [args.user_id] if args.user_id else pending_purges()
+
+    failed = 0
+    for user_id in user_ids:
+        purge = purge_user(user_id, args.batch_size, args.rows_per_second)
+        if purge.failed_at is not None:
+            failed += 1
+            print(f"user #{user_id}: gave up at stage {purge.stage}: "
+                  f"{purge.last_error}")
+
+    # non-zero for cron and friends
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
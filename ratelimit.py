@@ -0,0 +1,250 @@
+"""Rate limiting and admission control for the write endpoints.
+
+Every limited endpoint has token buckets per logged in user and per client
+IP. A bucket holds up to N tokens and refills at N per period; each request
+takes one token, and a request finding its bucket empty gets a 429 with a
+Retry-After telling the client how long until the next token.
+
+    RATE_LIMITS = {
+        "views.messages_add_del_like": {"user": "60/minute", "ip": "120/minute"},
+        ...
+    }
+
+Only the endpoints named in RATE_LIMITS are limited, and only for the
+methods that write (POST, PUT, PATCH, DELETE) -- showing the signup form is
+free, submitting it is not. The check runs before the request loads g.user,
+so a throttled request never touches the database.
+
+Buckets live in this process (the default) or, with RATE_LIMIT_STORAGE_URL
+set to redis://..., in Redis so every worker shares them. Needs the `redis`
+package.
+
+On top of the rate limits, at most MAX_CONCURRENT_WRITES limited requests
+run at once in a process (default: the connection pool size plus overflow).
+A request that can't get in within ADMISSION_TIMEOUT seconds gets a 503 with
+Retry-After instead of queueing on the connection pool.
+
+The client IP is request.remote_addr; behind a proxy, wrap the app in
+werkzeug's ProxyFix so that is the real client.
+"""
+
+import math
+import threading
+import time
+
+from flask import g, jsonify, make_response, request, session
+
+WRITE_METHODS = frozenset(("POST", "PUT", "PATCH", "DELETE"))
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+DEFAULT_LIMITS = {
+    "views.signup": {"ip": "10/hour"},
+    "views.login": {"ip": "30/minute"},
+    "views.messages_add": {"user": "10/minute", "ip": "30/minute"},
+    "views.messages_add_del_like": {"user": "60/minute", "ip": "120/minute"},
+    "views.add_follow": {"user": "30/minute", "ip": "60/minute"},
+    "views.stop_following": {"user": "30/minute", "ip": "60/minute"},
+}
+
+
+def parse_limit(limit):
+    """ "30/minute" -> (rate in tokens per second, burst). """
+
+    try:
+        count, period = limit.split("/")
+        count = int(count)
+        return count / PERIODS[period.strip()], count
+    except (ValueError, KeyError):
+        raise ValueError(f"bad rate limit '{limit}', expected e.g. '30/minute'")
+
+
+##############################################################################
+# Stores
+
+
+class MemoryStore:
+    """Token buckets in a dict, for a single process."""
+
+    # past this many buckets, the ones idle for an hour are dropped
+    MAX_BUCKETS = 100000
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst, now=None):
+        """Take a token from the bucket. Returns (allowed, seconds to wait)."""
+
+        now = time.monotonic() if now is None else now
+
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+
+            if tokens >= 1:
+                self.buckets[key] = (tokens - 1, now)
+                allowed, wait = True, 0.0
+            else:
+                self.buckets[key] = (tokens, now)
+                allowed, wait = False, (1 - tokens) / rate
+
+            if len(self.buckets) > self.MAX_BUCKETS:
+                self._prune(now)
+
+        return allowed, wait
+
+    def _prune(self, now):
+        # an idle bucket has refilled, which is the same as no bucket at all
+        self.buckets = {key: (tokens, updated)
+                        for key, (tokens, updated) in self.buckets.items()
+                        if now - updated < 3600}
+
+
+class RedisStore:
+    """Token buckets in Redis, shared by every worker; one round trip each."""
+
+    SCRIPT = """
+        local rate = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(bucket[1]) or burst
+        local updated = tonumber(bucket[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+        local allowed = 0
+        local wait = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+            allowed = 1
+        else
+            wait = (1 - tokens) / rate
+        end
+        redis.call('HMSET', KEYS[1], 'tokens', tokens, 'updated', now)
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+        return {allowed, tostring(wait)}
+    """
+
+    def __init__(self, url):
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+        self.script = self.redis.register_script(self.SCRIPT)
+
+    def take(self, key, rate, burst, now=None):
+        now = time.time() if now is None else now
+        allowed, wait = self.script(keys=[f"warbler:rate:{key}"],
+                                    args=[rate, burst, now])
+        return bool(allowed), float(wait)
+
+
+##############################################################################
+# Limiter
+
+
+class RateLimiter:
+    """Applies the configured limits and the admission limit to requests."""
+
+    def __init__(self, limits, store, max_concurrent, admission_timeout):
+        self.limits = {endpoint: {scope: parse_limit(limit)
+                                  for scope, limit in scopes.items()}
+                       for endpoint, scopes in limits.items()}
+        self.store = store
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.admission_timeout = admission_timeout
+        self.counts = {"allowed": 0, "limited": 0, "shed": 0}
+
+    def check(self, endpoint, user_id, ip):
+        """Seconds to wait if the request is over a limit, else None."""
+
+        waits = []
+        for scope, (rate, burst) in self.limits.get(endpoint, {}).items():
+            who = user_id if scope == "user" else ip
+            if who is None:
+                continue
+            allowed, wait = self.store.take(f"{endpoint}:{scope}:{who}",
+                                            rate, burst)
+            if not allowed:
+                waits.append(wait)
+
+        if waits:
+            self.counts["limited"] += 1
+            return max(waits)
+
+        self.counts["allowed"] += 1
+        return None
+
+    def admit(self):
+        """Take a write slot, waiting up to admission_timeout for one."""
+
+        if self.slots.acquire(timeout=self.admission_timeout):
+            return True
+
+        self.counts["shed"] += 1
+        return False
+
+    def release(self):
+        self.slots.release()
+
+    def stats(self):
+        return dict(self.counts, store=type(self.store).__name__)
+
+
+def too_many(status, message, retry_after):
+    """The 429/503 response, JSON for the API and plain text otherwise."""
+
+    retry_after = max(1, math.ceil(retry_after))
+    if request.blueprint == "api":
+        resp = make_response(jsonify({"error": message}), status)
+    else:
+        resp = make_response(f"{message} Please try again in {retry_after} "
+                             f"second{'s' if retry_after != 1 else ''}.", status)
+        resp.mimetype = "text/plain"
+
+    resp.headers["Retry-After"] = str(retry_after)
+    return resp
+
+
+def init_rate_limits(app):
+    """ Create the app's limiter and its request hooks. Call it before the
+        views are registered so the check runs before g.user is loaded.
+    """
+
+    from app import CURR_USER_KEY
+
+    app.config.setdefault("RATE_LIMITS", DEFAULT_LIMITS)
+    app.config.setdefault("RATE_LIMIT_STORAGE_URL", None)
+    app.config.setdefault("MAX_CONCURRENT_WRITES",
+                          app.config.get("DB_POOL_SIZE", 5)
+                          + app.config.get("DB_MAX_OVERFLOW", 10))
+    app.config.setdefault("ADMISSION_TIMEOUT", 1.0)
+
+    url = app.config["RATE_LIMIT_STORAGE_URL"]
+    store = RedisStore(url) if url else MemoryStore()
+
+    limiter = RateLimiter(app.config["RATE_LIMITS"], store,
+                          app.config["MAX_CONCURRENT_WRITES"],
+                          app.config["ADMISSION_TIMEOUT"])
+    app.extensions["rate_limiter"] = limiter
+
+    @app.before_request
+    def limit_writes():
+        if (request.method not in WRITE_METHODS
+                or request.endpoint not in limiter.limits):
+            return None
+
+        wait = limiter.check(request.endpoint, session.get(CURR_USER_KEY),
+                             request.remote_addr)
+        if wait is not None:
+            return too_many(429, "Too many requests.", wait)
+
+        if not limiter.admit():
+            return too_many(503, "The server is busy.", 1)
+        g.write_slot = True
+
+    @app.teardown_request
+    def release_write_slot(exc):
+        if g.pop("write_slot", False):
+            limiter.release()
+
+    return limiter
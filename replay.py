@@ -0,0 +1,307 @@
+"""Replay recorded requests against Warbler.
+
+Reads JSON lines, one request per line:
+
+    {"method": "POST", "path": "/messages/new", "form": {"text": "hi"}, "user": 12}
+    {"method": "GET", "path": "/", "user": "tuckerdiane", "at": 0.35}
+
+- method defaults to GET, form to no body.
+- user is a user id or username; leave it out for an anonymous request.
+- at (optional) is the offset in seconds from the start of the recording.
+
+Every user gets their own cookie jar, seeded with a session that logs them
+in, and a queue: a user's requests are sent one at a time and in the
+recorded order -- like one browser. Requests of different users run
+concurrently.
+
+Pacing:
+
+    --rate 50          send 50 requests per second
+    --speed 2          follow the recorded `at` offsets, twice as fast
+    (neither)          as fast as --concurrency workers allow
+
+Target:
+
+    (default)          the app in this process, through the Flask test client
+    --base-url URL     a running server; session cookies are signed with the
+                       app's SECRET_KEY, so it must match the server's, and
+                       server-side sessions are written to the app's
+                       SESSION_STORE, which the server must share (and
+                       the server needs WTF_CSRF_ENABLED off for form posts)
+
+The report lists throughput, latency percentiles and status codes per
+endpoint; --output also writes it as JSON.
+
+    python replay.py traffic.jsonl --concurrency 8 --output replay.json
+"""
+
+import argparse
+import json
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import Cookie, CookieJar
+
+from bench import latency_summary
+
+
+def read_records(path):
+    """Parse the JSON lines file; blank lines and # comments are skipped."""
+
+    records = []
+    with open(path) as log:
+        for line_no, line in enumerate(log, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as err:
+                raise SystemExit(f"{path}:{line_no}: not JSON ({err})")
+            if "path" not in record:
+                raise SystemExit(f"{path}:{line_no}: record has no path")
+            record.setdefault("method", "GET")
+            record["method"] = record["method"].upper()
+            records.append(record)
+
+    return records
+
+
+class UserResolver:
+    """Turns the `user` of a record into a user id, caching username lookups."""
+
+    def __init__(self):
+        self.ids = {}
+
+    def __call__(self, user):
+        if user is None or isinstance(user, int):
+            return user
+        if str(user).isdigit():
+            return int(user)
+
+        if user not in self.ids:
+            from models import User
+
+            found = User.query.filter_by(username=user).first()
+            if found is None:
+                raise SystemExit(f"replay: no user named '{user}'")
+            self.ids[user] = found.id
+
+        return self.ids[user]
+
+
+class TestClientTarget:
+    """Sends requests to the app in this process."""
+
+    def __init__(self, app):
+        self.app = app
+        self.clients = {}
+
+    def client_for(self, user_id):
+        from app import CURR_USER_KEY
+
+        if user_id not in self.clients:
+            client = self.app.test_client()
+            with client.session_transaction() as sess:
+                if user_id is not None:
+                    sess[CURR_USER_KEY] = user_id
+            self.clients[user_id] = client
+
+        return self.clients[user_id]
+
+    def send(self, user_id, method, path, form):
+        resp = self.client_for(user_id).open(path, method=method, data=form)
+        # streamed pages do their work as the body is read
+        resp.get_data()
+        resp.close()
+        return resp.status_code
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Report redirects as responses, like the test client does."""
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HTTPTarget:
+    """Sends requests to a running server, one cookie jar per user."""
+
+    def __init__(self, app, base_url):
+        self.app = app
+        self.base_url = base_url.rstrip("/")
+        self.openers = {}
+
+    def _session_cookie(self, user_id):
+        from sessions import login_cookie
+
+        value = login_cookie(self.app, user_id)
+        host = urllib.parse.urlsplit(self.base_url).hostname
+
+        return Cookie(0, self.app.session_cookie_name, value, None, False,
+                      host, False, False, "/", True, False, None, False,
+                      None, None, {})
+
+    def opener_for(self, user_id):
+        if user_id not in self.openers:
+            jar = CookieJar()
+            if user_id is not None:
+                jar.set_cookie(self._session_cookie(user_id))
+            self.openers[user_id] = urllib.request.build_opener(
+                urllib.request.HTTPCookieProcessor(jar), _NoRedirect)
+
+        return self.openers[user_id]
+
+    def send(self, user_id, method, path, form):
+        data = urllib.parse.urlencode(form).encode() if form else None
+        request = urllib.request.Request(self.base_url + path, data=data,
+                                         method=method)
+        try:
+            with self.opener_for(user_id).open(request) as resp:
+                resp.read()
+                return resp.status
+        except urllib.error.HTTPError as err:
+            return err.code
+
+
+def endpoint_for(app, method, path):
+    """The Flask endpoint name a request maps to, for grouping the report."""
+
+    adapter = app.url_map.bind("localhost")
+    try:
+        endpoint, _ = adapter.match(urllib.parse.urlsplit(path).path,
+                                    method=method)
+        return endpoint
+    except Exception:
+        return f"{method} {path} (no route)"
+
+
+def replay(app, records, target, concurrency, rate=None, speed=None):
+    """Send the records and return the per-endpoint report."""
+
+    resolve = UserResolver()
+    jobs = [(resolve(record.get("user")), record["method"], record["path"],
+             record.get("form"), record.get("at"),
+             endpoint_for(app, record["method"], record["path"]))
+            for record in records]
+
+    # a queue per user sends a user's requests one at a time and in order,
+    #  like one browser: a worker drains a user's queue while it has
+    #  requests, then goes back to the pool
+    queues = defaultdict(deque)
+    draining = set()
+    queue_lock = threading.Lock()
+    results = defaultdict(list)
+    results_lock = threading.Lock()
+    start = time.perf_counter()
+
+    def send(job):
+        user_id, method, path, form, at, endpoint = job
+
+        sent = time.perf_counter()
+        try:
+            status = target.send(user_id, method, path, form)
+        except Exception:
+            status = 0
+        elapsed = time.perf_counter() - sent
+
+        with results_lock:
+            results[endpoint].append((elapsed, status, time.perf_counter()))
+
+    def drain(user_id):
+        while True:
+            with queue_lock:
+                if not queues[user_id]:
+                    draining.discard(user_id)
+                    return
+                job = queues[user_id].popleft()
+            send(job)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for index, job in enumerate(jobs):
+            user_id, at = job[0], job[4]
+
+            # pacing: when this request is due, relative to the start
+            if rate:
+                due = index / rate
+            elif speed and at is not None:
+                due = at / speed
+            else:
+                due = None
+            if due is not None:
+                delay = start + due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+            with queue_lock:
+                queues[user_id].append(job)
+                if user_id in draining:
+                    continue
+                draining.add(user_id)
+            pool.submit(drain, user_id)
+
+    wall = time.perf_counter() - start
+    report = {"requests": len(jobs), "seconds": round(wall, 3),
+              "throughput_rps": round(len(jobs) / wall, 2) if wall else 0.0,
+              "endpoints": {}}
+
+    for endpoint, samples in sorted(results.items()):
+        summary = latency_summary([s[0] for s in samples])
+        statuses = defaultdict(int)
+        for sample in samples:
+            statuses[str(sample[1])] += 1
+        summary["statuses"] = dict(statuses)
+        summary["throughput_rps"] = round(len(samples) / wall, 2) if wall else 0.0
+        report["endpoints"][endpoint] = summary
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded Warbler requests.")
+    parser.add_argument("log", help="JSON lines file of request records")
+    parser.add_argument("--concurrency", type=int, default=4)
+    pacing = parser.add_mutually_exclusive_group()
+    pacing.add_argument("--rate", type=float, help="requests per second")
+    pacing.add_argument("--speed", type=float,
+                        help="follow the recorded 'at' offsets, this much faster")
+    parser.add_argument("--base-url", help="replay against a running server")
+    parser.add_argument("--output", help="write the report as JSON")
+    args = parser.parse_args()
+
+    from app import create_app
+
+    # in process every request comes from one IP, so the rate limits are off
+    #  (a --base-url server applies its own); no trending snapshots from a
+    #  replay
+    app = create_app({"WTF_CSRF_ENABLED": False, "RATE_LIMITS": {},
+                      "TRENDING_SNAPSHOT_SECONDS": 0})
+
+    records = read_records(args.log)
+    if args.base_url:
+        target = HTTPTarget(app, args.base_url)
+    else:
+        target = TestClientTarget(app)
+
+    report = replay(app, records, target, args.concurrency,
+                    rate=args.rate, speed=args.speed)
+
+    print(f"{report['requests']} requests in {report['seconds']}s "
+          f"({report['throughput_rps']} req/s)")
+    for endpoint, summary in report["endpoints"].items():
+        print(f"{endpoint:24} n {summary['count']:6}  "
+              f"{summary['throughput_rps']:8.2f} req/s  "
+              f"p50 {summary['p50_ms']:9.2f}ms  p95 {summary['p95_ms']:9.2f}ms  "
+              f"p99 {summary['p99_ms']:9.2f}ms  {summary['statuses']}")
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
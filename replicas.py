@@ -0,0 +1,193 @@
+"""Read-replica routing for Warbler.
+
+GET views decorated with @replica_reads read from a replica; everything else,
+and every write, goes to the primary (SQLALCHEMY_DATABASE_URI). The routing
+itself is done by RoutingSession in models.py -- this module holds the
+replica engines, picks one per request and decides when a request may use it.
+
+Settings (app.config, filled from the environment in app.py):
+
+- SQLALCHEMY_REPLICA_URIS: list of replica database URIs. Empty turns routing
+  off.
+- REPLICA_SELECTION: "round-robin" or "least-latency". least-latency keeps
+  a moving average of statement time per replica and picks the fastest.
+- REPLICA_STICKY_SECONDS: after a user's own POST (a like, a follow, a new
+  message, ...) their reads stay on the primary this long, so they see their
+  own write even when the replicas lag behind.
+- REPLICA_RETRY_SECONDS: a replica that drops its connection is skipped for
+  this long.
+
+Locally, two SQLite files are enough to try it:
+
+    DATABASE_URL=sqlite:////tmp/primary.db \
+    DATABASE_REPLICA_URLS=sqlite:////tmp/replica.db flask run
+"""
+
+import itertools
+import threading
+import time
+
+from flask import g, request, session
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+
+from models import engine_options
+
+PRIMARY_UNTIL_KEY = "primary_until"
+
+# weight of the newest sample in the least-latency moving average
+LATENCY_ALPHA = 0.2
+
+
+class Replica:
+    """One replica engine plus the numbers used to pick it."""
+
+    def __init__(self, uri, engine):
+        self.uri = uri
+        self.engine = engine
+        self.latency = 0.0
+        self.samples = 0
+        self.down_until = 0.0
+
+    def record(self, seconds):
+        """Fold one statement time into the moving average."""
+
+        if self.samples:
+            self.latency += LATENCY_ALPHA * (seconds - self.latency)
+        else:
+            self.latency = seconds
+        self.samples += 1
+
+    def __repr__(self):
+        return f"<Replica {self.uri}: {self.latency * 1000:.2f}ms>"
+
+
+class ReplicaSet:
+    """The replicas of one app and the policy for picking between them."""
+
+    def __init__(self, uris, config):
+        self.selection = config.get("REPLICA_SELECTION", "round-robin")
+        self.retry_seconds = config.get("REPLICA_RETRY_SECONDS", 30)
+        self.replicas = [self._connect(uri, config) for uri in uris]
+        self._cycle = itertools.cycle(self.replicas)
+        self._lock = threading.Lock()
+
+        if self.selection not in ("round-robin", "least-latency"):
+            raise ValueError(
+                f"unknown REPLICA_SELECTION '{self.selection}'")
+
+    def _connect(self, uri, config):
+        """Create the engine for one replica and hook up latency tracking."""
+
+        engine = create_engine(uri, **engine_options(config, make_url(uri)))
+        replica = Replica(uri, engine)
+
+        # one statement runs on a connection at a time: a single timestamp,
+        #  cleared by the statement's end or its error
+        @event.listens_for(engine, "before_cursor_execute")
+        def start_timer(conn, cursor, statement, params, context, many):
+            conn.info["replica_started"] = time.perf_counter()
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def stop_timer(conn, cursor, statement, params, context, many):
+            started = conn.info.pop("replica_started", None)
+            if started is not None:
+                replica.record(time.perf_counter() - started)
+
+        @event.listens_for(engine, "handle_error")
+        def mark_down(context):
+            if context.connection is not None:
+                context.connection.info.pop("replica_started", None)
+            if context.is_disconnect:
+                replica.down_until = time.monotonic() + self.retry_seconds
+
+        return replica
+
+    def choose(self):
+        """Pick a replica for a new request, or None when none is up."""
+
+        now = time.monotonic()
+
+        with self._lock:
+            if self.selection == "least-latency":
+                up = [r for r in self.replicas if r.down_until <= now]
+                return min(up, key=lambda r: r.latency) if up else None
+
+            for _ in range(len(self.replicas)):
+                replica = next(self._cycle)
+                if replica.down_until <= now:
+                    return replica
+
+        return None
+
+    def engine_for_request(self):
+        """The replica engine of the current request, picked on first use so
+        every read of a request sees the same replica.
+        """
+
+        if "db_replica" not in g:
+            g.db_replica = self.choose()
+
+        return g.db_replica.engine if g.db_replica else None
+
+    def status(self):
+        """Per-replica latency and availability, for /health/db."""
+
+        now = time.monotonic()
+        return [{"uri": repr(make_url(r.uri)),
+                 "latency_ms": round(r.latency * 1000, 3),
+                 "samples": r.samples,
+                 "up": r.down_until <= now} for r in self.replicas]
+
+
+def replica_reads(view):
+    """Mark a view as read-only so its GET requests may read from a replica.
+
+    Put it below @app.route so the route registers the marked view.
+    """
+
+    view.replica_reads = True
+    return view
+
+
+def stick_to_primary(app):
+    """Keep the current user's reads on the primary for a few seconds."""
+
+    session[PRIMARY_UNTIL_KEY] = time.time() + \
+        app.config["REPLICA_STICKY_SECONDS"]
+
+
+def init_replicas(app):
+    """ Connect the replicas in SQLALCHEMY_REPLICA_URIS and register the request
+        hooks that turn replica reads on and off. Call it before registering
+        any before_request that queries, so those queries are routed too.
+    """
+
+    app.config.setdefault("SQLALCHEMY_REPLICA_URIS", [])
+    app.config.setdefault("REPLICA_SELECTION", "round-robin")
+    app.config.setdefault("REPLICA_STICKY_SECONDS", 5)
+    app.config.setdefault("REPLICA_RETRY_SECONDS", 30)
+
+    uris = app.config["SQLALCHEMY_REPLICA_URIS"]
+    app.extensions["replicas"] = ReplicaSet(uris, app.config) if uris else None
+
+    @app.before_request
+    def route_reads():
+        """Send this request's reads to a replica when that is safe."""
+
+        view = app.view_functions.get(request.endpoint)
+        g.db_read_replica = bool(
+            app.extensions.get("replicas")
+            and request.method in ("GET", "HEAD")
+            and getattr(view, "replica_reads", False)
+            and session.get(PRIMARY_UNTIL_KEY, 0) < time.time())
+
+    @app.after_request
+    def read_your_writes(response):
+        """A POST is a write; keep the writer on the primary for a bit."""
+
+        if (request.method == "POST" and app.extensions.get("replicas")
+                and response.status_code < 400):
+            stick_to_primary(app)
+
+        return response
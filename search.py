@@ -0,0 +1,312 @@
+"""Full-text search over message text.
+
+Two backends behind one search_messages():
+
+- "postgres": a GIN index on to_tsvector('english', text). Postgres keeps
+  the index current by itself; a search is one indexed query ranked with
+  ts_rank_cd. The index is created with the messages table, or for an
+  existing database with `python search.py --create-index` (CONCURRENTLY,
+  so the table stays writable meanwhile).
+- "memory": an inverted index in the process -- term -> {message id: term
+  frequency} -- ranked with BM25, for SQLite and local development. It is
+  built on the first search and kept current by messages_add and
+  messages_destroy; messages written by other processes (or by seed.py or
+  the purge) are noticed by comparing the newest id and the row count with
+  the database before each search.
+
+SEARCH_BACKEND picks one; "auto" (the default) uses postgres on Postgres and
+memory otherwise. Both match messages containing every word of the query
+("dog walk" finds "walking the dog" on Postgres, which stems; the memory
+index matches whole words), filter by author, skip deleted accounts, and
+page by offset.
+"""
+
+import argparse
+import heapq
+import math
+import re
+import threading
+from collections import namedtuple, Counter
+
+from flask import current_app
+from sqlalchemy import DDL, event, func
+
+from models import db, User, Message
+
+PER_PAGE = 20
+
+WORD = re.compile(r"\w+")
+
+# the common words Postgres's english configuration leaves out too
+STOPWORDS = frozenset("""
+    a an and are as at be but by for from has have he her his i if in into is
+    it its me my no not of on or our she so that the their them then there
+    these they this to too was we were what when which who will with you your
+""".split())
+
+# BM25
+K1 = 1.2
+B = 0.75
+
+SearchResult = namedtuple("SearchResult", [
+    "id", "text", "timestamp", "user_id", "username", "image_url"])
+
+SearchPage = namedtuple("SearchPage", ["results", "page", "has_next"])
+
+RESULT_COLUMNS = [Message.id, Message.text, Message.timestamp, Message.user_id,
+                  User.username, User.image_url]
+
+
+def terms(text):
+    return [word for word in WORD.findall((text or "").lower())
+            if word not in STOPWORDS]
+
+
+##############################################################################
+# Postgres
+
+
+INDEX_DDL = ("CREATE INDEX {concurrently} IF NOT EXISTS messages_text_search "
+             "ON messages USING GIN (to_tsvector('english', text))")
+
+# created along with the table by db.create_all()
+event.listen(Message.__table__, "after_create",
+             DDL(INDEX_DDL.format(concurrently="")).execute_if(
+                 dialect="postgresql"))
+
+
+class PostgresSearch:
+    """Search through the GIN index."""
+
+    def add(self, message_id, user_id, text):
+        pass  # the index follows the table
+
+    def remove(self, message_id):
+        pass
+
+    def search(self, query, author_ids, offset, limit):
+        tsquery = func.plainto_tsquery("english", query)
+        document = func.to_tsvector("english", Message.text)
+        rank = func.ts_rank_cd(document, tsquery)
+
+        rows = (db.session.query(*RESULT_COLUMNS)
+                .join(User, Message.user_id == User.id)
+                .filter(document.op("@@")(tsquery), User.deleted_at.is_(None)))
+        if author_ids is not None:
+            rows = rows.filter(Message.user_id.in_(author_ids))
+
+        return [SearchResult(*row) for row in (rows
+                                               .order_by(rank.desc(),
+                                                         Message.id.desc())
+                                               .offset(offset)
+                                               .limit(limit))]
+
+
+##############################################################################
+# In memory
+
+
+class MemorySearch:
+    """Inverted index with BM25 ranking."""
+
+    def __init__(self):
+        self.postings = {}
+        # per message: its distinct terms (to unindex it), length, author
+        self.words = {}
+        self.lengths = {}
+        self.authors = {}
+        self.total_length = 0
+        # newest message id the index has seen
+        self.newest = None
+        self.lock = threading.Lock()
+
+    def add(self, message_id, user_id, text):
+        with self.lock:
+            self._add(message_id, user_id, text)
+            if self.newest is not None:
+                self.newest = max(self.newest, message_id)
+
+    def remove(self, message_id):
+        with self.lock:
+            self._remove(message_id)
+
+    def _add(self, message_id, user_id, text):
+        if message_id in self.lengths:
+            return
+
+        words = terms(text)
+        counts = Counter(words)
+        for term, count in counts.items():
+            self.postings.setdefault(term, {})[message_id] = count
+        self.words[message_id] = tuple(counts)
+        self.lengths[message_id] = len(words)
+        self.authors[message_id] = user_id
+        self.total_length += len(words)
+
+    def _remove(self, message_id):
+        length = self.lengths.pop(message_id, None)
+        if length is None:
+            return
+
+        self.authors.pop(message_id)
+        self.total_length -= length
+        for term in self.words.pop(message_id):
+            docs = self.postings[term]
+            del docs[message_id]
+            if not docs:
+                del self.postings[term]
+
+    def sync(self):
+        """Catch up with messages written or deleted by other processes."""
+
+        newest, count = db.session.query(func.max(Message.id),
+                                         func.count(Message.id)).one()
+
+        with self.lock:
+            if self.newest is not None and newest == self.newest \
+                    and count == len(self.lengths):
+                return
+
+            if self.newest is None or (newest or 0) < self.newest:
+                self._load(0, reset=True)
+            else:
+                self._load(self.newest)
+
+            if len(self.lengths) != count:
+                # something was deleted elsewhere: start over
+                self._load(0, reset=True)
+
+    def _load(self, after_id, reset=False):
+        if reset:
+            self.postings, self.words = {}, {}
+            self.lengths, self.authors = {}, {}
+            self.total_length = 0
+            self.newest = 0
+
+        rows = (db.session.query(Message.id, Message.user_id, Message.text)
+                .filter(Message.id > after_id)
+                .yield_per(1000))
+        for message_id, user_id, text in rows:
+            self._add(message_id, user_id, text)
+            self.newest = max(self.newest, message_id)
+
+    def search(self, query, author_ids, offset, limit):
+        self.sync()
+
+        words = list(dict.fromkeys(terms(query)))
+        hidden = {row[0] for row in db.session.query(User.id)
+                  .filter(User.deleted_at.isnot(None))}
+
+        with self.lock:
+            ranked = self._rank(words, author_ids, hidden, offset + limit)
+
+        ids = [message_id for _, message_id in ranked[offset:]]
+        if not ids:
+            return []
+
+        rows = {row.id: SearchResult(*row) for row in (
+            db.session.query(*RESULT_COLUMNS)
+            .join(User, Message.user_id == User.id)
+            .filter(Message.id.in_(ids)))}
+        return [rows[message_id] for message_id in ids if message_id in rows]
+
+    def _rank(self, words, author_ids, hidden, count):
+        """The best `count` (score, message id), best first."""
+
+        postings = [self.postings.get(word, {}) for word in words]
+        if not postings or not all(postings):
+            return []
+
+        # every word has to match: walk the shortest list
+        postings.sort(key=len)
+        candidates = [message_id for message_id in postings[0]
+                      if all(message_id in docs for docs in postings[1:])
+                      and self.authors[message_id] not in hidden
+                      and (author_ids is None
+                           or self.authors[message_id] in author_ids)]
+
+        documents = len(self.lengths)
+        average = self.total_length / documents
+        idf = [math.log(1 + (documents - len(docs) + 0.5) / (len(docs) + 0.5))
+               for docs in postings]
+
+        def score(message_id):
+            norm = K1 * (1 - B + B * self.lengths[message_id] / average)
+            return sum(weight * docs[message_id] * (K1 + 1)
+                       / (docs[message_id] + norm)
+                       for weight, docs in zip(idf, postings))
+
+        # newest first among equal scores, like the postgres backend
+        return heapq.nlargest(count, ((score(message_id), message_id)
+                                      for message_id in candidates))
+
+
+##############################################################################
+# Entry points
+
+
+def search_index():
+    """The app's search backend, picked on first use."""
+
+    state = current_app.extensions["search"]
+    with state["lock"]:
+        if state["backend"] is None:
+            name = current_app.config["SEARCH_BACKEND"]
+            if name == "auto":
+                name = ("postgres" if db.engine.dialect.name == "postgresql"
+                        else "memory")
+            state["backend"] = PostgresSearch() if name == "postgres" \
+                else MemorySearch()
+    return state["backend"]
+
+
+def search_messages(query, authors=None, page=1, per_page=PER_PAGE):
+    """ A SearchPage of the messages matching every word of query, best
+        first. authors: usernames to limit the search to.
+    """
+
+    page = max(1, page)
+    if not terms(query):
+        return SearchPage([], page, False)
+
+    author_ids = None
+    if authors:
+        author_ids = {row[0] for row in db.session.query(User.id)
+                      .filter(User.username.in_(authors))}
+        if not author_ids:
+            return SearchPage([], page, False)
+
+    # one extra row says whether there is a next page
+    results = search_index().search(query, author_ids,
+                                    (page - 1) * per_page, per_page + 1)
+    return SearchPage(results[:per_page], page, len(results) > per_page)
+
+
+def init_search(app):
+    app.config.setdefault("SEARCH_BACKEND", "auto")
+    app.extensions["search"] = {"backend": None, "lock": threading.Lock()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Message search maintenance.")
+    parser.add_argument("--create-index", action="store_true",
+                        help="create the Postgres GIN index on an existing "
+                             "messages table")
+    args = parser.parse_args()
+
+    from app import create_app
+    create_app({"TEMPLATE_WARMUP": "off"})
+
+    if args.create_index:
+        if db.engine.dialect.name != "postgresql":
+            raise SystemExit("the GIN index is Postgres only; other databases "
+                             "use the in-memory index")
+        # CREATE INDEX CONCURRENTLY can't run in a transaction
+        with db.engine.connect().execution_options(
+                isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(INDEX_DDL.format(concurrently="CONCURRENTLY"))
+        print("messages_text_search is ready")
+
+
+if __name__ == "__main__":
+    main()
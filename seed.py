@@ -1,9 +1,10 @@
 """Seed database with sample data from CSV Files."""
 
 from csv import DictReader
-from app import db
-from models import User, Message, Follows
+from app import create_app
+from models import db, User, Message, Follows
 
+app = create_app({"TEMPLATE_WARMUP": "off"})
 
 db.drop_all()
 db.create_all()
@@ -18,3 +19,6 @@ with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
 db.session.commit()
+
+# drop messages cached from the old tables
+app.extensions["message_cache"].invalidate()
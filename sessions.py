@@ -0,0 +1,545 @@
+"""Server-side sessions.
+
+Flask keeps the whole session in a signed cookie, so nothing on the server
+knows which sessions exist: deleting an account couldn't log out its other
+browsers, and every request with a deleted user's id went to the database
+to find that out. Here the session lives in a store and the cookie only
+carries its id -- random, and signed with the SECRET_KEY, so a made-up id
+is turned away without a store lookup.
+
+SESSION_STORE picks the store:
+
+- "sqlite" (default): a table in SESSION_PATH (default: a file in the
+  app's instance folder, one per database), shared by the workers on a host;
+- "file": a file per session in the SESSION_PATH directory;
+- "memory": a dict in this process, for development and tests;
+- "cookie": Flask's signed cookie, as before (no revocation).
+
+Sessions expire SESSION_TTL seconds after their last use.
+
+Next to the session data (the user id, flashes, the CSRF token) a session
+keeps a snapshot of the logged in user's row. add_user_to_g makes g.user a
+SessionUser from it without a query; only a page that needs more than the
+snapshot (the user's messages, follows, ...) loads the User, once.
+Deleting an account revokes every session of the user, and a profile edit
+rewrites the snapshot in all of them.
+"""
+
+import hashlib
+import json
+import os
+import secrets
+import sqlite3
+import tempfile
+import threading
+import time
+
+from flask import current_app, session
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import Signer, BadSignature
+from werkzeug.datastructures import CallbackDict
+
+from app import CURR_USER_KEY
+
+# the user columns a session keeps, so pages can show the user without a query
+SNAPSHOT = ("id", "username", "email", "image_url", "header_image_url", "bio",
+            "location")
+
+# expired sessions are deleted every this many writes
+PURGE_EVERY = 1000
+
+serializer = TaggedJSONSerializer()
+
+
+def snapshot(user):
+    return {name: getattr(user, name) for name in SNAPSHOT}
+
+
+class SessionUser:
+    """g.user from a session's snapshot. Anything else loads the User."""
+
+    def __init__(self, snapshot):
+        self.__dict__.update(snapshot)
+        self._user = None
+
+    def load(self):
+        """The User row itself."""
+
+        if self._user is None:
+            from models import User
+            self._user = User.query.get(self.id)
+        return self._user
+
+    def __getattr__(self, name):
+        # only called for names that aren't in the snapshot
+        return getattr(self.load(), name)
+
+    def __eq__(self, other):
+        # the same user as a User row or another SessionUser
+        from models import User
+        if isinstance(other, (SessionUser, User)):
+            return self.id == other.id
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f"<SessionUser #{self.id}: {self.username}>"
+
+
+##############################################################################
+# Stores
+#
+# Each keeps, per session id: the serialized session data, the user snapshot
+# (or None), the user id and when it expires.
+
+
+class MemoryStore:
+    """Sessions in a dict, for a single process."""
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.writes = 0
+
+    def get(self, sid):
+        record = self.sessions.get(sid)
+        if record is None or record[3] < time.time():
+            return None
+        return serializer.loads(record[0]), record[1], record[3]
+
+    def put(self, sid, data, user, ttl):
+        with self.lock:
+            self.sessions[sid] = (serializer.dumps(data), user,
+                                  user["id"] if user else None,
+                                  time.time() + ttl)
+            self.writes += 1
+            if self.writes % PURGE_EVERY == 0:
+                self._purge()
+
+    def delete(self, sid):
+        with self.lock:
+            self.sessions.pop(sid, None)
+
+    def revoke_user(self, user_id):
+        with self.lock:
+            sids = [sid for sid, record in self.sessions.items()
+                    if record[2] == user_id]
+            for sid in sids:
+                del self.sessions[sid]
+        return len(sids)
+
+    def update_user(self, user):
+        with self.lock:
+            for sid, record in self.sessions.items():
+                if record[2] == user["id"]:
+                    self.sessions[sid] = (record[0], user) + record[2:]
+
+    def _purge(self):
+        now = time.time()
+        for sid in [sid for sid, record in self.sessions.items()
+                    if record[3] < now]:
+            del self.sessions[sid]
+
+    def count(self):
+        return len(self.sessions)
+
+
+class FileStore:
+    """A JSON file per session, and a directory per user listing theirs."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.writes = 0
+        os.makedirs(os.path.join(directory, "sessions"), mode=0o700,
+                    exist_ok=True)
+        os.makedirs(os.path.join(directory, "users"), mode=0o700,
+                    exist_ok=True)
+
+    def _path(self, sid):
+        return os.path.join(self.directory, "sessions", sid)
+
+    def _user_dir(self, user_id):
+        return os.path.join(self.directory, "users", str(user_id))
+
+    def _read(self, sid):
+        try:
+            with open(self._path(sid)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, sid, record):
+        fd, tmp = tempfile.mkstemp(dir=os.path.join(self.directory, "sessions"))
+        with os.fdopen(fd, "w") as f:
+            json.dump(record, f)
+        os.replace(tmp, self._path(sid))
+
+    def get(self, sid):
+        record = self._read(sid)
+        if record is None or record["expires"] < time.time():
+            return None
+        return serializer.loads(record["data"]), record["user"], record["expires"]
+
+    def put(self, sid, data, user, ttl):
+        self._write(sid, {"data": serializer.dumps(data), "user": user,
+                          "expires": time.time() + ttl})
+        if user:
+            os.makedirs(self._user_dir(user["id"]), exist_ok=True)
+            open(os.path.join(self._user_dir(user["id"]), sid), "a").close()
+
+        self.writes += 1
+        if self.writes % PURGE_EVERY == 0:
+            self._purge()
+
+    def delete(self, sid):
+        try:
+            os.remove(self._path(sid))
+        except FileNotFoundError:
+            pass
+
+    def _user_sessions(self, user_id):
+        try:
+            return os.listdir(self._user_dir(user_id))
+        except FileNotFoundError:
+            return []
+
+    def revoke_user(self, user_id):
+        count = 0
+        for sid in self._user_sessions(user_id):
+            if self._read(sid) is not None:
+                count += 1
+            self.delete(sid)
+            os.remove(os.path.join(self._user_dir(user_id), sid))
+        return count
+
+    def update_user(self, user):
+        for sid in self._user_sessions(user["id"]):
+            record = self._read(sid)
+            if record is not None:
+                record["user"] = user
+                self._write(sid, record)
+
+    def _purge(self):
+        now = time.time()
+        for sid in os.listdir(os.path.join(self.directory, "sessions")):
+            record = self._read(sid)
+            if record is not None and record["expires"] < now:
+                self.delete(sid)
+
+    def count(self):
+        return len(os.listdir(os.path.join(self.directory, "sessions")))
+
+
+class SQLiteStore:
+    """A sessions table in an SQLite file, indexed by user id."""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.writes = 0
+
+        # the sessions are as good as passwords: owner only
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                     "sid TEXT PRIMARY KEY, data TEXT NOT NULL, user TEXT, "
+                     "user_id INTEGER, expires REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_user_id "
+                     "ON sessions (user_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires "
+                     "ON sessions (expires)")
+        conn.commit()
+
+    def _conn(self):
+        # sqlite3 connections stay in the thread that made them
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def get(self, sid):
+        row = self._conn().execute(
+            "SELECT data, user, expires FROM sessions "
+            "WHERE sid = ? AND expires >= ?", (sid, time.time())).fetchone()
+        if row is None:
+            return None
+        return (serializer.loads(row[0]), json.loads(row[1]) if row[1] else None,
+                row[2])
+
+    def put(self, sid, data, user, ttl):
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (sid, data, user, user_id, "
+                "expires) VALUES (?, ?, ?, ?, ?)",
+                (sid, serializer.dumps(data), json.dumps(user) if user else None,
+                 user["id"] if user else None, time.time() + ttl))
+
+            self.writes += 1
+            if self.writes % PURGE_EVERY == 0:
+                conn.execute("DELETE FROM sessions WHERE expires < ?",
+                             (time.time(),))
+
+    def delete(self, sid):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+    def revoke_user(self, user_id):
+        conn = self._conn()
+        with conn:
+            return conn.execute("DELETE FROM sessions WHERE user_id = ?",
+                                (user_id,)).rowcount
+
+    def update_user(self, user):
+        conn = self._conn()
+        with conn:
+            conn.execute("UPDATE sessions SET user = ? WHERE user_id = ?",
+                         (json.dumps(user), user["id"]))
+
+    def count(self):
+        return self._conn().execute(
+            "SELECT count(*) FROM sessions WHERE expires >= ?",
+            (time.time(),)).fetchone()[0]
+
+
+##############################################################################
+# The session interface
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """The session dict, plus its id and the user snapshot."""
+
+    def __init__(self, data=None, sid=None, user=None, expires=None):
+        def on_update(self):
+            self.modified = True
+
+        CallbackDict.__init__(self, data, on_update)
+        self.sid = sid or secrets.token_urlsafe(32)
+        self.new = sid is None
+        self.user = user
+        self.expires = expires
+        self.modified = False
+        # the id this session had before regenerate()
+        self.replaced = None
+
+    def regenerate(self):
+        """A new id (at login), so an id planted before it is worthless."""
+
+        if not self.new and self.replaced is None:
+            self.replaced = self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.new = True
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    """Sessions in a store; the cookie holds the signed session id."""
+
+    def __init__(self, store, ttl):
+        self.store = store
+        self.ttl = ttl
+
+    def signer(self, app):
+        return Signer(app.secret_key, salt="server-session")
+
+    def session_id(self, app, cookie):
+        """The id in a session cookie, or None if it wasn't signed here."""
+
+        try:
+            return self.signer(app).unsign(cookie).decode()
+        except BadSignature:
+            return None
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(app.session_cookie_name)
+        sid = self.session_id(app, cookie) if cookie else None
+        record = self.store.get(sid) if sid else None
+        if record is None:
+            return ServerSession()
+
+        data, user, expires = record
+        return ServerSession(data, sid, user, expires)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.replaced:
+            self.store.delete(session.replaced)
+
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(app.session_cookie_name,
+                                       domain=domain, path=path)
+            return
+
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        # write when something changed, or to push the expiry out once half
+        #  of the TTL has gone by
+        stale = (session.expires is not None
+                 and session.expires - time.time() < self.ttl / 2)
+        if not (session.modified or session.new or stale):
+            return
+
+        self.store.put(session.sid, dict(session), session.user, self.ttl)
+        response.set_cookie(
+            app.session_cookie_name,
+            self.signer(app).sign(session.sid.encode()).decode(),
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain, path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app))
+
+    def user_id(self, app, cookie):
+        """The logged in user id of a session cookie (for asgi.py)."""
+
+        sid = self.session_id(app, cookie)
+        record = self.store.get(sid) if sid else None
+        return record[0].get(CURR_USER_KEY) if record else None
+
+
+##############################################################################
+# In the app
+
+
+def session_store():
+    """The app's session store, or None with cookie sessions."""
+
+    interface = current_app.session_interface
+    return interface.store if isinstance(interface, ServerSessionInterface) \
+        else None
+
+
+def server_session():
+    """This request's ServerSession, or None with cookie sessions."""
+
+    current = session._get_current_object()
+    return current if isinstance(current, ServerSession) else None
+
+
+def session_user(user_id):
+    """g.user from the session's snapshot of user_id, or None without one."""
+
+    current = server_session()
+    if current is None or current.user is None \
+            or current.user["id"] != user_id:
+        return None
+    return SessionUser(current.user)
+
+
+def remember_user(user, login=False):
+    """ Keep a snapshot of user in this session; at login under a new id. """
+
+    current = server_session()
+    if current is None:
+        return
+    if login:
+        current.regenerate()
+    current.user = snapshot(user)
+    current.modified = True
+
+
+def forget_user():
+    """Drop the snapshot (at logout)."""
+
+    current = server_session()
+    if current is not None and current.user is not None:
+        current.user = None
+        current.modified = True
+
+
+def user_changed(user):
+    """Rewrite the snapshot of user in all of their sessions."""
+
+    store = session_store()
+    if store is None:
+        return
+    store.update_user(snapshot(user))
+    current = server_session()
+    if current is not None and current.user is not None \
+            and current.user["id"] == user.id:
+        current.user = snapshot(user)
+
+
+def revoke_user(user_id):
+    """End every session of user_id. Returns how many there were."""
+
+    store = session_store()
+    return store.revoke_user(user_id) if store is not None else 0
+
+
+def cookie_user_id(app, cookie):
+    """The user id in a session cookie, for either kind of session."""
+
+    interface = app.session_interface
+    if isinstance(interface, ServerSessionInterface):
+        return interface.user_id(app, cookie)
+
+    serializer = interface.get_signing_serializer(app)
+    max_age = int(app.permanent_session_lifetime.total_seconds())
+    try:
+        return serializer.loads(cookie, max_age=max_age).get(CURR_USER_KEY)
+    except BadSignature:
+        return None
+
+
+def login_cookie(app, user_id):
+    """ A session cookie value that logs user_id in, for either kind of
+        session -- for tools that talk to a running server (replay.py). With
+        server-side sessions the session is written to the store, so the
+        server has to share it (SESSION_STORE sqlite or file, same path).
+    """
+
+    interface = app.session_interface
+    if not isinstance(interface, ServerSessionInterface):
+        return interface.get_signing_serializer(app).dumps(
+            {CURR_USER_KEY: user_id})
+
+    # no snapshot: the first request loads the user and keeps one
+    session = ServerSession()
+    interface.store.put(session.sid, {CURR_USER_KEY: user_id}, None,
+                        interface.ttl)
+    return interface.signer(app).sign(session.sid.encode()).decode()
+
+
+def init_sessions(app):
+    app.config.setdefault("SESSION_STORE", "sqlite")
+    app.config.setdefault("SESSION_PATH", None)
+    app.config.setdefault("SESSION_TTL", 14 * 24 * 3600)
+
+    kind = app.config["SESSION_STORE"]
+    if kind == "cookie":
+        return None
+
+    path = app.config["SESSION_PATH"]
+    if path is None and kind != "memory":
+        # one store per database, in the instance folder: only this app's
+        # user can read it, unlike a name anyone can guess in /tmp
+        uri = app.config["SQLALCHEMY_DATABASE_URI"].encode()
+        os.makedirs(app.instance_path, mode=0o700, exist_ok=True)
+        path = os.path.join(app.instance_path, "sessions-"
+                            f"{hashlib.blake2b(uri, digest_size=6).hexdigest()}"
+                            + (".db" if kind == "sqlite" else ""))
+
+    if kind == "memory":
+        store = MemoryStore()
+    elif kind == "file":
+        store = FileStore(path)
+    elif kind == "sqlite":
+        store = SQLiteStore(path)
+    else:
+        raise ValueError(f"unknown SESSION_STORE '{kind}'")
+
+    app.session_interface = ServerSessionInterface(store,
+                                                   app.config["SESSION_TTL"])
+    return store
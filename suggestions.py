@@ -0,0 +1,50 @@
+"""Reading the precomputed follow suggestions.
+
+followgraph.py writes them offline; this is the cheap side the pages use.
+Between runs a user may follow a suggestion, or a suggested account may be
+deleted, so those are filtered out here rather than waiting for the next
+run.
+"""
+
+from collections import namedtuple
+
+from sqlalchemy import and_, exists
+
+from models import db, User, Follows, FollowSuggestion
+
+# score: how many of the users you follow follow them; followed_by: a few of
+#  their usernames
+Suggestion = namedtuple("Suggestion", [
+    "id", "username", "image_url", "score", "followed_by"])
+
+
+def follow_suggestions(user_id, limit=3):
+    """ The best `limit` suggestions for user_id, in two queries: the
+        suggestions and the usernames of their mutual follows.
+    """
+
+    already_following = exists().where(and_(
+        Follows.user_following_id == user_id,
+        Follows.user_being_followed_id == FollowSuggestion.suggested_id))
+
+    rows = (db.session.query(User.id, User.username, User.image_url,
+                             FollowSuggestion.score, FollowSuggestion.mutual_ids)
+            .join(FollowSuggestion, FollowSuggestion.suggested_id == User.id)
+            .filter(FollowSuggestion.user_id == user_id,
+                    User.deleted_at.is_(None),
+                    ~already_following)
+            .order_by(FollowSuggestion.rank)
+            .limit(limit)
+            .all())
+
+    mutual_ids = {mutual_id for row in rows for mutual_id in row.mutual_ids}
+    usernames = {}
+    if mutual_ids:
+        usernames = dict(db.session.query(User.id, User.username)
+                         .filter(User.id.in_(mutual_ids),
+                                 User.deleted_at.is_(None)))
+
+    return [Suggestion(row.id, row.username, row.image_url, row.score,
+                       [usernames[mutual_id] for mutual_id in row.mutual_ids
+                        if mutual_id in usernames])
+            for row in rows]
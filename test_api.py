@@ -0,0 +1,116 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_api.py
+
+
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+from app import create_app, CURR_USER_KEY
+
+# Build the app against the test database. create_app() takes the settings
+# directly, so nothing has to be set in the environment first.
+
+app = create_app({"SQLALCHEMY_DATABASE_URI": "postgresql:///warbler-test"})
+
+db.create_all()
+
+
+class APITestCase(TestCase):
+    """Test the /api/v1 endpoints."""
+
+    def setUp(self):
+        """Two users, testuser follows author who has 5 messages."""
+
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.client = app.test_client()
+
+        testuser = User(username="apiuser", email="api@test.com",
+                        password="HASHED_PASSWORD")
+        author = User(username="apiauthor", email="author@test.com",
+                      password="HASHED_PASSWORD")
+        db.session.add_all([testuser, author])
+        db.session.commit()
+        self.testuser_id = testuser.id
+        self.author_id = author.id
+
+        db.session.add(Follows(user_being_followed_id=author.id,
+                               user_following_id=testuser.id))
+        for i in range(5):
+            db.session.add(Message(text=f"api message {i}", user_id=author.id))
+        db.session.commit()
+
+    def login(self, client):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.testuser_id
+
+    def test_feed_pages(self):
+        """ Does the feed page with cursors and honor sparse fieldsets? """
+
+        with self.client as client:
+            self.login(client)
+
+            resp = client.get("/api/v1/feed?limit=2&fields=id,text")
+            self.assertEqual(resp.status_code, 200)
+            page = resp.get_json()
+            self.assertEqual(len(page["data"]), 2)
+            self.assertEqual(set(page["data"][0]), {"id", "text"}, "only the requested fields")
+
+            seen = [msg["id"] for msg in page["data"]]
+            while page["next"]:
+                page = client.get(
+                    f"/api/v1/feed?limit=2&fields=id&cursor={page['next']}").get_json()
+                seen.extend(msg["id"] for msg in page["data"])
+
+            self.assertEqual(len(seen), 5, "every message exactly once")
+            self.assertEqual(len(set(seen)), 5)
+
+    def test_etag_revalidation(self):
+        """ Does If-None-Match with the current ETag get a 304? """
+
+        with self.client as client:
+            self.login(client)
+
+            resp = client.get(f"/api/v1/users/{self.author_id}/messages")
+            etag = resp.headers["ETag"]
+
+            resp = client.get(f"/api/v1/users/{self.author_id}/messages",
+                              headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
+
+    def test_access_rules(self):
+        """ Same rules as the HTML pages: login for the feed, own likes only. """
+
+        self.assertEqual(self.client.get("/api/v1/feed").status_code, 401)
+
+        with self.client as client:
+            self.login(client)
+            resp = client.get(f"/api/v1/users/{self.author_id}/likes")
+            self.assertEqual(resp.status_code, 403)
+            resp = client.get("/api/v1/feed?fields=password")
+            self.assertEqual(resp.status_code, 400, "password is not a field")
+
+    def test_likes_skip_deleted_authors(self):
+        """ Are a deleted author's messages left out of the likes listing? """
+
+        for msg in Message.query.all()[:2]:
+            db.session.add(Likes(user_id=self.testuser_id, message_id=msg.id))
+        User.query.filter_by(id=self.author_id).update(
+            {"deleted_at": db.func.now()}, synchronize_session=False)
+        db.session.commit()
+
+        with self.client as client:
+            self.login(client)
+            resp = client.get(f"/api/v1/users/{self.testuser_id}/likes")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()["data"], [])
@@ -0,0 +1,237 @@
+"""ASGI entry point tests, with a stand-in for the asyncpg pool."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_asgi.py
+
+
+import asyncio
+import json
+from datetime import datetime
+from unittest import TestCase
+
+from asgiref.testing import ApplicationCommunicator
+
+from models import db
+
+from app import create_app
+from asgi import WarblerASGI, AsyncReads, flask_app
+from sessions import login_cookie
+
+# Build the app against the test database.
+
+app = create_app({"SQLALCHEMY_DATABASE_URI": "postgresql:///warbler-test",
+                  "RATE_LIMITS": {}})
+
+db.create_all()
+
+
+class Row(tuple):
+    """An asyncpg Record: values in order, and by column name."""
+
+    def __new__(cls, **columns):
+        row = super().__new__(cls, columns.values())
+        row.columns = columns
+        return row
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.columns[key]
+        return super().__getitem__(key)
+
+    def keys(self):
+        return self.columns.keys()
+
+
+class FakeConnection:
+    """Answers the queries asgi.py sends, and records them."""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def fetch(self, sql, *args):
+        self.pool.queries.append(sql)
+        self.pool.args.append(args)
+        if "FROM likes WHERE" in sql:
+            return [Row(message_id=7)]
+        if "FROM users u WHERE u.id" in sql:
+            return [Row(id=1, username="asyncuser", image_url=None,
+                        header_image_url=None, bio=None, location=None)]
+        if "count(*)" in sql:
+            return [Row(messages=1, following=0, followers=1, likes=0)]
+        if "FROM messages m" in sql:
+            return [Row(id=7, text="async warble",
+                        timestamp=datetime(2024, 1, 2, 3, 4, 5), user_id=1,
+                        username="asyncuser", image_url=None,
+                        sort_ts=datetime(2024, 1, 2, 3, 4, 5), sort_id=7)]
+        return []
+
+    async def fetchval(self, sql, *args):
+        self.pool.queries.append(sql)
+        self.pool.args.append(args)
+        return 1
+
+
+class FakePool:
+    def __init__(self):
+        self.queries = []
+        self.args = []
+        self.closed = False
+
+    def acquire(self):
+        pool = self
+
+        class Acquired:
+            async def __aenter__(self):
+                return FakeConnection(pool)
+
+            async def __aexit__(self, *exc):
+                return False
+
+        return Acquired()
+
+    async def close(self):
+        self.closed = True
+
+
+def request(asgi_app, path, headers=()):
+    """(status, headers, body) of a GET through the ASGI app."""
+
+    async def run():
+        scope = {"type": "http", "method": "GET", "path": path,
+                 "raw_path": path.encode(), "root_path": "",
+                 "scheme": "http", "query_string": b"",
+                 "headers": [(b"host", b"localhost"), *headers],
+                 "server": ("localhost", 80), "client": ("127.0.0.1", 1234),
+                 "http_version": "1.1", "asgi": {"version": "3.0"}}
+        communicator = ApplicationCommunicator(asgi_app, scope)
+        await communicator.send_input({"type": "http.request", "body": b""})
+
+        start = await communicator.receive_output(10)
+        body = b""
+        while True:
+            message = await communicator.receive_output(10)
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        return start["status"], dict(start["headers"]), body
+
+    return asyncio.run(run())
+
+
+class ASGITestCase(TestCase):
+    """The async routes against the fake pool, the rest through Flask."""
+
+    def setUp(self):
+        self.asgi = WarblerASGI(app)
+        self.pool = FakePool()
+        self.asgi.reads = AsyncReads("postgresql:///fake", app.config)
+        self.asgi.reads.pool = self.pool
+
+    def test_async_route(self):
+        """ Is /api/v1/users/<id>/messages answered from the pool as JSON? """
+
+        status, headers, body = request(self.asgi, "/api/v1/users/1/messages")
+
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b"content-type"], b"application/json")
+        payload = json.loads(body)
+        self.assertEqual(payload["data"][0]["text"], "async warble")
+        self.assertEqual(payload["data"][0]["username"], "asyncuser")
+        self.assertIsNone(payload["next"])
+        self.assertEqual(len(self.pool.queries), 2)
+
+    def test_etag(self):
+        """ Does a matching If-None-Match get a 304? """
+
+        status, headers, body = request(self.asgi, "/api/v1/users/1/messages")
+        status, _, body = request(self.asgi, "/api/v1/users/1/messages",
+                                  [(b"if-none-match", headers[b"etag"])])
+
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b"")
+
+    def login(self):
+        # the session as asgi.py reads it: its own app's
+        cookie = login_cookie(flask_app, 3)
+        return [(b"cookie",
+                 f"{flask_app.session_cookie_name}={cookie}".encode())]
+
+    def test_feed_likes_of_page(self):
+        """ Are the viewer's likes asked for the page's messages only? """
+
+        status, _, body = request(self.asgi, "/api/v1/feed", self.login())
+
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)["liked"], [7])
+
+        likes = [(sql, args) for sql, args in zip(self.pool.queries, self.pool.args)
+                 if "FROM likes" in sql]
+        self.assertEqual(len(likes), 1)
+        self.assertIn("ANY($2", likes[0][0])
+        self.assertEqual(likes[0][1], (3, [7]))
+
+    def test_profile_one_follow_row(self):
+        """ Is the viewer's follow looked up as one row, not all of them? """
+
+        status, _, body = request(self.asgi, "/api/v1/users/1", self.login())
+
+        self.assertEqual(status, 200)
+        payload = json.loads(body)
+        self.assertTrue(payload["is_following"])
+        self.assertEqual(payload["liked"], [7])
+
+        follows = [(sql, args) for sql, args in zip(self.pool.queries, self.pool.args)
+                   if "FROM follows WHERE user_following_id = $1 AND" in sql]
+        self.assertEqual(len(follows), 1)
+        self.assertIn("EXISTS", follows[0][0])
+        self.assertEqual(follows[0][1], (3, 1))
+
+    def test_login_required(self):
+        """ Is the feed refused without a session? """
+
+        status, _, body = request(self.asgi, "/api/v1/feed")
+
+        self.assertEqual(status, 401)
+        self.assertEqual(json.loads(body), {"error": "login required"})
+
+    def test_falls_through_to_flask(self):
+        """ Does a path without an async handler go to the Flask app? """
+
+        status, headers, body = request(self.asgi, "/signup")
+
+        self.assertEqual(status, 200)
+        self.assertIn(b"text/html", headers[b"content-type"])
+        self.assertIn(b"<form", body)
+        self.assertEqual(self.pool.queries, [])
+
+        status, _, _ = request(self.asgi, "/no/such/page")
+        self.assertEqual(status, 404)
+        self.assertEqual(self.pool.queries, [])
+
+    def test_no_postgres(self):
+        """ Off Postgres, does even an async path go to Flask? """
+
+        asgi_app = WarblerASGI(app)
+        if asgi_app.reads is not None:
+            self.skipTest("the test database is Postgres")
+
+        status, headers, _ = request(asgi_app, "/api/v1/users/0")
+        self.assertEqual(status, 404)
+        self.assertEqual(headers[b"content-type"], b"application/json")
+
+    def test_lifespan(self):
+        """ Is the pool closed at shutdown? """
+
+        async def run():
+            communicator = ApplicationCommunicator(
+                self.asgi, {"type": "lifespan", "asgi": {"version": "3.0"}})
+            await communicator.send_input({"type": "lifespan.startup"})
+            started = await communicator.receive_output(5)
+            await communicator.send_input({"type": "lifespan.shutdown"})
+            stopped = await communicator.receive_output(5)
+            return started["type"], stopped["type"]
+
+        self.assertEqual(asyncio.run(run()), ("lifespan.startup.complete",
+                                              "lifespan.shutdown.complete"))
+        self.assertTrue(self.pool.closed)
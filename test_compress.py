@@ -0,0 +1,248 @@
+"""Response compression and streamed page tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_compress.py
+
+
+import gzip
+import time
+import zlib
+from unittest import TestCase, skipUnless
+
+
+from models import db, User, Message, Follows, Likes
+
+from app import create_app
+from compress import CompressionMiddleware, choose_encoding, brotli
+
+# Build the app against the test database.
+
+app = create_app({"SQLALCHEMY_DATABASE_URI": "postgresql:///warbler-test",
+                  "RATE_LIMITS": {},
+                  "COMPRESS_MIN_SIZE": 200})
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+PAGE = "<p>warble</p>" * 100
+
+
+def wsgi(status="200 OK", content_type="text/html", chunks=(PAGE,),
+         headers=()):
+    """A plain WSGI app answering with chunks."""
+
+    def app(environ, start_response):
+        start_response(status, [("Content-Type", content_type), *headers])
+        return [chunk.encode() for chunk in chunks]
+
+    return app
+
+
+def call(app, accept="gzip"):
+    """(status, headers, body chunks) of a GET through app."""
+
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = status
+        response["headers"] = dict(headers)
+
+    environ = {"REQUEST_METHOD": "GET", "HTTP_ACCEPT_ENCODING": accept}
+    chunks = list(app(environ, start_response))
+    return response["status"], response["headers"], chunks
+
+
+class NegotiationTestCase(TestCase):
+    """Accept-Encoding parsing."""
+
+    def test_choose(self):
+        """ Is the preferred encoding picked, and q=0 refused? """
+
+        self.assertEqual(choose_encoding("gzip, deflate"), "gzip")
+        self.assertIsNone(choose_encoding("identity"))
+        self.assertIsNone(choose_encoding(None))
+        self.assertIsNone(choose_encoding("gzip;q=0"))
+        self.assertEqual(choose_encoding("*"),
+                         "br" if brotli is not None else "gzip")
+
+    @skipUnless(brotli, "needs the brotli package")
+    def test_choose_brotli(self):
+        """ Does br win a tie, but not a lower q? """
+
+        self.assertEqual(choose_encoding("gzip, deflate, br"), "br")
+        self.assertEqual(choose_encoding("gzip, br;q=0.5"), "gzip")
+
+
+class MiddlewareTestCase(TestCase):
+    """The middleware around plain WSGI apps."""
+
+    def test_gzip(self):
+        """ Is a large page gzipped, with Vary and no Content-Length? """
+
+        status, headers, chunks = call(CompressionMiddleware(
+            wsgi(headers=[("Content-Length", str(len(PAGE))),
+                          ("ETag", '"abc"')]), min_size=200))
+
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        self.assertEqual(headers["Vary"], "Accept-Encoding")
+        self.assertEqual(headers["ETag"], 'W/"abc"')
+        self.assertNotIn("Content-Length", headers)
+        body = b"".join(chunks)
+        self.assertLess(len(body), len(PAGE))
+        self.assertEqual(gzip.decompress(body).decode(), PAGE)
+
+    @skipUnless(brotli, "needs the brotli package")
+    def test_brotli(self):
+        """ Does a client that takes br get br? """
+
+        status, headers, chunks = call(CompressionMiddleware(
+            wsgi(), min_size=200), accept="br, gzip")
+
+        self.assertEqual(headers["Content-Encoding"], "br")
+        self.assertEqual(brotli.decompress(b"".join(chunks)).decode(), PAGE)
+
+    def test_passed_through(self):
+        """ Are small bodies, images, event streams and refusals left alone? """
+
+        cases = [
+            (wsgi(chunks=["<p>hi</p>"]), "gzip"),
+            (wsgi(content_type="image/png"), "gzip"),
+            (wsgi(content_type="text/event-stream"), "gzip"),
+            (wsgi(), "identity"),
+            (wsgi(status="304 NOT MODIFIED", chunks=()), "gzip"),
+        ]
+        for app, accept in cases:
+            status, headers, chunks = call(CompressionMiddleware(
+                app, min_size=200), accept)
+            self.assertNotIn("Content-Encoding", headers)
+
+        status, headers, chunks = call(CompressionMiddleware(
+            wsgi(), min_size=200, level=0))
+        self.assertNotIn("Content-Encoding", headers)
+
+    def test_event_stream_unbuffered(self):
+        """ Do an event stream's headers and first event go out at once? """
+
+        def events():
+            yield b"retry: 3000\n\n"
+            raise AssertionError("read past the first event")
+
+        def sse(environ, start_response):
+            start_response("200 OK", [("Content-Type", "text/event-stream")])
+            return events()
+
+        response = {}
+        body = CompressionMiddleware(sse, min_size=200)(
+            {"REQUEST_METHOD": "GET", "HTTP_ACCEPT_ENCODING": "gzip"},
+            lambda status, headers, exc_info=None: response.update(
+                headers=dict(headers)))
+
+        self.assertEqual(next(body), b"retry: 3000\n\n")
+        self.assertNotIn("Content-Encoding", response["headers"])
+        body.close()
+
+    def test_streamed(self):
+        """ Does a streamed body go out in pieces that decompress together? """
+
+        parts = ["<head>" + "x" * 300 + "</head>"] + [PAGE] * 20
+        status, headers, chunks = call(CompressionMiddleware(
+            wsgi(chunks=parts), min_size=200))
+
+        # the head is flushed on its own, before the rest
+        self.assertGreater(len(chunks), 1)
+        decompressor = zlib.decompressobj(31)
+        self.assertIn(b"<head>", decompressor.decompress(chunks[0]))
+        rest = decompressor.decompress(b"".join(chunks[1:]))
+        self.assertEqual(rest.decode(), "".join(parts)[len(parts[0]):])
+
+
+class CompressedAppTestCase(TestCase):
+    """The middleware and stream_template in the app."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        for i in range(30):
+            User.signup(username=f"compressed{i}", email=f"c{i}@test.com",
+                        password="testuser", image_url=None)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, client):
+        return client.post("/login", data={"username": "compressed0",
+                                           "password": "testuser"})
+
+    def test_users_page(self):
+        """ Is /users streamed, gzipped, and whole once decompressed? """
+
+        with app.test_client() as client:
+            self.login(client)
+            # the login flash, out of the way
+            client.get("/")
+
+            resp = client.get("/users", headers={"Accept-Encoding": "gzip"},
+                              buffered=False)
+            self.assertTrue(resp.is_streamed)
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+
+            html = gzip.decompress(resp.get_data()).decode()
+            self.assertIn("@compressed29", html)
+            self.assertTrue(html.rstrip().endswith("</html>"))
+
+            plain = client.get("/users").get_data(as_text=True)
+            self.assertEqual(plain, html)
+
+    def test_message_stream(self):
+        """ Does /api/v1/stream/messages send its first event straight away? """
+
+        with app.test_client() as client:
+            self.login(client)
+
+            started = time.monotonic()
+            resp = client.get("/api/v1/stream/messages",
+                              headers={"Accept-Encoding": "gzip"},
+                              buffered=False)
+            first = next(iter(resp.response))
+            resp.close()
+
+        # well before the first keepalive would have filled the buffer
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(resp.headers["Content-Type"], "text/event-stream; charset=utf-8")
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertIn(b"retry:", first)
+
+    def test_flash_on_streamed_page(self):
+        """ Does a flash show on a streamed page, once? """
+
+        with app.test_client() as client:
+            self.login(client)
+            user = User.query.filter_by(username="compressed0").one()
+
+            html = client.get(f"/users/{user.id}").get_data(as_text=True)
+            self.assertIn("Hello, compressed0!", html)
+            html = client.get(f"/users/{user.id}").get_data(as_text=True)
+            self.assertNotIn("Hello, compressed0!", html)
+
+    def test_api_etag(self):
+        """ Does a compressed API response still answer If-None-Match? """
+
+        with app.test_client() as client:
+            self.login(client)
+            user = User.query.filter_by(username="compressed0").one()
+            resp = client.get(f"/api/v1/users/{user.id}",
+                              headers={"Accept-Encoding": "gzip"})
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+            etag = resp.headers["ETag"]
+            self.assertTrue(etag.startswith("W/"))
+
+            again = client.get(f"/api/v1/users/{user.id}",
+                               headers={"Accept-Encoding": "gzip",
+                                        "If-None-Match": etag})
+            self.assertEqual(again.status_code, 304)
@@ -0,0 +1,110 @@
+"""Account export tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_export.py
+
+
+import csv
+import io
+import json
+import zipfile
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+from app import create_app, CURR_USER_KEY
+from export import export_archive
+
+# Build the app against the test database.
+
+app = create_app({"SQLALCHEMY_DATABASE_URI": "postgresql:///warbler-test",
+                  "RATE_LIMITS": {}})
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ExportTestCase(TestCase):
+    """Test the export zip and the /users/export download."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.owner = User.signup(username="owner", email="owner@test.com",
+                                 password="testuser", image_url=None)
+        self.friend = User.signup(username="friend", email="friend@test.com",
+                                  password="testuser", image_url=None)
+        db.session.commit()
+
+        for i in range(5):
+            self.owner.messages.append(Message(text=f"warble {i}"))
+        liked = Message(text="worth a like")
+        self.friend.messages.append(liked)
+        self.owner.following.append(self.friend)
+        db.session.commit()
+
+        db.session.add(Likes(user_id=self.owner.id, message_id=liked.id))
+        db.session.commit()
+
+        self.owner_id = self.owner.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_archive(self):
+        """ Is every file there, complete across chunk boundaries? """
+
+        with app.app_context():
+            chunks = list(export_archive(self.owner_id, chunk_size=2))
+
+        archive = zipfile.ZipFile(io.BytesIO(b"".join(chunks)))
+        self.assertEqual(archive.namelist(),
+                         ["profile.json", "messages.ndjson", "likes.ndjson",
+                          "following.ndjson", "followers.ndjson"])
+        self.assertIsNone(archive.testzip())
+
+        profile = json.loads(archive.read("profile.json"))
+        self.assertEqual(profile["username"], "owner")
+        self.assertNotIn("password", profile)
+
+        messages = [json.loads(line) for line in
+                    archive.read("messages.ndjson").decode().splitlines()]
+        self.assertEqual([msg["text"] for msg in messages],
+                         [f"warble {i}" for i in range(5)])
+
+        likes = json.loads(archive.read("likes.ndjson"))
+        self.assertEqual((likes["text"], likes["author"]),
+                         ("worth a like", "friend"))
+        self.assertEqual(json.loads(archive.read("following.ndjson"))["username"],
+                         "friend")
+        self.assertEqual(archive.read("followers.ndjson"), b"")
+
+        # the zip went out in pieces, not in one piece at the end
+        self.assertGreater(len([chunk for chunk in chunks if chunk]), 5)
+
+    def test_download_csv(self):
+        """ Does the view stream a CSV export of the logged in user? """
+
+        with app.test_client() as client:
+            resp = client.get("/users/export?format=csv")
+            self.assertEqual(resp.status_code, 302)
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.owner_id
+
+            resp = client.get("/users/export?format=csv")
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(resp.is_streamed)
+            self.assertIn("warbler-owner-", resp.headers["Content-Disposition"])
+
+            archive = zipfile.ZipFile(io.BytesIO(resp.get_data()))
+
+        rows = list(csv.reader(io.StringIO(
+            archive.read("messages.csv").decode())))
+        self.assertEqual(rows[0], ["id", "text", "timestamp"])
+        self.assertEqual(len(rows), 6)
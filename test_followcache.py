@@ -0,0 +1,167 @@
+"""Follow cache tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_followcache.py
+
+
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+from app import create_app, CURR_USER_KEY
+from followcache import FollowCache, entry_size
+
+# Build the app against the test database.
+
+app = create_app({"SQLALCHEMY_DATABASE_URI": "postgresql:///warbler-test",
+                  "RATE_LIMITS": {}})
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FollowCacheUnitTestCase(TestCase):
+    """The cache alone, with a dict for a database."""
+
+    def setUp(self):
+        self.follows = {1: [2, 3], 2: [1], 3: list(range(100, 200))}
+        self.loads = []
+
+        def loader(user_id):
+            self.loads.append(user_id)
+            return self.follows.get(user_id, [])
+
+        self.loader = loader
+
+    def test_membership(self):
+        """ Are lookups answered from one load per user? """
+
+        cache = FollowCache(1 << 20, 60, self.loader)
+
+        self.assertTrue(cache.is_following(1, 3))
+        self.assertFalse(cache.is_following(1, 4))
+        self.assertTrue(cache.is_following(3, 150))
+        self.assertFalse(cache.is_following(4, 1))
+        self.assertEqual(self.loads, [1, 3, 4])
+
+    def test_apply(self):
+        """ Do committed changes update cached users and skip the others? """
+
+        cache = FollowCache(1 << 20, 60, self.loader)
+        cache.following(1)
+
+        cache.apply([(1, 5, "add"), (1, 2, "remove"), (2, 3, "add")])
+
+        self.assertEqual(list(cache.following(1)), [3, 5])
+        self.assertEqual(self.loads, [1])
+
+    def test_budget(self):
+        """ Are the least recently used users evicted to stay in budget? """
+
+        budget = entry_size(cache_array([2, 3])) * 2 + 10
+        cache = FollowCache(budget, 60, self.loader)
+
+        cache.following(1)
+        cache.following(2)
+        cache.following(1)
+        cache.following(4)      # evicts 2, the coldest
+
+        self.assertLessEqual(cache.bytes, budget)
+        self.assertEqual(list(cache.entries), [1, 4])
+        self.assertEqual(cache.counts["evictions"], 1)
+
+    def test_racing_change(self):
+        """ Is a load that raced a change used once but not stored? """
+
+        cache = FollowCache(1 << 20, 60, None)
+
+        def loader(user_id):
+            cache.apply([(user_id, 9, "add")])
+            return [2]
+
+        cache.loader = loader
+        cache.following(1)
+        self.assertNotIn(1, cache.entries)
+
+
+def cache_array(ids):
+    from array import array
+    return array("i", ids)
+
+
+class FollowCacheTestCase(TestCase):
+    """Test that follows made through the app keep the cache current."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.fan = User.signup(username="fan", email="fan@test.com",
+                               password="testuser", image_url=None)
+        self.star = User.signup(username="star", email="star@test.com",
+                                password="testuser", image_url=None)
+        db.session.commit()
+
+        self.fan_id = self.fan.id
+        self.star_id = self.star.id
+        self.cache = app.extensions["follow_cache"]
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_follow_views(self):
+        """ Do follow and unfollow update the cached followees in place? """
+
+        with app.app_context():
+            self.assertFalse(self.cache.is_following(self.fan_id, self.star_id))
+            misses = self.cache.counts["misses"]
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.fan_id
+
+            client.post(f"/users/follow/{self.star_id}")
+            with app.app_context():
+                self.assertTrue(self.cache.is_following(self.fan_id,
+                                                        self.star_id))
+
+            client.post(f"/users/stop-following/{self.star_id}")
+            with app.app_context():
+                self.assertFalse(self.cache.is_following(self.fan_id,
+                                                         self.star_id))
+
+        self.assertEqual(self.cache.counts["misses"], misses)
+
+    def test_other_worker(self):
+        """ Does a change published by another process reach the cache? """
+
+        with app.app_context():
+            self.cache.following(self.fan_id)
+
+        app.extensions["pubsub"].dispatch(
+            {"type": "follow", "pid": -1,
+             "changes": [[self.fan_id, self.star_id, "add"]]})
+
+        with app.app_context():
+            self.assertTrue(self.fan.is_following(self.star))
+            self.assertTrue(self.star.is_followed_by(self.fan))
+
+    def test_bulk_delete(self):
+        """ Does a bulk delete of follows clear the cache? """
+
+        db.session.add(Follows(user_following_id=self.fan_id,
+                               user_being_followed_id=self.star_id))
+        db.session.commit()
+
+        with app.app_context():
+            self.assertTrue(self.cache.is_following(self.fan_id, self.star_id))
+
+            Follows.query.delete()
+            db.session.commit()
+
+            self.assertFalse(self.cache.is_following(self.fan_id, self.star_id))
@@ -0,0 +1,155 @@
+"""Follow graph and suggestion tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_followgraph.py
+
+
+import os
+import random
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from models import db, User, Message, Follows, Likes, FollowSuggestion
+
+from app import create_app, CURR_USER_KEY
+from followgraph import FollowGraph, changed_followers, refresh
+from suggestions import follow_suggestions
+
+# Build the app against the test database.
+
+app = create_app({"SQLALCHEMY_DATABASE_URI": "postgresql:///warbler-test",
+                  "RATE_LIMITS": {}})
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FollowGraphTestCase(TestCase):
+    """ The arrays alone, no database.
+
+        1 follows 2 and 3; 2 follows 4 and 5; 3 follows 4 and 1; 5 follows 6.
+    """
+
+    edges = [(1, 2), (1, 3), (2, 4), (2, 5), (3, 4), (3, 1), (5, 6)]
+
+    def test_suggest(self):
+        """ Are friends of friends ranked by overlap, without known users? """
+
+        graph = FollowGraph(self.edges)
+
+        # 4 is followed by 2 and 3, 5 only by 2; 1 itself and 2, 3 are out
+        self.assertEqual(graph.suggest(1), [(4, 2, [2, 3]), (5, 1, [2])])
+        self.assertEqual(graph.suggest(1, k=1), [(4, 2, [2, 3])])
+        self.assertEqual(graph.suggest(6), [])
+        self.assertEqual(graph.suggest(99), [])
+
+    def test_ties_by_id(self):
+        """ Among candidates tied at the k-th score, do the lowest ids win? """
+
+        # 1 follows 2 and 3; 2 follows 200 users, 3 follows 30 of them
+        users = list(range(100, 300))
+        random.Random(0).shuffle(users)
+        graph = FollowGraph([(1, 2), (1, 3)] + [(2, user) for user in users]
+                            + [(3, user) for user in users[:30]])
+
+        self.assertEqual([user for user, _, _ in graph.suggest(1, k=40)],
+                         sorted(users[:30]) + sorted(users[30:])[:10])
+
+    def test_affected(self):
+        """ Does a new follow recompute the follower and their followers? """
+
+        old = np.array(sorted((a << 32) | b for a, b in self.edges))
+        new = np.array(sorted((a << 32) | b for a, b in self.edges + [(5, 4)]))
+        graph = FollowGraph(self.edges + [(5, 4)])
+
+        changed = changed_followers(old, new)
+        self.assertEqual(list(changed), [5])
+        self.assertEqual(list(graph.affected_by(changed)), [2, 5])
+
+
+class SuggestionTestCase(TestCase):
+    """Test the job against the database and the pages that show its results."""
+
+    def setUp(self):
+        FollowSuggestion.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.users = {}
+        for name in ("ann", "bob", "cat", "dan", "eve"):
+            self.users[name] = User.signup(username=name,
+                                           email=f"{name}@test.com",
+                                           password="testuser",
+                                           image_url=None)
+        db.session.commit()
+        self.ids = {name: user.id for name, user in self.users.items()}
+
+        for follower, followed in (("ann", "bob"), ("ann", "cat"),
+                                   ("bob", "dan"), ("cat", "dan"),
+                                   ("bob", "eve")):
+            db.session.add(Follows(user_following_id=self.ids[follower],
+                                   user_being_followed_id=self.ids[followed]))
+        db.session.commit()
+
+        self.snapshot = os.path.join(tempfile.mkdtemp(), "graph.npy")
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, client, name):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.ids[name]
+
+    def test_refresh_and_serve(self):
+        """ Are the stored suggestions served, minus users followed since? """
+
+        refresh(self.snapshot)
+
+        suggestions = follow_suggestions(self.ids["ann"])
+        self.assertEqual([(s.username, s.score, s.followed_by)
+                          for s in suggestions],
+                         [("dan", 2, ["bob", "cat"]), ("eve", 1, ["bob"])])
+
+        with app.test_client() as client:
+            self.login(client, "ann")
+            html = client.get("/").get_data(as_text=True)
+            self.assertIn("Who to follow", html)
+            self.assertIn("@dan", html)
+
+            client.post(f"/users/follow/{self.ids['dan']}")
+
+        self.assertEqual([s.username for s in follow_suggestions(self.ids["ann"])],
+                         ["eve"])
+
+    def test_incremental(self):
+        """ Does a run with a snapshot only recompute the affected users? """
+
+        refresh(self.snapshot)
+
+        db.session.add(Follows(user_following_id=self.ids["cat"],
+                               user_being_followed_id=self.ids["eve"]))
+        db.session.commit()
+
+        _, recomputed = refresh(self.snapshot)
+        self.assertEqual(recomputed, 2)  # cat and ann, who follows cat
+
+        eve = [s for s in follow_suggestions(self.ids["ann"])
+               if s.username == "eve"][0]
+        self.assertEqual((eve.score, eve.followed_by), (2, ["bob", "cat"]))
+
+    def test_known_followers(self):
+        """ Does a profile show which of the viewer's follows follow them? """
+
+        with app.test_client() as client:
+            self.login(client, "ann")
+            html = client.get(f"/users/{self.ids['dan']}").get_data(as_text=True)
+
+        self.assertIn('id="known-followers"', html)
+        self.assertIn("@bob", html)
+        self.assertIn("@cat", html)
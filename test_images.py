@@ -0,0 +1,251 @@
+"""Image thumbnail tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_images.py
+
+
+import io
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+
+from flask import Flask
+
+from models import db, User, Message, Follows, Likes
+
+from app import create_app
+import images
+from images import (ImageProxy, ImageError, SIZES, Image, fetch_url,
+                    init_images, thumbnail_url)
+
+# Build the app against the test database.
+
+cache_dir = tempfile.mkdtemp()
+
+app = create_app({"SQLALCHEMY_DATABASE_URI": "postgresql:///warbler-test",
+                  "RATE_LIMITS": {},
+                  "IMAGE_CACHE_DIR": cache_dir})
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def png(color="red", size=(300, 200)):
+    out = io.BytesIO()
+    Image.new("RGB", size, color).save(out, "PNG")
+    return out.getvalue()
+
+
+@skipUnless(Image, "thumbnails need Pillow")
+class ImageProxyTestCase(TestCase):
+    """The proxy alone, with a dict standing in for the web."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.web = {"http://a/one.png": png("red"),
+                    "http://b/same.png": png("red"),
+                    "http://a/bad.png": b"not an image"}
+        self.fetches = []
+
+        def fetch(url):
+            self.fetches.append(url)
+            if url not in self.web:
+                raise ImageError("404")
+            return self.web[url]
+
+        self.proxy = ImageProxy(self.dir, workers=2, fetch=fetch)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_sizes_and_fetch_once(self):
+        """ Is every size made from one fetch, at the right dimensions? """
+
+        for size, dimensions in SIZES.items():
+            etag, data = self.proxy.thumbnail("http://a/one.png", size)
+            self.assertEqual(Image.open(io.BytesIO(data)).size, dimensions)
+
+        self.assertEqual(self.fetches, ["http://a/one.png"])
+
+    def test_content_addressed(self):
+        """ Do two URLs with the same picture share the thumbnail? """
+
+        first = self.proxy.thumbnail("http://a/one.png", "card")
+        second = self.proxy.thumbnail("http://b/same.png", "card")
+        self.assertEqual(first[0], second[0])
+
+    def test_errors(self):
+        """ Do bad images raise, and not get fetched again right away? """
+
+        for url in ("http://a/bad.png", "http://a/missing.png"):
+            with self.assertRaises(ImageError):
+                self.proxy.thumbnail(url, "card")
+            with self.assertRaises(ImageError):
+                self.proxy.thumbnail(url, "card")
+
+        self.assertEqual(self.fetches, ["http://a/bad.png",
+                                        "http://a/missing.png"])
+
+    def test_concurrent_misses(self):
+        """ Do simultaneous requests for a new image share one job? """
+
+        threads = [threading.Thread(target=self.proxy.thumbnail,
+                                    args=("http://a/one.png", "card"))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.fetches, ["http://a/one.png"])
+
+    def test_cache_dir(self):
+        """ Is the default cache in the instance folder, owner only, and a
+            directory someone else made refused?
+        """
+
+        bare = Flask(__name__, instance_path=self.dir + "/instance")
+        proxy = init_images(bare)
+        self.assertEqual(proxy.cache_dir, bare.instance_path + "/images")
+        self.assertEqual(stat.S_IMODE(os.stat(proxy.cache_dir).st_mode), 0o700)
+
+        with patch("os.getuid", return_value=os.getuid() + 1):
+            with self.assertRaises(PermissionError):
+                ImageProxy(proxy.cache_dir)
+
+
+class Origin(BaseHTTPRequestHandler):
+    """A local web server: /page is HTML, anything else a PNG."""
+
+    def do_GET(self):
+        body = b"<p>not a picture</p>" if self.path == "/page" else b"PNG"
+        self.send_response(200)
+        self.send_header("Content-Type",
+                         "text/html" if self.path == "/page" else "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchTestCase(TestCase):
+    """What the fetcher will and won't connect to."""
+
+    def setUp(self):
+        self.server = HTTPServer(("127.0.0.1", 0), Origin)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.origin = f"http://127.0.0.1:{self.server.server_port}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_private_hosts(self):
+        """ Are loopback, link-local and private hosts refused? """
+
+        for url in (self.origin + "/x.png", "http://localhost/x.png",
+                    "http://169.254.169.254/latest/meta-data/",
+                    "http://10.0.0.1/x.png", "http://192.168.1.1/x.png",
+                    "http://[::1]/x.png", "http://[::ffff:127.0.0.1]/x.png",
+                    "http://0.0.0.0/x.png", "file:///etc/passwd"):
+            with self.assertRaises(ImageError, msg=url):
+                fetch_url(url)
+
+    def test_checked_on_connect(self):
+        """ Is the address connected to checked, not just the URL? """
+
+        with self.assertRaises(ImageError):
+            images.public_connection(("127.0.0.1", self.server.server_port))
+
+    def test_redirects_checked(self):
+        """ Is a redirect to a private host refused? """
+
+        handler = images._PublicRedirectHandler()
+        request = urllib.request.Request("http://example.com/x.png")
+        for url in ("http://169.254.169.254/", "http://127.0.0.1/x.png",
+                    "file:///etc/passwd"):
+            with self.assertRaises(ImageError, msg=url):
+                handler.redirect_request(request, None, 302, "Found", {}, url)
+
+    def test_bad_urls(self):
+        """ Do URLs urllib can't parse raise ImageError, not ValueError? """
+
+        for url in ("http://a b.com/x.png", "http://host:abc/x.png"):
+            with self.assertRaises(ImageError, msg=url):
+                fetch_url(url)
+
+    def test_content_type(self):
+        """ Is an answer that isn't an image/* type refused? """
+
+        # the local server standing in for a public one
+        with patch.object(images, "public_address", lambda address: True):
+            self.assertEqual(fetch_url(self.origin + "/x.png"), b"PNG")
+            with self.assertRaises(ImageError):
+                fetch_url(self.origin + "/page")
+
+
+@skipUnless(Image, "thumbnails need Pillow")
+class ImageViewTestCase(TestCase):
+    """The filter in the templates and the /images route."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        User.signup(username="pictured", email="pictured@test.com",
+                    password="testuser", image_url=None)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_cards_use_thumbnails(self):
+        """ Do the user cards link signed thumbnails that serve and cache? """
+
+        with app.test_client() as client:
+            html = client.get("/users").get_data(as_text=True)
+            self.assertNotIn('src="/static/images/default-pic.png"', html)
+
+            start = html.index('/images/card/')
+            url = html[start:html.index('"', start)]
+
+            resp = client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, "image/jpeg")
+            self.assertIn("immutable", resp.headers["Cache-Control"])
+            self.assertEqual(Image.open(io.BytesIO(resp.data)).size,
+                             SIZES["card"])
+
+            again = client.get(url, headers={"If-None-Match": resp.headers["ETag"]})
+            self.assertEqual(again.status_code, 304)
+
+    def test_unfetchable_redirects(self):
+        """ Does a URL the fetcher refuses redirect to the original? """
+
+        for url in ("http://host:abc/x.png", "http://169.254.169.254/x.png"):
+            with app.test_request_context():
+                thumbnail = thumbnail_url(url, "card")
+
+            with app.test_client() as client:
+                resp = client.get(thumbnail)
+                self.assertEqual(resp.status_code, 302)
+                self.assertEqual(resp.location, url)
+
+    def test_forged_token(self):
+        """ Is a URL the app didn't sign turned away? """
+
+        with app.test_client() as client:
+            resp = client.get("/images/card/aHR0cDovL2V2aWwv.forged")
+            self.assertEqual(resp.status_code, 404)
@@ -0,0 +1,129 @@
+"""Like counter tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_likecounts.py
+
+
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, LikeCount
+
+from app import create_app, CURR_USER_KEY
+from likecounts import like_counts, rebuild, SHARDS
+from writebatch import apply_batch
+
+# Build the app against the test database.
+
+app = create_app({"SQLALCHEMY_DATABASE_URI": "postgresql:///warbler-test",
+                  "RATE_LIMITS": {}})
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class LikeCountTestCase(TestCase):
+    """Test likes by many users and the sharded counters behind the counts."""
+
+    def setUp(self):
+        LikeCount.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.author = User.signup(username="countauthor",
+                                  email="author@test.com",
+                                  password="testuser",
+                                  image_url=None)
+        # enough likers to land on more than one shard
+        self.likers = [User.signup(username=f"liker{i}",
+                                   email=f"liker{i}@test.com",
+                                   password="testuser",
+                                   image_url=None)
+                       for i in range(SHARDS + 2)]
+        db.session.commit()
+
+        msg = Message(text="popular warble", user_id=self.author.id)
+        other = Message(text="quiet warble", user_id=self.author.id)
+        db.session.add_all([msg, other])
+        db.session.commit()
+
+        self.author_id = self.author.id
+        self.liker_ids = [liker.id for liker in self.likers]
+        self.msg_id = msg.id
+        self.other_id = other.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def toggle_like(self, user_id, message_id):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            return client.post(f"/messages/{message_id}/likes/all")
+
+    def test_many_likers(self):
+        """ Can several users like one message, and is each counted? """
+
+        for liker_id in self.liker_ids:
+            self.toggle_like(liker_id, self.msg_id)
+
+        self.assertEqual(Likes.query.filter_by(message_id=self.msg_id).count(),
+                         len(self.liker_ids))
+        self.assertEqual(like_counts([self.msg_id, self.other_id]),
+                         {self.msg_id: len(self.liker_ids)})
+
+        # spread over the shards, not one hot row
+        self.assertEqual(LikeCount.query.filter_by(message_id=self.msg_id).count(),
+                         SHARDS)
+
+    def test_unlike(self):
+        """ Does unliking take the like back off the count? """
+
+        self.toggle_like(self.liker_ids[0], self.msg_id)
+        self.toggle_like(self.liker_ids[1], self.msg_id)
+        self.toggle_like(self.liker_ids[0], self.msg_id)
+
+        self.assertEqual(like_counts([self.msg_id]), {self.msg_id: 1})
+
+    def test_count_shown(self):
+        """ Is the count on the message page? """
+
+        for liker_id in self.liker_ids[:3]:
+            self.toggle_like(liker_id, self.msg_id)
+
+        with app.test_client() as client:
+            resp = client.get(f"/messages/{self.msg_id}")
+            html = resp.get_data(as_text=True)
+
+        self.assertIn('<i class="fa fa-thumbs-up"></i> 3', html)
+
+    def test_batched_likes(self):
+        """ Do batched likes and unlikes keep the counters right? """
+
+        apply_batch({("like", liker_id, self.msg_id): "add"
+                     for liker_id in self.liker_ids})
+        # already liked: no second count
+        apply_batch({("like", self.liker_ids[0], self.msg_id): "add",
+                     ("like", self.liker_ids[1], self.msg_id): "remove",
+                     ("like", self.liker_ids[2], self.other_id): "remove"})
+
+        self.assertEqual(like_counts([self.msg_id, self.other_id]),
+                         {self.msg_id: len(self.liker_ids) - 1})
+
+    def test_rebuild(self):
+        """ Does a recount match the likes table? """
+
+        for liker_id in self.liker_ids[:4]:
+            db.session.add(Likes(user_id=liker_id, message_id=self.msg_id))
+        db.session.add(Likes(user_id=self.liker_ids[0], message_id=self.other_id))
+        db.session.commit()
+
+        self.assertEqual(like_counts([self.msg_id]), {})
+
+        rebuild()
+        self.assertEqual(like_counts([self.msg_id, self.other_id]),
+                         {self.msg_id: 4, self.other_id: 1})
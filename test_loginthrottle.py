@@ -0,0 +1,119 @@
+"""Login throttle tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_loginthrottle.py
+
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User, Message, Follows, Likes
+
+from app import create_app
+from loginthrottle import LoginThrottle
+
+# Build the app against the test database, locking out after 3 failures
+
+app = create_app({"SQLALCHEMY_DATABASE_URI": "postgresql:///warbler-test",
+                  "LOGIN_MAX_FAILURES": 3,
+                  "RATE_LIMITS": {}})
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class LoginThrottleTestCase(TestCase):
+    """Test the failure counting and the lockouts."""
+
+    def test_exponential_lockout(self):
+        """ Does each lockout last twice as long as the one before? """
+
+        throttle = LoginThrottle(max_failures=2, window=60, lockout=10,
+                                 max_lockout=25)
+
+        throttle.failure("bob", "1.1.1.1", now=0)
+        self.assertEqual(throttle.locked_for("bob", "1.1.1.1", now=0), 0)
+        throttle.failure("bob", "1.1.1.1", now=1)
+        self.assertEqual(throttle.locked_for("bob", "1.1.1.1", now=1), 10)
+
+        throttle.failure("bob", "1.1.1.1", now=12)
+        throttle.failure("bob", "1.1.1.1", now=13)
+        self.assertEqual(throttle.locked_for("bob", None, now=13), 20)
+
+        # capped at max_lockout
+        throttle.failure("bob", "1.1.1.1", now=40)
+        throttle.failure("bob", "1.1.1.1", now=41)
+        self.assertEqual(throttle.locked_for("BOB", None, now=41), 25)
+
+        # other usernames from another IP are not affected
+        self.assertEqual(throttle.locked_for("alice", "2.2.2.2", now=41), 0)
+
+    def test_window_and_success(self):
+        """ Do old failures fall out of the window, and success reset it? """
+
+        throttle = LoginThrottle(max_failures=2, window=60, lockout=10)
+
+        throttle.failure("bob", None, now=0)
+        throttle.failure("bob", None, now=61)
+        self.assertEqual(throttle.locked_for("bob", None, now=61), 0)
+
+        throttle.success("bob")
+        throttle.failure("bob", None, now=62)
+        self.assertEqual(throttle.locked_for("bob", None, now=62), 0)
+
+
+class LoginViewTestCase(TestCase):
+    """Test the lockout on the login view."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        User.signup(username="throttleduser",
+                    email="throttled@test.com",
+                    password="rightpassword",
+                    image_url=None)
+        db.session.commit()
+
+        app.extensions["login_throttle"].records.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_lockout_skips_bcrypt(self):
+        """ After 3 failures, is even the right password refused unchecked? """
+
+        with app.test_client() as client:
+            for i in range(3):
+                resp = client.post("/login", data={"username": "throttleduser",
+                                                   "password": "wrongpassword"})
+                self.assertEqual(resp.status_code, 200)
+
+            with patch.object(User, "authenticate") as authenticate:
+                resp = client.post("/login", data={"username": "throttleduser",
+                                                   "password": "rightpassword"})
+                authenticate.assert_not_called()
+
+            self.assertEqual(resp.status_code, 429)
+            self.assertIn("Retry-After", resp.headers)
+            self.assertIn("Too many failed attempts", resp.get_data(as_text=True))
+
+    def test_login_stats(self):
+        """ Are failures and lockouts at /health/limits, not on readiness? """
+
+        with app.test_client() as client:
+            before = client.get("/health/limits").get_json()["logins"]
+            for i in range(4):
+                client.post("/login", data={"username": "throttleduser",
+                                            "password": "wrongpassword"})
+
+            stats = client.get("/health/limits").get_json()["logins"]
+            ready = client.get("/health/ready").get_json()
+
+        self.assertEqual(stats["lockouts"] - before["lockouts"], 1)
+        self.assertEqual(stats["refused"] - before["refused"], 1)
+        self.assertNotIn("logins", ready)
@@ -0,0 +1,180 @@
+"""Message cache tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_messagecache.py
+
+
+import os
+import shutil
+import stat
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from flask import Flask
+
+from models import db, User, Message, Follows, Likes
+
+from app import create_app, CURR_USER_KEY
+from messagecache import (MessageCache, SharedTable, LOG_SIZE,
+                          init_message_cache)
+
+# Build the app against the test database. create_app() takes the settings
+# directly, so nothing has to be set in the environment first.
+
+app = create_app({"SQLALCHEMY_DATABASE_URI": "postgresql:///warbler-test",
+                  "MESSAGE_CACHE_PATH": "off"})
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class MessageCacheTestCase(TestCase):
+    """ Two MessageCaches on one shared table stand in for two workers. """
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.user = User.signup(username="cacheuser",
+                                email="cache@test.com",
+                                password="testuser",
+                                image_url=None)
+        db.session.commit()
+
+        msg = Message(text="cached warble", user_id=self.user.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        self.user_id = self.user.id
+        self.msg_id = msg.id
+
+        self.table_file = tempfile.NamedTemporaryFile(suffix=".cache")
+        self.worker1 = MessageCache(10, SharedTable(self.table_file.name, 64))
+        self.worker2 = MessageCache(10, SharedTable(self.table_file.name, 64))
+
+    def tearDown(self):
+        db.session.rollback()
+        self.table_file.close()
+
+    def test_shared_fill(self):
+        """ Does one worker's database read fill the other worker's cache? """
+
+        with app.test_request_context():
+            first = self.worker1.get(self.msg_id)
+            second = self.worker2.get(self.msg_id)
+
+        self.assertEqual(first, second)
+        self.assertEqual(second.text, "cached warble")
+        self.assertEqual(second.username, "cacheuser")
+        self.assertEqual(self.worker1.counts["misses"], 1)
+        self.assertEqual(self.worker2.counts["shared_hits"], 1)
+
+    def test_invalidate(self):
+        """ Does a delete in one worker drop the message in the other one? """
+
+        with app.test_request_context():
+            self.worker1.get(self.msg_id)
+            self.worker2.get(self.msg_id)
+
+            Message.query.filter_by(id=self.msg_id).delete()
+            db.session.commit()
+            self.worker1.invalidate()
+
+            self.assertIsNone(self.worker2.get(self.msg_id))
+
+    def test_forget_message(self):
+        """ Does forgetting one message leave the others cached everywhere? """
+
+        with app.test_request_context():
+            other = Message(text="other warble", user_id=self.user_id)
+            db.session.add(other)
+            db.session.commit()
+
+            for worker in (self.worker1, self.worker2):
+                worker.get(self.msg_id)
+                worker.get(other.id)
+
+            Message.query.filter_by(id=self.msg_id).delete()
+            db.session.commit()
+            self.worker1.forget_message(self.msg_id)
+
+            self.assertIsNone(self.worker2.get(self.msg_id))
+            hits = self.worker2.counts["local_hits"]
+            self.assertEqual(self.worker2.get(other.id).text, "other warble")
+            self.assertEqual(self.worker2.counts["local_hits"], hits + 1)
+
+    def test_forget_user(self):
+        """ Does forgetting a user drop only that user's messages? """
+
+        with app.test_request_context():
+            author = User.signup(username="otherauthor", email="other@test.com",
+                                 password="testuser", image_url=None)
+            db.session.commit()
+            other = Message(text="someone else's", user_id=author.id)
+            db.session.add(other)
+            db.session.commit()
+
+            for worker in (self.worker1, self.worker2):
+                worker.get(self.msg_id)
+                worker.get(other.id)
+
+            User.query.filter_by(id=self.user_id).update({"username": "renamed"})
+            db.session.commit()
+            self.worker1.forget_user(self.user_id)
+
+            self.assertEqual(self.worker2.get(self.msg_id).username, "renamed")
+            self.assertEqual(self.worker2.get(other.id).username, "otherauthor")
+            # the first two reads, and the renamed author's message again
+            self.assertEqual(self.worker1.counts["misses"]
+                             + self.worker2.counts["misses"], 3)
+
+    def test_log_overrun(self):
+        """ Does a worker that missed more than the ring holds start over? """
+
+        with app.test_request_context():
+            self.worker2.get(self.msg_id)
+            for key in range(LOG_SIZE + 1):
+                self.worker1.forget_message(10 ** 6 + key)
+
+            self.worker2.get(self.msg_id)
+            self.assertEqual(self.worker2.counts["shared_hits"], 1)
+
+    def test_table_file(self):
+        """ Is the default table in the instance folder, owner only, and a
+            table someone else made refused?
+        """
+
+        instance = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, instance)
+        bare = Flask(__name__, instance_path=instance + "/instance")
+        bare.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+
+        path = init_message_cache(bare).shared.path
+        self.assertEqual(os.path.dirname(path), bare.instance_path)
+        self.assertEqual(stat.S_IMODE(os.stat(bare.instance_path).st_mode),
+                         0o700)
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+
+        with patch("os.getuid", return_value=os.getuid() + 1):
+            with self.assertRaises(PermissionError):
+                SharedTable(path, 64)
+
+    def test_destroy_view(self):
+        """ Is a deleted message gone from its permalink? """
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = client.get(f"/messages/{self.msg_id}")
+            self.assertIn("cached warble", resp.get_data(as_text=True))
+
+            client.post(f"/messages/{self.msg_id}/delete")
+
+            resp = client.get(f"/messages/{self.msg_id}")
+            self.assertEqual(resp.status_code, 404)
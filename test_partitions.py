@@ -0,0 +1,184 @@
+"""Message partition and archive tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_partitions.py
+
+
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+
+from models import db, User, Message, Follows, Likes
+
+from app import create_app
+import partitions
+from partitions import (add_months, partition_name, partition_month,
+                        partition_ddl, recent_first, write_archive,
+                        query_archive, MIGRATION)
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# Build the app against the test database.
+
+app = create_app({"SQLALCHEMY_DATABASE_URI": "postgresql:///warbler-test",
+                  "RATE_LIMITS": {},
+                  "FEED_WINDOW_DAYS": 7})
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class MonthsTestCase(TestCase):
+    """Month arithmetic and partition names."""
+
+    def test_months(self):
+        """ Do months roll over years both ways? """
+
+        self.assertEqual(add_months(datetime(2023, 11, 1), 3),
+                         datetime(2024, 2, 1))
+        self.assertEqual(add_months(datetime(2024, 1, 1), -1),
+                         datetime(2023, 12, 1))
+
+    def test_names(self):
+        """ Do partition names round trip, and bound a month? """
+
+        month = datetime(2024, 2, 1)
+        self.assertEqual(partition_name(month), "messages_y2024m02")
+        self.assertEqual(partition_month("messages_y2024m02"), month)
+        self.assertIsNone(partition_month("messages"))
+        self.assertIn("FROM ('2024-02-01') TO ('2024-03-01')",
+                      partition_ddl(month))
+
+    def test_migration_without_like_counts(self):
+        """ Does the migration leave like_counts alone when it isn't there? """
+
+        self.assertIn("ALTER TABLE IF EXISTS like_counts", MIGRATION)
+        self.assertIn("to_regclass('like_counts')", MIGRATION)
+
+
+class MaintenanceTestCase(TestCase):
+    """The partitions created by the serving processes."""
+
+    def test_starts_with_first_request(self):
+        """ Is the maintenance thread started by the first request only? """
+
+        with patch.object(partitions, "run_maintenance") as run:
+            serving = create_app({"SQLALCHEMY_DATABASE_URI": "postgresql:///warbler-test",
+                                  "RATE_LIMITS": {},
+                                  "PARTITION_MAINTAIN_SECONDS": 60})
+            self.assertFalse(run.called)
+            serving.test_client().get("/signup")
+            serving.test_client().get("/signup")
+
+        run.assert_called_once_with(serving, 60)
+
+    def test_unpartitioned(self):
+        """ Does maintenance stop when messages isn't partitioned? """
+
+        with patch.object(partitions, "ensure_partitions") as ensure, \
+                patch.object(partitions, "is_partitioned", return_value=False):
+            partitions.run_maintenance(app, 60)
+
+        self.assertFalse(ensure.called)
+
+
+class FeedWindowTestCase(TestCase):
+    """recent_first looks at the window first and falls back to older rows."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        user = User.signup(username="windowed", email="windowed@test.com",
+                           password="testuser", image_url=None)
+        now = datetime.utcnow()
+        for days, text in ((1, "new"), (2, "newer than a week"),
+                           (30, "a month ago"), (60, "two months ago")):
+            user.messages.append(Message(text=text,
+                                         timestamp=now - timedelta(days=days)))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_window_is_enough(self):
+        """ Are only recent messages read when they fill the page? """
+
+        with app.app_context():
+            texts = [msg.text for msg in recent_first(Message.query, 2)]
+        self.assertEqual(texts, ["new", "newer than a week"])
+
+    def test_falls_back(self):
+        """ Are older messages added, in order, when the window runs short? """
+
+        with app.app_context():
+            texts = [msg.text for msg in recent_first(Message.query, 3)]
+        self.assertEqual(texts, ["new", "newer than a week", "a month ago"])
+
+    def test_default_timestamp(self):
+        """ Is a new message stamped when it is written, not at import? """
+
+        msg = Message(text="now", user_id=User.query.one().id)
+        db.session.add(msg)
+        db.session.commit()
+
+        self.assertLess(datetime.utcnow() - msg.timestamp, timedelta(minutes=1))
+
+
+@skipUnless(pyarrow, "the archive needs pyarrow")
+class ArchiveTestCase(TestCase):
+    """Writing archive files and reading them back."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, rows, fmt):
+        path = os.path.join(self.directory,
+                            name + (".parquet" if fmt == "parquet" else ".arrow"))
+        return write_archive([rows[:1], rows[1:]], path, fmt)
+
+    def test_round_trip(self):
+        """ Are both formats read back, filtered and newest first? """
+
+        self.write("messages_y2023m01", [
+            (1, "january", datetime(2023, 1, 5), 7, 2),
+            (2, "january too", datetime(2023, 1, 9), 8, 0)], "parquet")
+        self.write("messages_y2023m02", [
+            (3, "february", datetime(2023, 2, 5), 7, 1)], "arrow")
+
+        rows = query_archive(self.directory)
+        self.assertEqual([row["id"] for row in rows], [3, 2, 1])
+        self.assertEqual(rows[2]["likes"], 2)
+
+        self.assertEqual([row["id"] for row in
+                          query_archive(self.directory, user_id=7)], [3, 1])
+        self.assertEqual([row["id"] for row in
+                          query_archive(self.directory,
+                                        since=datetime(2023, 2, 1))], [3])
+        self.assertEqual([row["id"] for row in
+                          query_archive(self.directory, contains="TOO")], [2])
+
+    def test_no_partial_files(self):
+        """ Is nothing left under the final name when writing fails? """
+
+        def batches():
+            yield [(1, "fine", datetime(2023, 1, 1), 1, 0)]
+            raise RuntimeError("connection lost")
+
+        path = os.path.join(self.directory, "messages_y2023m01.parquet")
+        with self.assertRaises(RuntimeError):
+            write_archive(batches(), path)
+        self.assertEqual(os.listdir(self.directory), [])
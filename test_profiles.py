@@ -0,0 +1,127 @@
+"""Profile loader tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_profiles.py
+
+
+from unittest import TestCase
+
+from werkzeug.exceptions import NotFound
+
+from models import db, User, Message, Follows, Likes
+
+from app import create_app, CURR_USER_KEY
+from profiles import load_profile, loader_workers
+
+# Build the app against the test database. create_app() takes the settings
+# directly, so nothing has to be set in the environment first.
+
+app = create_app({"SQLALCHEMY_DATABASE_URI": "postgresql:///warbler-test"})
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ProfileLoaderTestCase(TestCase):
+    """Test the ProfileView the profile pages render."""
+
+    def setUp(self):
+        """Two users following each other, one message, one like."""
+
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.viewer = User.signup(username="profileviewer",
+                                  email="viewer@test.com",
+                                  password="testuser",
+                                  image_url=None)
+        self.author = User.signup(username="profileauthor",
+                                  email="author@test.com",
+                                  password="testuser",
+                                  image_url=None)
+        db.session.commit()
+
+        msg = Message(text="profile message", user_id=self.author.id)
+        db.session.add(msg)
+        db.session.add(Follows(user_being_followed_id=self.author.id,
+                               user_following_id=self.viewer.id))
+        db.session.add(Follows(user_being_followed_id=self.viewer.id,
+                               user_following_id=self.author.id))
+        db.session.commit()
+
+        db.session.add(Likes(user_id=self.viewer.id, message_id=msg.id))
+        db.session.commit()
+
+        self.viewer_id = self.viewer.id
+        self.author_id = self.author.id
+        self.msg_id = msg.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_profile_view(self):
+        """ Does the view have the counters, the follow state and the lists? """
+
+        with app.test_request_context():
+            profile = load_profile(self.author_id, self.viewer_id,
+                                   messages="own", users="followers")
+
+        self.assertEqual(profile.user.username, "profileauthor")
+        self.assertEqual((profile.messages_count, profile.following_count,
+                          profile.followers_count, profile.likes_count),
+                         (1, 1, 1, 0))
+        self.assertTrue(profile.is_following)
+        self.assertEqual(profile.liked_ids, [self.msg_id])
+        self.assertEqual([msg.id for msg in profile.messages], [self.msg_id])
+        self.assertEqual([user.id for user in profile.users], [self.viewer_id])
+
+        # the view is read only
+        with self.assertRaises(AttributeError):
+            profile.likes_count = 5
+
+    def test_liked_by_deleted_author(self):
+        """ Are a deleted author's messages left out of a user's likes? """
+
+        User.query.filter_by(id=self.author_id).update(
+            {"deleted_at": db.func.now()}, synchronize_session=False)
+        db.session.commit()
+
+        with app.test_request_context():
+            profile = load_profile(self.viewer_id, messages="liked")
+
+        self.assertEqual(profile.messages, ())
+
+    def test_loader_fits_pool(self):
+        """ Does the loader take at most half the connection pool? """
+
+        config = {"PROFILE_LOADER_WORKERS": 8, "DB_POOL_SIZE": 2,
+                  "DB_MAX_OVERFLOW": 4,
+                  "SQLALCHEMY_DATABASE_URI": "postgresql:///warbler"}
+        self.assertEqual(loader_workers(config), 3)
+        self.assertEqual(loader_workers(dict(config, DB_POOL_SIZE=20)), 8)
+        self.assertEqual(loader_workers(dict(config, DB_PGBOUNCER=True)), 8)
+
+    def test_missing_user(self):
+        """ Does a missing user 404? """
+
+        with app.test_request_context():
+            with self.assertRaises(NotFound):
+                load_profile(0, self.viewer_id)
+
+    def test_profile_page(self):
+        """ Does the page show the counters from the view? """
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer_id
+
+            resp = client.get(f"/users/{self.author_id}")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("profile message", html)
+            self.assertIn("Unfollow", html)
@@ -0,0 +1,47 @@
+"""Pub/sub hub tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_pubsub.py
+
+
+from unittest import TestCase
+
+from pubsub import Hub
+
+
+class HubTestCase(TestCase):
+    """Test delivery through the in-process hub."""
+
+    def test_delivery_by_author(self):
+        """ Do subscribers only get the messages of the authors they follow? """
+
+        hub = Hub()
+        follows_1 = hub.subscribe([1])
+        follows_1_2 = hub.subscribe([1, 2])
+
+        hub.publish({"type": "message", "id": 10, "user_id": 1})
+        hub.publish({"type": "message", "id": 11, "user_id": 2})
+        hub.publish({"type": "message", "id": 12, "user_id": 3})
+
+        self.assertEqual(follows_1.get(0)["id"], 10)
+        self.assertIsNone(follows_1.get(0), "nothing from authors 2 and 3")
+        self.assertEqual([follows_1_2.get(0)["id"], follows_1_2.get(0)["id"]], [10, 11])
+
+        hub.unsubscribe(follows_1)
+        hub.publish({"type": "message", "id": 13, "user_id": 1})
+        self.assertIsNone(follows_1.get(0), "unsubscribed")
+        self.assertEqual(hub.stats()["subscribers"], 1)
+
+    def test_slow_subscriber(self):
+        """ Does a full queue drop the oldest notification instead of blocking? """
+
+        hub = Hub()
+        sub = hub.subscribe([1])
+        sub.queue.maxsize = 2
+
+        for msg_id in range(5):
+            hub.publish({"type": "message", "id": msg_id, "user_id": 1})
+
+        self.assertEqual([sub.get(0)["id"], sub.get(0)["id"]], [3, 4])
+        self.assertEqual(sub.dropped, 3)
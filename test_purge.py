@@ -0,0 +1,158 @@
+"""Purge of deleted accounts tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_purge.py
+
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy.exc import OperationalError
+
+from models import (db, User, Message, Follows, Likes, UserPurge,
+                    db_soft_delete_user)
+
+from app import create_app
+import purge
+from purge import purge_user, pending_purges, PURGE_STAGES
+
+# Build the app against the test database.
+
+app = create_app({"SQLALCHEMY_DATABASE_URI": "postgresql:///warbler-test",
+                  "RATE_LIMITS": {}})
+
+db.create_all()
+
+
+class Interrupted(Exception):
+    """Stands in for the purge being killed between two batches."""
+
+
+class PurgeTestCase(TestCase):
+    """ A deleted user with 5 messages (3 liked by someone else), 4 likes of
+        their own and follows both ways.
+    """
+
+    def setUp(self):
+        UserPurge.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        gone = User.signup(username="gone", email="gone@test.com",
+                           password="testuser", image_url=None)
+        stays = User.signup(username="stays", email="stays@test.com",
+                            password="testuser", image_url=None)
+        db.session.commit()
+        self.gone_id, self.stays_id = gone.id, stays.id
+
+        mine = [Message(text=f"gone {i}", user_id=gone.id) for i in range(5)]
+        theirs = [Message(text=f"stays {i}", user_id=stays.id) for i in range(4)]
+        db.session.add_all(mine + theirs)
+        db.session.commit()
+
+        db.session.add_all([Likes(user_id=stays.id, message_id=msg.id)
+                            for msg in mine[:3]])
+        db.session.add_all([Likes(user_id=gone.id, message_id=msg.id)
+                            for msg in theirs])
+        db.session.add_all([
+            Follows(user_being_followed_id=stays.id, user_following_id=gone.id),
+            Follows(user_being_followed_id=gone.id, user_following_id=stays.id)])
+        db_soft_delete_user(gone)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_stages(self):
+        """ Does the purge go through every stage in order and remove it all? """
+
+        seen = []
+        done = purge_user(self.gone_id, batch_size=2, rows_per_second=0,
+                          report=lambda row: seen.append(row.stage))
+
+        self.assertEqual(done.stage, "done")
+        self.assertIsNotNone(done.finished_at)
+        self.assertEqual((done.likes_deleted, done.messages_deleted,
+                          done.follows_deleted), (7, 5, 2))
+
+        # stages only move forward, and each one is reached
+        order = [PURGE_STAGES.index(stage) for stage in seen]
+        self.assertEqual(order, sorted(order))
+        self.assertEqual(seen[-1], "done")
+
+        self.assertIsNone(User.query.get(self.gone_id))
+        self.assertEqual(Message.query.filter_by(user_id=self.gone_id).count(), 0)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(Message.query.filter_by(user_id=self.stays_id).count(), 4)
+
+    def test_batch_size(self):
+        """ Does no batch remove more than batch_size rows? """
+
+        sizes = []
+        last = {"total": 0}
+
+        def report(row):
+            total = row.likes_deleted + row.messages_deleted + row.follows_deleted
+            sizes.append(total - last["total"])
+            last["total"] = total
+
+        purge_user(self.gone_id, batch_size=2, rows_per_second=0, report=report)
+
+        self.assertLessEqual(max(sizes), 2)
+        self.assertEqual(sum(sizes), 14)
+
+    def test_resume(self):
+        """ Does an interrupted purge pick up where it stopped? """
+
+        batches = []
+
+        def report(row):
+            batches.append(row.stage)
+            if len(batches) == 3:
+                raise Interrupted()
+
+        with self.assertRaises(Interrupted):
+            purge_user(self.gone_id, batch_size=2, rows_per_second=0,
+                       report=report)
+
+        db.session.rollback()
+        stopped = UserPurge.query.get(self.gone_id)
+        self.assertNotEqual(stopped.stage, "done")
+        self.assertEqual(pending_purges(), [self.gone_id])
+
+        done = purge_user(self.gone_id, batch_size=2, rows_per_second=0,
+                          report=None)
+
+        # the counters carry on; nothing was counted twice
+        self.assertEqual((done.likes_deleted, done.messages_deleted,
+                          done.follows_deleted), (7, 5, 2))
+        self.assertEqual(pending_purges(), [])
+
+    def test_gives_up(self):
+        """ Does a batch that keeps failing get recorded instead of retried
+            forever, and does running it again start over?
+        """
+
+        calls = []
+
+        def broken(stage, user_id, batch_size):
+            calls.append(stage)
+            raise OperationalError("DELETE ...", {}, Exception("connection lost"))
+
+        with patch.object(purge, "_delete_batch", broken):
+            failed = purge_user(self.gone_id, rows_per_second=0, report=None,
+                                max_attempts=3, retry_seconds=0)
+
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(failed.stage, "likes")
+        self.assertIsNotNone(failed.failed_at)
+        self.assertIn("connection lost", failed.last_error)
+        self.assertEqual(pending_purges(), [])
+
+        done = purge_user(self.gone_id, rows_per_second=0, report=None)
+        self.assertEqual(done.stage, "done")
+        self.assertIsNone(done.failed_at)
@@ -0,0 +1,115 @@
+"""Rate limiter tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_ratelimit.py
+
+
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+from app import create_app, CURR_USER_KEY
+from ratelimit import MemoryStore, parse_limit
+
+# Build the app against the test database, with a tight limit on new messages
+
+app = create_app({"SQLALCHEMY_DATABASE_URI": "postgresql:///warbler-test",
+                  "RATE_LIMITS": {"views.messages_add": {"user": "2/minute"}}})
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TokenBucketTestCase(TestCase):
+    """Test the in-memory token buckets."""
+
+    def test_bucket(self):
+        """ Does a bucket allow a burst, refuse, then refill? """
+
+        store = MemoryStore()
+        rate, burst = parse_limit("3/minute")
+
+        self.assertEqual([store.take("k", rate, burst, now=0)[0]
+                          for i in range(4)], [True, True, True, False])
+
+        allowed, wait = store.take("k", rate, burst, now=0)
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(wait, 20)
+
+        # one token back after 20 seconds
+        self.assertTrue(store.take("k", rate, burst, now=20)[0])
+        self.assertFalse(store.take("k", rate, burst, now=20)[0])
+
+        # other keys have their own bucket
+        self.assertTrue(store.take("other", rate, burst, now=20)[0])
+
+    def test_parse_limit(self):
+        """ Are bad limits refused? """
+
+        self.assertEqual(parse_limit("120/hour"), (120 / 3600, 120))
+        with self.assertRaises(ValueError):
+            parse_limit("120 per hour")
+
+
+class RateLimitViewTestCase(TestCase):
+    """Test the limit on a write view."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        user = User.signup(username="limiteduser",
+                           email="limited@test.com",
+                           password="testuser",
+                           image_url=None)
+        db.session.commit()
+        self.user_id = user.id
+
+        # fresh buckets: a user id can come back after the delete above
+        app.extensions["rate_limiter"].store = MemoryStore()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_messages_add_limited(self):
+        """ Does the third message in a minute get a 429 with Retry-After? """
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            statuses = [client.post("/messages/new",
+                                    data={"text": f"warble {i}"}).status_code
+                        for i in range(3)]
+            self.assertEqual(statuses, [302, 302, 429])
+
+            resp = client.post("/messages/new", data={"text": "one more"})
+            self.assertEqual(resp.status_code, 429)
+            self.assertTrue(0 < int(resp.headers["Retry-After"]) <= 30)
+
+            # reading is not limited
+            self.assertEqual(client.get("/messages/new").status_code, 200)
+
+        self.assertEqual(Message.query.count(), 2)
+
+    def test_limit_stats(self):
+        """ Are refusals counted at /health/limits, and kept off readiness? """
+
+        with app.test_client() as client:
+            before = client.get("/health/limits").get_json()["rate_limits"]
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            for i in range(3):
+                client.post("/messages/new", data={"text": f"warble {i}"})
+
+            stats = client.get("/health/limits").get_json()
+            ready = client.get("/health/ready").get_json()
+
+        self.assertEqual(stats["rate_limits"].get("limited", 0)
+                         - before.get("limited", 0), 1)
+        self.assertNotIn("rate_limits", ready)
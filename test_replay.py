@@ -0,0 +1,130 @@
+"""Request replay smoke tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_replay.py
+
+
+import random
+import threading
+import time
+from unittest import TestCase
+
+from flask import Flask, Response
+from werkzeug.serving import make_server
+
+from models import db, User, Message, Follows, Likes
+
+from app import create_app
+import replay
+from sessions import cookie_user_id
+
+# Build the app against the test database.
+
+app = create_app({"SQLALCHEMY_DATABASE_URI": "postgresql:///warbler-test",
+                  "RATE_LIMITS": {},
+                  "WTF_CSRF_ENABLED": False})
+
+db.create_all()
+
+
+class ReplayTestCase(TestCase):
+    """Replaying a short recording in process and against a server."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        user = User.signup(username="replayed", email="replayed@test.com",
+                           password="testuser", image_url=None)
+        db.session.commit()
+        self.user_id = user.id
+
+        self.records = [
+            {"method": "GET", "path": "/users/profile", "user": self.user_id},
+            {"method": "POST", "path": "/messages/new",
+             "form": {"text": "replayed"}, "user": "replayed"},
+            {"method": "GET", "path": "/users/profile"},
+        ]
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def check(self, report):
+        endpoints = report["endpoints"]
+        self.assertEqual(report["requests"], 3)
+        # the logged in user gets the page, the anonymous one a redirect
+        self.assertEqual(endpoints["views.profile"]["statuses"],
+                         {"200": 1, "302": 1})
+        self.assertEqual(endpoints["views.messages_add"]["statuses"],
+                         {"302": 1})
+        self.assertEqual(Message.query.filter_by(text="replayed").count(), 1)
+
+    def test_in_process(self):
+        """ Does a replay through the test client log users in? """
+
+        self.check(replay.replay(app, self.records,
+                                 replay.TestClientTarget(app), 2))
+
+    def test_http(self):
+        """ Does a replay against a running server log users in? """
+
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            target = replay.HTTPTarget(app, f"http://127.0.0.1:{server.server_port}")
+            cookie = target._session_cookie(self.user_id)
+            self.assertEqual(cookie_user_id(app, cookie.value), self.user_id)
+
+            self.check(replay.replay(app, self.records, target, 2))
+        finally:
+            server.shutdown()
+            thread.join()
+
+    def test_user_order(self):
+        """ Are each user's requests sent in the recorded order, one at a
+            time, however the workers are scheduled?
+        """
+
+        sent = []
+        busy = set()
+
+        class Target:
+            def send(self, user_id, method, path, form):
+                assert user_id not in busy
+                busy.add(user_id)
+                time.sleep(random.random() / 500)
+                sent.append((user_id, path))
+                busy.discard(user_id)
+                return 200
+
+        records = [{"method": "GET", "path": f"/step/{step}", "user": user}
+                   for step in range(20) for user in (1, 2, 3)]
+        report = replay.replay(app, records, Target(), 8)
+
+        self.assertEqual(report["requests"], 60)
+        for user in (1, 2, 3):
+            self.assertEqual([path for user_id, path in sent if user_id == user],
+                             [f"/step/{step}" for step in range(20)])
+
+    def test_streamed_body_read(self):
+        """ Does the in-process target read a streamed page to the end? """
+
+        streamed = Flask(__name__)
+        streamed.secret_key = "replay"
+        finished = []
+
+        @streamed.route("/stream")
+        def stream():
+            def rows():
+                yield "first"
+                finished.append(True)
+                yield "last"
+            return Response(rows())
+
+        target = replay.TestClientTarget(streamed)
+        self.assertEqual(target.send(None, "GET", "/stream", None), 200)
+        self.assertEqual(finished, [True])
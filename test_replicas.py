@@ -0,0 +1,119 @@
+"""Read-replica routing tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_replicas.py
+
+
+import tempfile
+import time
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+from app import create_app, CURR_USER_KEY
+from replicas import ReplicaSet, PRIMARY_UNTIL_KEY
+
+# Build the app against the test database. create_app() takes the settings
+# directly, so nothing has to be set in the environment first.
+
+app = create_app({"SQLALCHEMY_DATABASE_URI": "postgresql:///warbler-test"})
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """ The primary is the usual test database, the replica is a SQLite file.
+        Rows that only exist on one side show where a request read from.
+    """
+
+    def setUp(self):
+        """Create a replica and rows that exist on only one side."""
+
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.replica_file = tempfile.NamedTemporaryFile(suffix=".db")
+        replicas = ReplicaSet([f"sqlite:///{self.replica_file.name}"],
+                              app.config)
+        replica_engine = replicas.replicas[0].engine
+        db.metadata.create_all(replica_engine)
+        app.extensions["replicas"] = replicas
+
+        # the logged in user exists on both sides with the same id
+        self.testuser = User.signup(username="replicauser",
+                                    email="replica@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        self.primaryonly = User(username="primaryonly",
+                                email="primaryonly@test.com",
+                                password="HASHED_PASSWORD")
+        db.session.add(self.primaryonly)
+        db.session.commit()
+        self.testuser_id = self.testuser.id
+        self.primaryonly_id = self.primaryonly.id
+
+        users = User.__table__
+        replica_engine.execute(users.insert(), [
+            {"id": self.testuser_id, "username": "replicauser",
+             "email": "replica@test.com", "password": "HASHED_PASSWORD"},
+            {"id": self.primaryonly_id + 1000, "username": "replicaonly",
+             "email": "replicaonly@test.com", "password": "HASHED_PASSWORD"},
+        ])
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.extensions["replicas"] = None
+        self.replica_file.close()
+
+    def test_get_reads_from_replica(self):
+        """ Does a marked GET view read from the replica? """
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            html = client.get("/users").get_data(as_text=True)
+            self.assertIn("@replicaonly", html, "/users read from the replica")
+            self.assertNotIn("@primaryonly", html, "/users did not read the primary")
+
+    def test_read_your_writes(self):
+        """ Does a POST keep the user's reads on the primary for a while? """
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = client.post(f"/users/follow/{self.primaryonly_id}")
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Follows.query.count(), 1, "follow written to the primary")
+
+            html = client.get("/users").get_data(as_text=True)
+            self.assertIn("@primaryonly", html, "sticky: /users read the primary")
+            self.assertNotIn("@replicaonly", html, "sticky: /users did not read the replica")
+
+            # stickiness over, back to the replica
+            with client.session_transaction() as sess:
+                sess[PRIMARY_UNTIL_KEY] = time.time() - 1
+
+            html = client.get("/users").get_data(as_text=True)
+            self.assertIn("@replicaonly", html, "/users back on the replica")
+
+    def test_failed_statement_timer(self):
+        """ Does a failing statement leave no timer behind on its connection? """
+
+        replica = app.extensions["replicas"].replicas[0]
+
+        with replica.engine.connect() as conn:
+            for i in range(3):
+                with self.assertRaises(Exception):
+                    conn.execute("SELECT * FROM no_such_table")
+            self.assertNotIn("replica_started", conn.info)
+
+            conn.execute("SELECT 1")
+            self.assertNotIn("replica_started", conn.info)
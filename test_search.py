@@ -0,0 +1,125 @@
+"""Message search tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_search.py
+
+
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+from app import create_app, CURR_USER_KEY
+from search import MemorySearch, search_messages, terms
+
+# Build the app against the test database.
+
+app = create_app({"SQLALCHEMY_DATABASE_URI": "postgresql:///warbler-test",
+                  "RATE_LIMITS": {},
+                  "MESSAGE_CACHE_PATH": "off"})
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class SearchTestCase(TestCase):
+    """Search through search_messages and the /search page."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.alice = User.signup(username="alice", email="alice@test.com",
+                                 password="testuser", image_url=None)
+        self.bob = User.signup(username="bob", email="bob@test.com",
+                               password="testuser", image_url=None)
+        db.session.commit()
+
+        self.alice_id = self.alice.id
+        self.bob_id = self.bob.id
+
+        for user, text in ((self.alice, "walking the dog in the park"),
+                           (self.alice, "dog dog dog"),
+                           (self.bob, "my dog likes the park"),
+                           (self.bob, "a cat in the park")):
+            user.messages.append(Message(text=text))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def texts(self, page):
+        return [msg.text for msg in page.results]
+
+    def test_terms(self):
+        """ Are words lowercased and stopwords dropped? """
+
+        self.assertEqual(terms("The Dog, and THE cat!"), ["dog", "cat"])
+
+    def test_all_words_ranked(self):
+        """ Must every word match, with the best match first? """
+
+        with app.app_context():
+            page = search_messages("dog park")
+            self.assertCountEqual(self.texts(page),
+                                  ["walking the dog in the park",
+                                   "my dog likes the park"])
+
+            self.assertEqual(self.texts(search_messages("dog"))[0],
+                             "dog dog dog")
+            self.assertEqual(self.texts(search_messages("the")), [])
+
+    def test_author_and_pages(self):
+        """ Do the author filter and paging cut the results? """
+
+        with app.app_context():
+            page = search_messages("dog", authors=["bob"])
+            self.assertEqual(self.texts(page), ["my dog likes the park"])
+            self.assertEqual(self.texts(search_messages("dog",
+                                                        authors=["nobody"])),
+                             [])
+
+            first = search_messages("park", per_page=2)
+            second = search_messages("park", page=2, per_page=2)
+            self.assertTrue(first.has_next)
+            self.assertFalse(second.has_next)
+            self.assertEqual(len(self.texts(first) + self.texts(second)), 3)
+
+    def test_views_keep_index(self):
+        """ Are new and deleted messages found and forgotten? """
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.bob_id
+
+            # builds the index
+            client.get("/search?q=parrot")
+
+            client.post("/messages/new", data={"text": "a parrot talks"})
+            html = client.get("/search?q=Parrot&author=@bob").get_data(as_text=True)
+            self.assertIn("a parrot talks", html)
+
+            msg_id = Message.query.filter_by(text="a parrot talks").one().id
+            client.post(f"/messages/{msg_id}/delete")
+            html = client.get("/search?q=parrot").get_data(as_text=True)
+            self.assertNotIn("a parrot talks", html)
+            self.assertNotIn(msg_id, app.extensions["search"]["backend"].lengths)
+
+    def test_catches_up(self):
+        """ Are messages written behind the index's back picked up? """
+
+        index = MemorySearch()
+        with app.app_context():
+            index.sync()
+            self.assertEqual(len(index.lengths), 4)
+
+            Message.query.filter_by(text="a cat in the park").delete()
+            db.session.add(Message(text="cat nap", user_id=self.alice_id))
+            db.session.commit()
+
+            index.sync()
+            self.assertEqual(sorted(index.postings["cat"].values()), [1])
+            self.assertEqual(len(index.lengths), 4)
@@ -0,0 +1,195 @@
+"""Server-side session tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_sessions.py
+
+
+import os
+import shutil
+import stat
+import tempfile
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+from flask import Flask
+
+from models import db, User, Message, Follows, Likes
+
+from app import create_app, CURR_USER_KEY
+from sessions import (MemoryStore, FileStore, SQLiteStore, SessionUser,
+                      cookie_user_id, init_sessions, snapshot)
+
+# Build the app against the test database.
+
+app = create_app({"SQLALCHEMY_DATABASE_URI": "postgresql:///warbler-test",
+                  "RATE_LIMITS": {},
+                  "SESSION_STORE": "memory"})
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class StoreTestCase(TestCase):
+    """The same checks against each store."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def stores(self):
+        return [MemoryStore(), FileStore(self.dir + "/files"),
+                SQLiteStore(self.dir + "/sessions.db")]
+
+    def test_round_trip(self):
+        """ Do data and snapshot come back, and expire? """
+
+        for store in self.stores():
+            store.put("a", {"curr_user": 1, "_flashes": [("info", "hi")]},
+                      {"id": 1, "username": "one"}, 60)
+            store.put("b", {}, None, -1)
+
+            data, user, expires = store.get("a")
+            self.assertEqual(data["_flashes"], [("info", "hi")])
+            self.assertEqual(user["username"], "one")
+            self.assertIsNone(store.get("b"))
+            self.assertIsNone(store.get("missing"))
+
+    def test_revoke_and_update(self):
+        """ Are all of a user's sessions rewritten or ended at once? """
+
+        for store in self.stores():
+            store.put("a", {"curr_user": 1}, {"id": 1, "username": "one"}, 60)
+            store.put("b", {"curr_user": 1}, {"id": 1, "username": "one"}, 60)
+            store.put("c", {"curr_user": 2}, {"id": 2, "username": "two"}, 60)
+
+            store.update_user({"id": 1, "username": "uno"})
+            self.assertEqual(store.get("b")[1]["username"], "uno")
+
+            self.assertEqual(store.revoke_user(1), 2)
+            self.assertIsNone(store.get("a"))
+            self.assertIsNone(store.get("b"))
+            self.assertIsNotNone(store.get("c"))
+
+    def test_default_path(self):
+        """ Does the default store live in the instance folder, owner only? """
+
+        bare = Flask(__name__, instance_path=self.dir + "/instance")
+        bare.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        store = init_sessions(bare)
+
+        self.assertEqual(os.path.dirname(store.path), bare.instance_path)
+        self.assertEqual(stat.S_IMODE(os.stat(bare.instance_path).st_mode),
+                         0o700)
+        self.assertEqual(stat.S_IMODE(os.stat(store.path).st_mode), 0o600)
+
+
+class SessionViewTestCase(TestCase):
+    """Logging in, the snapshot and revocation through the app."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        User.signup(username="sessioned", email="sessioned@test.com",
+                    password="testuser", image_url=None)
+        db.session.commit()
+
+        self.store = app.session_interface.store
+        self.store.sessions.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, client):
+        return client.post("/login", data={"username": "sessioned",
+                                           "password": "testuser"})
+
+    def test_cookie_holds_id(self):
+        """ Does the cookie carry a signed id that maps to the user? """
+
+        with app.test_client() as client:
+            self.login(client)
+            cookie = next(c for c in client.cookie_jar
+                          if c.name == app.session_cookie_name).value
+
+        self.assertNotIn("curr_user", cookie)
+        self.assertEqual(cookie_user_id(app, cookie),
+                         User.query.one().id)
+        self.assertIsNone(cookie_user_id(app, "made-up.id"))
+
+    def test_snapshot(self):
+        """ Is g.user read from the session, and refreshed by an edit? """
+
+        with app.test_client() as client:
+            self.login(client)
+
+            # changed behind the app's back: the snapshot still says
+            #  "sessioned", which shows no query was made for it
+            User.query.update({"username": "renamed"})
+            db.session.commit()
+            html = client.get("/users/profile").get_data(as_text=True)
+            self.assertIn('alt="sessioned"', html)
+
+            User.query.update({"username": "sessioned"})
+            db.session.commit()
+            client.post("/users/profile",
+                        data={"username": "edited", "email": "sessioned@test.com",
+                              "image_url": "", "header_image_url": "",
+                              "location": "", "bio": "",
+                              "password": "testuser"})
+            html = client.get("/").get_data(as_text=True)
+            self.assertIn("@edited", html)
+
+    def test_delete_revokes(self):
+        """ Does deleting the account log out its other browsers? """
+
+        with app.test_client() as phone, app.test_client() as laptop:
+            self.login(phone)
+            self.login(laptop)
+            self.assertEqual(self.store.count(), 2)
+
+            resp = laptop.post("/users/delete")
+            self.assertEqual(resp.location.rsplit("/", 1)[-1], "signup")
+
+            # only the laptop's anonymous session, holding the goodbye flash
+            self.assertEqual([record[1] for record in self.store.sessions.values()],
+                             [None])
+            resp = phone.get("/users/profile")
+            self.assertEqual(resp.status_code, 302)
+
+    def test_logout(self):
+        """ Does logging out end the session's user? """
+
+        with app.test_client() as client:
+            self.login(client)
+            client.get("/logout")
+
+            with client.session_transaction() as sess:
+                self.assertNotIn(CURR_USER_KEY, sess)
+                self.assertIsNone(sess.user)
+
+    def test_session_user_follows(self):
+        """ Do follow checks without the follow cache see g.user's follows? """
+
+        user = User.query.one()
+        other = User.signup(username="other", email="other@test.com",
+                            password="testuser", image_url=None)
+        db.session.commit()
+        other.followers.append(user)
+        db.session.commit()
+
+        session_user = SessionUser(snapshot(user))
+        self.assertEqual(session_user, user)
+        self.assertNotEqual(session_user, other)
+
+        with patch.dict(app.extensions, {"follow_cache": None}):
+            self.assertTrue(other.is_followed_by(session_user))
+            self.assertTrue(session_user.is_following(other))
+            self.assertFalse(user.is_followed_by(session_user))
@@ -0,0 +1,122 @@
+"""Statement timeout tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_statement_timeout.py
+
+
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from flask import g
+from sqlalchemy import event, select
+from sqlalchemy.engine.url import make_url
+
+import models
+from models import db, User, engine_options
+
+from app import create_app
+from profiles import ProfileLoader
+from replicas import ReplicaSet
+
+# Build the app against the test database, as if behind pgbouncer.
+
+app = create_app({"SQLALCHEMY_DATABASE_URI": "postgresql:///warbler-test",
+                  "RATE_LIMITS": {},
+                  "DB_PGBOUNCER": True,
+                  "DB_STATEMENT_TIMEOUT_MS": 250})
+
+db.create_all()
+
+SET_LOCAL = "SET LOCAL statement_timeout = 250"
+
+
+class StatementTimeoutTestCase(TestCase):
+    """The timeout on the primary, the replicas and the profile threads."""
+
+    def setUp(self):
+        # whatever the test database is, let it take the setting
+        dialects = patch.object(models, "STATEMENT_TIMEOUT_DIALECTS",
+                                ("postgresql", "sqlite"))
+        dialects.start()
+        self.addCleanup(dialects.stop)
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+
+    def record_settings(self, engine):
+        """ The SET LOCALs sent on engine during the test. Off Postgres they
+            are recorded and replaced by a no-op.
+        """
+
+        sent = []
+
+        def capture(conn, cursor, statement, params, context, many):
+            if statement.startswith("SET LOCAL statement_timeout"):
+                sent.append(statement)
+                if conn.dialect.name != "postgresql":
+                    return "SELECT 1", ()
+            return statement, params
+
+        event.listen(engine, "before_cursor_execute", capture, retval=True)
+        self.addCleanup(event.remove, engine, "before_cursor_execute", capture)
+        return sent
+
+    def test_primary_every_transaction(self):
+        """ Is the timeout set again after a commit? """
+
+        with app.app_context():
+            sent = self.record_settings(db.engine)
+            User.query.count()
+            db.session.commit()
+            User.query.count()
+            db.session.commit()
+
+        self.assertEqual(sent, [SET_LOCAL, SET_LOCAL])
+
+    def test_replica(self):
+        """ Is the timeout set on a replica's transaction too? """
+
+        replica_file = tempfile.NamedTemporaryFile(suffix=".db")
+        replicas = ReplicaSet([f"sqlite:///{replica_file.name}"], app.config)
+        engine = replicas.replicas[0].engine
+        db.metadata.create_all(engine)
+        sent = self.record_settings(engine)
+
+        with app.test_request_context():
+            app.extensions["replicas"], saved = replicas, app.extensions.get("replicas")
+            try:
+                g.db_read_replica = True
+                User.query.count()
+            finally:
+                app.extensions["replicas"] = saved
+
+        self.assertEqual(sent, [SET_LOCAL])
+        replica_file.close()
+
+    def test_profile_threads(self):
+        """ Do the profile loader's threads set it in their transactions? """
+
+        with app.app_context():
+            engine = db.engine
+        sent = self.record_settings(engine)
+
+        loader = ProfileLoader(2, statement_timeout_ms=250)
+        rows = loader.run(engine, {"one": select([1]), "two": select([2])})
+
+        self.assertEqual(rows, {"one": [(1,)], "two": [(2,)]})
+        self.assertEqual(sent, [SET_LOCAL, SET_LOCAL])
+
+    def test_direct_connection_option(self):
+        """ Without pgbouncer, is it a connection option of every engine? """
+
+        url = make_url("postgresql:///warbler")
+        options = engine_options({"DB_STATEMENT_TIMEOUT_MS": 250}, url)
+        self.assertEqual(options["connect_args"],
+                         {"options": "-c statement_timeout=250"})
+
+        options = engine_options({"DB_STATEMENT_TIMEOUT_MS": 250,
+                                  "DB_PGBOUNCER": True}, url)
+        self.assertNotIn("connect_args", options)
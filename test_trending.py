@@ -0,0 +1,246 @@
+"""Trending tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_trending.py
+
+
+import socket
+import subprocess
+import sys
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User, Message, Follows, Likes, TrendingSnapshot
+
+from app import create_app, CURR_USER_KEY
+import trending
+from trending import (DecayedTopK, Trending, hashtags, save_snapshot,
+                      restore_snapshot, run_snapshots)
+
+# Build the app against the test database.
+
+app = create_app({"SQLALCHEMY_DATABASE_URI": "postgresql:///warbler-test",
+                  "RATE_LIMITS": {},
+                  "MESSAGE_CACHE_PATH": "off",
+                  "TRENDING_SNAPSHOT_SECONDS": 0})
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class DecayedTopKTestCase(TestCase):
+    """The sketch and heap on their own, with a fake clock."""
+
+    def test_hashtags(self):
+        """ Are tags found once each, lowercased, and entities left alone? """
+
+        self.assertEqual(hashtags("#Flask and #flask, #python! &#39; a#b"),
+                         ["flask", "python"])
+        self.assertEqual(hashtags(None), [])
+
+    def test_counts_and_order(self):
+        """ Are the most frequent keys on top with their counts? """
+
+        top = DecayedTopK(k=2, half_life=3600, now=0)
+        for key, times in (("a", 5), ("b", 3), ("c", 1)):
+            for i in range(times):
+                top.add(key, now=0)
+
+        self.assertEqual([(key, round(score)) for key, score in top.top_k(now=0)],
+                         [("a", 5), ("b", 3)])
+
+    def test_decay(self):
+        """ Does an old burst lose to a smaller recent one? """
+
+        top = DecayedTopK(k=2, half_life=60, now=0)
+        for i in range(8):
+            top.add("old", now=0)
+        for i in range(3):
+            top.add("new", now=300)
+
+        best = top.top_k(now=300)
+        self.assertEqual(best[0][0], "new")
+        self.assertAlmostEqual(best[1][1], 8 / 32)
+
+    def test_eviction(self):
+        """ Does a key that overtakes the tracked ones get in? """
+
+        top = DecayedTopK(k=1, half_life=3600, now=0)
+        for key in ("a", "b", "c"):
+            top.add(key, now=0)
+        for i in range(3):
+            top.add("d", now=0)
+
+        self.assertEqual(top.top_k(now=0)[0][0], "d")
+        self.assertLessEqual(len(top.top), top.capacity)
+
+    def test_merge(self):
+        """ Does merging a snapshot add its counts? """
+
+        first = DecayedTopK(k=2, half_life=3600, now=0)
+        for i in range(4):
+            first.add("a", now=0)
+
+        second = DecayedTopK(k=2, half_life=3600, now=0)
+        second.add("a", now=0)
+        second.merge(first.state())
+
+        self.assertEqual(round(second.top_k(now=0)[0][1]), 5)
+
+
+class TrendingViewTestCase(TestCase):
+    """Test the stream into the trackers and the /trending page."""
+
+    def setUp(self):
+        TrendingSnapshot.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.author = User.signup(username="trendauthor",
+                                  email="author@test.com",
+                                  password="testuser",
+                                  image_url=None)
+        self.fan = User.signup(username="trendfan",
+                               email="fan@test.com",
+                               password="testuser",
+                               image_url=None)
+        db.session.commit()
+
+        self.author_id = self.author.id
+        self.fan_id = self.fan.id
+
+        # a fresh tracker per test, on the app's hub
+        tracker = Trending()
+        app.extensions["trending"] = tracker
+        hub = app.extensions["pubsub"]
+        hub.listeners["message"] = [tracker.on_message]
+        hub.listeners["like"] = [tracker.on_like]
+        self.tracker = tracker
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, client, user_id):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_trending_page(self):
+        """ Do new messages and likes show up on /trending? """
+
+        with app.test_client() as client:
+            self.login(client, self.author_id)
+            client.post("/messages/new", data={"text": "hello #Warbler"})
+            client.post("/messages/new", data={"text": "more #warbler #news"})
+
+            msg_id = Message.query.filter_by(text="hello #Warbler").one().id
+            self.login(client, self.fan_id)
+            client.post(f"/messages/{msg_id}/likes/all")
+
+            html = client.get("/trending").get_data(as_text=True)
+
+        self.assertEqual([tag for tag, _ in self.tracker.hashtags.top_k()],
+                         ["warbler", "news"])
+        self.assertIn("#warbler", html)
+        self.assertIn("hello #Warbler", html)
+
+    def saved(self, worker, times, shared=False, age=0):
+        """ A worker's rows, as if written age seconds ago. """
+
+        tracker = Trending(shared=shared, worker=worker)
+        for i in range(times):
+            tracker.hashtags.add("saved")
+        tracker.messages.add(42)
+
+        save_snapshot(tracker, 60)
+        (TrendingSnapshot.query.filter_by(worker=worker)
+         .update({"taken_at": datetime.utcnow() - timedelta(seconds=age)}))
+        db.session.commit()
+
+    def workers(self):
+        return sorted({snapshot.worker
+                       for snapshot in TrendingSnapshot.query.all()})
+
+    def test_snapshot(self):
+        """ Does a new process adopt a gone worker's counts, once? """
+
+        self.saved("gone-1", 3, age=3600)
+
+        restarted = Trending(worker="new-1")
+        restore_snapshot(restarted, 60)
+
+        self.assertEqual(restarted.hashtags.top_k()[0][0], "saved")
+        self.assertAlmostEqual(restarted.hashtags.top_k()[0][1], 3, places=2)
+        self.assertEqual(restarted.messages.top_k()[0][0], 42)
+
+        # the counts moved into the new worker's rows
+        self.assertEqual(self.workers(), ["new-1"])
+
+        again = Trending(worker="new-2")
+        restore_snapshot(again, 60)
+        self.assertEqual(again.hashtags.top_k(), [])
+
+    def test_dead_pid(self):
+        """ Is a dead process on this host adopted without waiting? """
+
+        self.saved("live-1", 5)
+        proc = subprocess.Popen([sys.executable, "-c", "pass"])
+        proc.wait()
+        self.saved(f"{socket.gethostname()}-{proc.pid}", 2)
+
+        restarted = Trending(worker="new-1")
+        restore_snapshot(restarted, 60)
+
+        # the live worker's counts stay its own
+        self.assertAlmostEqual(restarted.hashtags.top_k()[0][1], 2, places=2)
+        self.assertEqual(self.workers(), ["live-1", "new-1"])
+
+    def test_shared(self):
+        """ With every worker counting everything, is only the newest row
+            merged?
+        """
+
+        self.saved("one-1", 3, shared=True, age=30)
+        self.saved("two-1", 4, shared=True, age=10)
+
+        restarted = Trending(shared=True, worker="new-1")
+        restore_snapshot(restarted, 60)
+
+        self.assertAlmostEqual(restarted.hashtags.top_k()[0][1], 4, places=2)
+
+
+class SnapshotThreadTestCase(TestCase):
+    """When the snapshot thread runs, and that it outlives a dead database."""
+
+    def test_starts_with_first_request(self):
+        """ Is the thread left off until the app serves a request? """
+
+        serving = create_app({"SQLALCHEMY_DATABASE_URI": "postgresql:///warbler-test",
+                              "RATE_LIMITS": {},
+                              "MESSAGE_CACHE_PATH": "off",
+                              "TRENDING_SNAPSHOT_SECONDS": 60})
+
+        with patch.object(trending, "run_snapshots") as run:
+            self.assertFalse(run.called)
+            serving.test_client().get("/trending")
+            serving.test_client().get("/trending")
+
+        run.assert_called_once_with(serving, serving.extensions["trending"], 60)
+
+    def test_failed_rollback(self):
+        """ Does a rollback failing after a failed snapshot not end it? """
+
+        class Stop(Exception):
+            pass
+
+        with patch.object(trending, "restore_snapshot",
+                          side_effect=RuntimeError("database gone")), \
+                patch.object(db.session, "rollback",
+                             side_effect=RuntimeError("connection dead")), \
+                patch.object(trending.time, "sleep", side_effect=Stop):
+            with self.assertRaises(Stop):
+                run_snapshots(app, Trending(), 60)
@@ -5,23 +5,17 @@
 #    python -m unittest test_user_model.py
 
 
-import os
 from unittest import TestCase
 
 from models import db, User, db_change_user, Message, Follows
 from sqlalchemy.exc import IntegrityError
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
+from app import create_app
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+# Build the app against the test database. create_app() takes the settings
+# directly, so nothing has to be set in the environment first.
 
-
-# Now we can import app
-
-from app import app
+app = create_app({"SQLALCHEMY_DATABASE_URI": "postgresql:///warbler-test"})
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
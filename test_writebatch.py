@@ -0,0 +1,223 @@
+"""Write batching tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_writebatch.py
+
+
+import json
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User, Message, Follows, Likes
+
+from app import create_app, CURR_USER_KEY
+import writebatch
+from writebatch import WriteBatcher, WriteBatchFailed
+
+# Build the app against the test database. The batches are flushed by the
+# tests, so the interval is long enough to never flush on its own.
+
+app = create_app({"SQLALCHEMY_DATABASE_URI": "postgresql:///warbler-test",
+                  "WRITE_BATCH": "async",
+                  "WRITE_BATCH_INTERVAL_MS": 600000,
+                  "RATE_LIMITS": {}})
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class WriteBatchTestCase(TestCase):
+    """Test coalescing, toggles and journal recovery."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.liker = User.signup(username="batchliker",
+                                 email="liker@test.com",
+                                 password="testuser",
+                                 image_url=None)
+        self.author = User.signup(username="batchauthor",
+                                  email="author@test.com",
+                                  password="testuser",
+                                  image_url=None)
+        db.session.commit()
+
+        msg = Message(text="batched warble", user_id=self.author.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        self.liker_id = self.liker.id
+        self.author_id = self.author.id
+        self.msg_id = msg.id
+        self.batcher = app.extensions["write_batch"]
+        # nothing left buffered by the last test
+        self.batcher.pending.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_toggles_coalesce(self):
+        """ Do three quick toggles see each other and write one like? """
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.liker_id
+
+            for i in range(3):
+                client.post(f"/messages/{self.msg_id}/likes/all")
+
+            client.post(f"/users/follow/{self.author_id}")
+
+        self.assertEqual(self.batcher.pending_op("like", self.liker_id,
+                                                 self.msg_id), "add")
+        self.assertEqual(Likes.query.count(), 0)
+
+        self.batcher.flush()
+
+        self.assertEqual(Likes.query.filter_by(user_id=self.liker_id,
+                                               message_id=self.msg_id).count(), 1)
+        self.assertIsNotNone(Follows.query.get((self.author_id, self.liker_id)))
+        self.assertIsNone(self.batcher.pending_op("like", self.liker_id,
+                                                  self.msg_id))
+
+    def test_deleted_target_dropped(self):
+        """ Is a like of a message deleted before the flush skipped? """
+
+        self.batcher.submit("like", self.liker_id, self.msg_id, "add")
+        Message.query.filter_by(id=self.msg_id).delete()
+        db.session.commit()
+
+        self.batcher.flush()
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(self.batcher.stats()["pending"], 0)
+
+    def test_journal_recovery(self):
+        """ Are the changes in a dead process's journal written on startup? """
+
+        journal_dir = tempfile.mkdtemp()
+        # a pid that isn't running
+        with open(os.path.join(journal_dir, "writes-999999999.log"), "w") as log:
+            log.write(json.dumps(["follow", self.liker_id, self.author_id,
+                                  "add"]) + "\n")
+            log.write(json.dumps(["like", self.liker_id, self.msg_id,
+                                  "add"]) + "\n")
+            log.write('["like", 1')  # cut short by the crash
+
+        batcher = WriteBatcher(app, "async", interval_ms=600000,
+                               journal_dir=journal_dir)
+        self.assertEqual(batcher.counts["recovered"], 2)
+
+        batcher.flush()
+
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertIsNotNone(Follows.query.get((self.author_id, self.liker_id)))
+        self.assertEqual(os.listdir(journal_dir),
+                         [f"writes-{os.getpid()}.log"])
+
+    def test_toggle_is_atomic(self):
+        """ Do concurrent toggles alternate instead of queueing one op twice? """
+
+        def is_set():
+            # a slow read, to give a second toggle a chance to sneak in
+            time.sleep(0.01)
+            return False
+
+        ops = []
+        threads = [threading.Thread(target=lambda: ops.append(
+            self.batcher.toggle("like", self.liker_id, self.msg_id, is_set)))
+            for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(ops), ["add"] * 3 + ["remove"] * 3)
+        self.assertEqual(self.batcher.pending_op("like", self.liker_id,
+                                                 self.msg_id), "remove")
+
+    def test_toggle_reads_unlocked(self):
+        """ Can other writes go on during a toggle's database read, and does
+            a change they queue for the same key make it look again?
+        """
+
+        reads = []
+
+        def is_set():
+            # a like queued from another request while this one reads
+            other = threading.Thread(target=self.batcher.submit, args=(
+                "like", self.liker_id, self.msg_id, "add"))
+            other.start()
+            other.join(2)
+            reads.append(other.is_alive())
+            return False
+
+        op = self.batcher.toggle("like", self.liker_id, self.msg_id, is_set)
+
+        self.assertEqual(reads, [False])
+        self.assertEqual(op, "remove")
+        self.assertEqual(self.batcher.pending_op("like", self.liker_id,
+                                                 self.msg_id), "remove")
+        self.assertEqual(self.batcher.reading, {})
+
+    def test_timeout_returns(self):
+        """ Does a "group" change that isn't committed in time return, still
+            buffered, instead of inviting a retry?
+        """
+
+        batcher = WriteBatcher(app, "group", interval_ms=600000, timeout=0.05)
+        op = batcher.toggle("like", self.liker_id, self.msg_id, lambda: False)
+
+        self.assertEqual(op, "add")
+        self.assertEqual(batcher.counts["timeouts"], 1)
+        self.assertEqual(batcher.pending_op("like", self.liker_id,
+                                            self.msg_id), "add")
+
+        batcher.flush()
+        self.assertEqual(Likes.query.count(), 1)
+
+    def test_dropped_change_raises(self):
+        """ Does a "group" change dropped by the one-by-one fallback raise,
+            while the other changes of its batch return normally?
+        """
+
+        real_apply = writebatch.apply_batch
+        bad = ("like", self.liker_id, self.msg_id)
+
+        def apply_batch(batch):
+            if bad in batch:
+                raise RuntimeError("bad row")
+            real_apply(batch)
+
+        batcher = WriteBatcher(app, "group", interval_ms=50, timeout=10)
+        results = {}
+
+        def submit(name, *change):
+            try:
+                batcher.submit(*change)
+                results[name] = "ok"
+            except WriteBatchFailed:
+                results[name] = "failed"
+
+        with patch.object(writebatch, "apply_batch", apply_batch):
+            threads = [
+                threading.Thread(target=submit, args=("like", *bad, "add")),
+                threading.Thread(target=submit, args=(
+                    "follow", "follow", self.liker_id, self.author_id, "add"))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(results, {"like": "failed", "follow": "ok"})
+        self.assertEqual(batcher.counts["dropped"], 1)
+        self.assertIsNotNone(Follows.query.get((self.author_id, self.liker_id)))
+        self.assertEqual(Likes.query.count(), 0)
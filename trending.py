@@ -0,0 +1,381 @@
+"""Trending hashtags and messages, counted from the event stream.
+
+New messages and likes already go through the pubsub hub (messages_add and
+the like toggle publish them). The trackers here listen to those events and
+keep time-decayed counts in memory, so /trending never touches the messages
+or likes tables:
+
+- hashtags: every #tag in a new message's text counts once;
+- messages: every like counts once for the message (unlikes don't take it
+  back; a Count-Min Sketch can only go up).
+
+Each tracker is a Count-Min Sketch -- TRENDING_SKETCH_DEPTH rows of
+TRENDING_SKETCH_WIDTH counters; a key adds to one counter per row and its
+estimate is the smallest of them, which overcounts only by collisions -- plus
+a heap of the keys with the best estimates. Counts decay with a half-life of
+TRENDING_HALF_LIFE seconds. Rather than touching every counter as time
+passes, an event at time t adds 2 ** ((t - epoch) / half_life), and reads
+divide by the same factor for "now" ("forward decay"); when the factor gets
+large, everything is scaled down and the epoch moves up.
+
+With TRENDING_SNAPSHOT_SECONDS set (it is off by default; set it for the web
+servers, not the CLIs), each worker writes its sketches and heaps to the
+trending_snapshots table that often, one row per tracker and worker (host
+and pid). The thread starts with the worker's first request, and reads the
+rows back before it writes any, so a restart doesn't start the trends from
+zero.
+
+With PUBSUB_URL set every worker sees every event and trends the whole
+site: the workers' rows are copies of the same counts, so a new process
+merges only the newest one. Without it each worker trends on the traffic it
+served itself, and the rows add up to the site's: a new process adopts the
+rows of workers that are gone -- a dead pid on this host, or a row that
+hasn't been rewritten for two intervals -- merging them into its own
+counts and deleting them, so each is counted once.
+"""
+
+import hashlib
+import heapq
+import math
+import os
+import re
+import socket
+import threading
+import time
+from array import array
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+HASHTAG = re.compile(r"(?<![\w&])#(\w{1,50})")
+
+# rescale once an event is worth this much more than one at the epoch
+MAX_FACTOR = 2.0 ** 64
+
+
+def hashtags(text):
+    """The distinct hashtags in text, lowercased, in order of appearance."""
+
+    return list(dict.fromkeys(tag.lower() for tag in HASHTAG.findall(text or "")))
+
+
+class DecayedTopK:
+    """Count-Min Sketch with forward decay and a heap of the top keys."""
+
+    def __init__(self, k=20, width=4096, depth=4, half_life=3600.0,
+                 now=None):
+        self.k = k
+        self.width = width
+        self.depth = depth
+        self.rate = math.log(2) / half_life
+        self.epoch = time.time() if now is None else now
+        self.counts = array("d", bytes(8 * width * depth))
+        # the best keys kept: twice k, so a key slipping just below the
+        #  k-th place isn't forgotten at once
+        self.capacity = 2 * k
+        self.top = {}
+        self.heap = []
+        self.lock = threading.Lock()
+        self.events = 0
+
+    def _cells(self, key):
+        digest = hashlib.blake2b(str(key).encode(),
+                                 digest_size=4 * self.depth).digest()
+        return [row * self.width
+                + int.from_bytes(digest[4 * row:4 * row + 4], "little") % self.width
+                for row in range(self.depth)]
+
+    def add(self, key, now=None):
+        """Count one event for key at time now."""
+
+        now = time.time() if now is None else now
+
+        with self.lock:
+            weight = math.exp(self.rate * (now - self.epoch))
+            if weight > MAX_FACTOR:
+                self._rescale(now)
+                weight = 1.0
+
+            cells = self._cells(key)
+            for cell in cells:
+                self.counts[cell] += weight
+            estimate = min(self.counts[cell] for cell in cells)
+
+            self._offer(key, estimate)
+            self.events += 1
+
+    def top_k(self, now=None):
+        """[(key, decayed count)], best first."""
+
+        now = time.time() if now is None else now
+
+        with self.lock:
+            factor = math.exp(self.rate * (now - self.epoch))
+            best = sorted(self.top.items(), key=lambda item: (-item[1], str(item[0])))
+
+        return [(key, score / factor) for key, score in best[:self.k]]
+
+    def _offer(self, key, estimate):
+        if key not in self.top and len(self.top) >= self.capacity:
+            self._drop_stale()
+            if estimate <= self.heap[0][0]:
+                return
+            _, evicted = heapq.heappop(self.heap)
+            del self.top[evicted]
+
+        self.top[key] = estimate
+        heapq.heappush(self.heap, (estimate, key))
+
+        # entries for keys whose estimate has gone up since are stale
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [(score, key) for key, score in self.top.items()]
+            heapq.heapify(self.heap)
+
+    def _drop_stale(self):
+        while self.heap and self.top.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+
+    def _rescale(self, now):
+        scale = math.exp(-self.rate * (now - self.epoch))
+        self.epoch = now
+        for i in range(len(self.counts)):
+            self.counts[i] *= scale
+        self.top = {key: score * scale for key, score in self.top.items()}
+        self.heap = [(score, key) for key, score in self.top.items()]
+        heapq.heapify(self.heap)
+
+    ##########################################################################
+    # Snapshots
+
+    def state(self):
+        with self.lock:
+            return {"epoch": self.epoch, "width": self.width,
+                    "depth": self.depth, "counts": self.counts.tobytes(),
+                    "top": [[key, score] for key, score in self.top.items()]}
+
+    def merge(self, state):
+        """Add a snapshot's counts (taken by this or another process)."""
+
+        if (state["width"], state["depth"]) != (self.width, self.depth):
+            return False
+
+        counts = array("d")
+        counts.frombytes(state["counts"])
+
+        with self.lock:
+            # bring the snapshot's counters to this sketch's epoch
+            scale = math.exp(self.rate * (state["epoch"] - self.epoch))
+            for i, count in enumerate(counts):
+                self.counts[i] += count * scale
+
+            for key, _ in state["top"]:
+                self._offer(key, min(self.counts[cell]
+                                     for cell in self._cells(key)))
+        return True
+
+
+class Trending:
+    """The hashtag and message trackers and their event handlers."""
+
+    def __init__(self, k=20, width=4096, depth=4, half_life=3600.0,
+                 shared=False, worker=None):
+        self.hashtags = DecayedTopK(k, width, depth, half_life)
+        self.messages = DecayedTopK(k, width, depth, half_life)
+        # shared: every worker counts every event (PUBSUB_URL)
+        self.shared = shared
+        # the name on this process's snapshots; worker_name() by default
+        self.worker = worker
+
+    def on_message(self, event):
+        for tag in hashtags(event.get("text")):
+            self.hashtags.add(tag)
+
+    def on_like(self, event):
+        self.messages.add(event["message_id"])
+
+    def trackers(self):
+        return {"hashtags": self.hashtags, "messages": self.messages}
+
+    def stats(self):
+        return {name: {"events": tracker.events, "tracked": len(tracker.top)}
+                for name, tracker in self.trackers().items()}
+
+
+##############################################################################
+# Snapshots to the database
+
+
+def worker_name():
+    """This process, as its snapshots are signed: host and pid."""
+
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def pid_alive(pid):
+    """Is there a process pid on this host (maybe not ours to signal)?"""
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def orphaned(snapshot, interval, now=None):
+    """ Is the worker that wrote snapshot gone? On this host its pid tells;
+        elsewhere it would have rewritten the row within two intervals.
+    """
+
+    host, _, pid = snapshot.worker.rpartition("-")
+    if host == socket.gethostname() and pid.isdigit():
+        return not pid_alive(int(pid))
+
+    now = datetime.utcnow() if now is None else now
+    return snapshot.taken_at < now - timedelta(seconds=2 * interval)
+
+
+def merge_snapshot(trending, snapshot):
+    tracker = trending.trackers().get(snapshot.kind)
+    if tracker is None:
+        return
+
+    # message ids went through JSON as strings
+    convert = int if snapshot.kind == "messages" else str
+    tracker.merge({"epoch": snapshot.epoch, "width": snapshot.width,
+                   "depth": snapshot.depth, "counts": snapshot.counts,
+                   "top": [[convert(key), score]
+                           for key, score in snapshot.top]})
+
+
+def save_snapshot(trending, interval):
+    """ Write this worker's rows, first dropping the rows of workers that
+        are gone -- after merging them in, unless the workers are shared.
+    """
+
+    from models import db, TrendingSnapshot
+
+    worker = trending.worker or worker_name()
+
+    # SKIP LOCKED: two new workers don't both adopt the same row
+    for snapshot in (TrendingSnapshot.query
+                     .filter(TrendingSnapshot.worker != worker)
+                     .with_for_update(skip_locked=True)):
+        if orphaned(snapshot, interval):
+            if not trending.shared:
+                merge_snapshot(trending, snapshot)
+            db.session.delete(snapshot)
+
+    for name, tracker in trending.trackers().items():
+        state = tracker.state()
+        db.session.merge(TrendingSnapshot(
+            kind=name, worker=worker, taken_at=datetime.utcnow(),
+            epoch=state["epoch"], width=state["width"], depth=state["depth"],
+            counts=state["counts"],
+            top=[[str(key), score] for key, score in state["top"]]))
+
+    # one transaction: adopted counts are in this worker's rows before the
+    #  rows they came from are gone
+    db.session.commit()
+
+
+def restore_snapshot(trending, interval):
+    """ Pick up the saved counts, once, when the process starts. """
+
+    from models import TrendingSnapshot
+
+    if trending.shared:
+        newest = {}
+        for snapshot in TrendingSnapshot.query.order_by(TrendingSnapshot.taken_at):
+            newest[snapshot.kind] = snapshot
+        for snapshot in newest.values():
+            merge_snapshot(trending, snapshot)
+
+    # unshared, the adopting happens as the rows are saved
+    save_snapshot(trending, interval)
+
+
+def run_snapshots(app, trending, interval):
+    """ Restore the saved counts, then write a snapshot every interval
+        seconds. Merging adds, so events counted before the restore aren't
+        lost.
+    """
+
+    restored = False
+    while True:
+        with app.app_context():
+            from models import db
+
+            try:
+                if restored:
+                    save_snapshot(trending, interval)
+                else:
+                    restore_snapshot(trending, interval)
+                    restored = True
+            except Exception:
+                app.logger.exception("trending snapshot failed")
+                # a dead connection can fail the rollback too; the thread
+                #  has to live to try again next time
+                try:
+                    db.session.rollback()
+                except Exception:
+                    pass
+            finally:
+                try:
+                    db.session.remove()
+                except Exception:
+                    pass
+
+        time.sleep(interval)
+
+
+##############################################################################
+# Setup
+
+
+def trending():
+    """The current app's Trending."""
+
+    return current_app.extensions["trending"]
+
+
+def like_event(message_id, user_id):
+    """The event published for a new like."""
+
+    return {"type": "like", "message_id": message_id, "user_id": user_id}
+
+
+def init_trending(app):
+    """ Create the trackers and subscribe them to the hub (after
+        init_pubsub).
+    """
+
+    app.config.setdefault("TRENDING_TOP_K", 20)
+    app.config.setdefault("TRENDING_HALF_LIFE", 3600)
+    app.config.setdefault("TRENDING_SKETCH_WIDTH", 4096)
+    app.config.setdefault("TRENDING_SKETCH_DEPTH", 4)
+    app.config.setdefault("TRENDING_SNAPSHOT_SECONDS", 0)
+
+    tracker = Trending(k=app.config["TRENDING_TOP_K"],
+                       width=app.config["TRENDING_SKETCH_WIDTH"],
+                       depth=app.config["TRENDING_SKETCH_DEPTH"],
+                       half_life=app.config["TRENDING_HALF_LIFE"],
+                       shared=bool(app.config.get("PUBSUB_URL")))
+    app.extensions["trending"] = tracker
+
+    hub = app.extensions["pubsub"]
+    hub.listen("message", tracker.on_message)
+    hub.listen("like", tracker.on_like)
+
+    interval = app.config["TRENDING_SNAPSHOT_SECONDS"]
+    if interval:
+        # only in a process that serves: the CLIs and asgi.py's import
+        #  create an app too
+        @app.before_first_request
+        def start_trending_snapshots():
+            threading.Thread(target=run_snapshots,
+                             args=(app, tracker, interval),
+                             daemon=True, name="trending-snapshots").start()
+
+    return tracker
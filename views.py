@@ -0,0 +1,870 @@
+"""Warbler's HTML views, the health checks and the request hooks.
+
+Registered on the app by create_app() in app.py.
+"""
+
+from flask import (Blueprint, Response, current_app, render_template, request,
+                   flash, redirect, session, g, abort, jsonify,
+                   stream_with_context, get_flashed_messages)
+from sqlalchemy.exc import IntegrityError
+
+from app import CURR_USER_KEY
+from forms import UserAddForm, UserEditForm, LoginForm, MessageForm
+from models import (db, User, db_change_user, db_soft_delete_user,
+                    Message, Likes, Follows, pool_status)
+from replicas import replica_reads
+from pubsub import message_event
+from trending import trending, like_event
+from profiles import load_profile
+from messagecache import message_cache
+from writebatch import write_batcher
+from followcache import follow_cache
+from suggestions import follow_suggestions
+from likecounts import like_counts, bump as bump_like_counts
+from search import search_messages, search_index
+from partitions import recent_first
+from export import export_archive, export_filename, FORMATS as EXPORT_FORMATS
+from sessions import (session_user, remember_user, forget_user,
+                      user_changed, revoke_user as revoke_user_sessions)
+from images import SIZES, ImageError, image_proxy, image_source, CACHE_SECONDS
+
+views = Blueprint("views", __name__)
+
+
+##############################################################################
+#
+# Supporting Functions
+
+def get_user_likes(user_id):
+    """ Returns a list of message ids that user_id has liked.
+    """
+
+    # build a list of liked messages
+    db_likes = Likes.query.filter(
+        Likes.user_id == user_id).order_by(Likes.message_id).all()
+    user_likes = []
+    for like in db_likes:
+        user_likes.append(like.message_id)
+
+    return user_likes
+
+
+def get_active_user_or_404(user_id):
+    """ User.query.get_or_404 that also 404s for users who deleted their
+        account and are waiting on the purge.
+    """
+
+    user = User.query.get_or_404(user_id)
+    if user.is_deleted:
+        abort(404)
+
+    return user
+
+
+# template events per streamed chunk; a user card or a message is a few dozen
+STREAM_BUFFER = 100
+
+
+def stream_template(template_name, **context):
+    """ render_template, but the page is sent while it renders: the head and
+        the first cards go out before the last ones are built. For the pages
+        with long lists (/users, profiles). The request context stays open
+        until the page is done (stream_with_context).
+    """
+
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+
+    # the session is saved before the body is sent, so take the flashes out
+    #  of it now; base.html gets the same ones from the request's cache.
+    get_flashed_messages(with_categories=True)
+
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(STREAM_BUFFER)
+    return Response(stream_with_context(stream), mimetype="text/html")
+
+
+##############################################################################
+# User signup/login/logout
+
+
+@views.before_app_request
+def add_user_to_g():
+    """If we're logged in, add curr user to Flask global."""
+
+    if CURR_USER_KEY in session:
+        # with server-side sessions, from the session's snapshot of the user:
+        #  deleting an account revokes its sessions, so there is no need to
+        #  ask the database whether it still exists.
+        g.user = session_user(session[CURR_USER_KEY])
+        if g.user is not None:
+            return
+
+        g.user = User.query.get(session[CURR_USER_KEY])
+
+        # a deleted account is logged out everywhere, not just in the browser
+        #  that deleted it.
+        if g.user is None or g.user.is_deleted:
+            do_logout()
+            g.user = None
+        else:
+            remember_user(g.user)
+
+    else:
+
+        g.user = None
+
+
+def do_login(user):
+    """Log in user."""
+
+    remember_user(user, login=True)
+    session[CURR_USER_KEY] = user.id
+
+
+def login_throttle():
+    """The app's failed-login tracker (loginthrottle.py)."""
+
+    return current_app.extensions["login_throttle"]
+
+
+def lockout_message(wait):
+    minutes, seconds = divmod(int(wait) + 1, 60)
+    when = f"{minutes} min {seconds} sec" if minutes else f"{seconds} seconds"
+    return f"Too many failed attempts. Please try again in {when}."
+
+
+def do_logout():
+    """Logout user."""
+
+    if CURR_USER_KEY in session:
+        del session[CURR_USER_KEY]
+    forget_user()
+
+
+@views.route('/signup', methods=["GET", "POST"])
+def signup():
+    """Handle user signup.
+
+    Create new user and add to DB. Redirect to home page.
+
+    If form not valid, present form.
+
+    If the there already is a user with that username: flash message
+    and re-present form.
+    """
+
+    form = UserAddForm()
+
+    if form.validate_on_submit():
+        try:
+            user = User.signup(
+                username=form.username.data.strip().lower(),
+                password=form.password.data,
+                email=form.email.data.strip().lower(),
+                image_url=form.image_url.data.strip() or User.image_url.default.arg.strip(),
+            )
+            db.session.commit()
+
+        except IntegrityError:
+            flash("Username already taken", 'danger')
+            return render_template('users/signup.html', form=form)
+
+        do_login(user)
+
+        return redirect("/")
+
+    else:
+        return render_template('users/signup.html', form=form)
+
+
+@views.route('/login', methods=["GET", "POST"])
+def login():
+    """Handle user login."""
+
+    form = LoginForm()
+
+    if form.validate_on_submit():
+        username = form.username.data.strip().lower()
+
+        # locked out: refuse before the user lookup and the bcrypt check
+        wait = login_throttle().locked_for(username, request.remote_addr)
+        if wait:
+            flash(lockout_message(wait), 'danger')
+            return (render_template('users/login.html', form=form), 429,
+                    {"Retry-After": str(int(wait) + 1)})
+
+        user = User.authenticate(username, form.password.data)
+
+        if user:
+            login_throttle().success(username)
+            do_login(user)
+            flash(f"Hello, {user.username}!", "success")
+            return redirect("/")
+
+        login_throttle().failure(username, request.remote_addr)
+        flash("Invalid credentials.", 'danger')
+
+    return render_template('users/login.html', form=form)
+
+
+@views.route('/logout')
+def logout():
+    """Handle logout of user."""
+
+    do_logout()
+
+    if g.user:
+        flash(f"{g.user.username} successfully logged out.", "success")
+        g.user = None
+    else:
+        flash(f"User was logged out.", "success")
+
+    return redirect("/login")
+
+
+##############################################################################
+# General user routes:
+
+@views.route('/users')
+@replica_reads
+def list_users():
+    """Page with listing of users.
+
+    Can take a 'q' param in querystring to search by that username.
+    """
+
+    search = request.args.get('q')
+
+    users = User.query.filter(User.deleted_at.is_(None))
+    if not search:
+        users = users.all()
+    else:
+        users = users.filter(User.username.like(f"%{search}%")).all()
+
+    return stream_template('users/index.html', users=users)
+
+
+@views.route('/users/<int:user_id>')
+@replica_reads
+def users_show(user_id):
+    """Show user profile."""
+
+    # the messages come from a user join query. Even though all the messages belong to
+    #  user_id in this route, adding the user details about the user to the messages
+    #  means we can use the same (slightly altered) show.html as we do when we show
+    #  all the messages that a user liked. load_profile runs it alongside the
+    #  user, counter and likes queries.
+    viewer_id = g.user.id if g.user else None
+    profile = load_profile(user_id, viewer_id, messages="own")
+
+    # 'route' helps control where the redirect will take you when you alter a
+    #  like on a message. You should stay on the same page. This gets tricky
+    #  since you can like from 3 different places -- the root page, the user's
+    #  all message page, or the user's like's.
+    return stream_template('users/show.html', user=profile.user, profile=profile,
+                           messages=profile.messages, likes=profile.liked_ids,
+                           like_counts=like_counts(msg.id for msg in profile.messages),
+                           route=user_id, logged_in_user_id=viewer_id)
+
+
+@views.route('/users/<int:user_id>/likes', methods=["GET"])
+@replica_reads
+def user_likes(user_id):
+    """ Show the user profile page with the messages that user_id has liked. user_id must
+        match the currently logged in user, g.user.id.
+    """
+
+    if g.user:
+        if (user_id == g.user.id):
+            profile = load_profile(user_id, g.user.id, messages="liked")
+            user = profile.user
+            if (user.username[-1].lower() == "s"):
+                name_possessive = f"{user.username}'"
+            else:
+                name_possessive = f"{user.username}'s"
+
+            return stream_template('users/show.html', user=user, profile=profile,
+                                   messages=profile.messages,
+                                   list_type=f"{name_possessive} Likes",
+                                   route="MyLikes",
+                                   likes=profile.liked_ids, logged_in_user_id=g.user.id,
+                                   like_counts=like_counts(msg.id for msg in profile.messages))
+        else:
+            # for now, block access to another user's likes. I would think that seeing another user's likes
+            #  should be restricted to users that g.user.id is following and users who are following g.user.id.
+            flash(
+                "Access unauthorized - Sorry, but you cannot view the messages another use likes.", "danger")
+            # leave g.user on the other user's 'main' page.
+            return redirect(f"/users/{user_id}")
+
+    else:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+
+@views.route('/users/<int:user_id>/following')
+@replica_reads
+def show_following(user_id):
+    """Show list of people this user is following."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    profile = load_profile(user_id, g.user.id, users="following")
+    return stream_template('users/following.html', user=profile.user,
+                           profile=profile)
+
+
+@views.route('/users/<int:user_id>/followers')
+@replica_reads
+def users_followers(user_id):
+    """Show list of followers of this user."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    profile = load_profile(user_id, g.user.id, users="followers")
+    return stream_template('users/followers.html', user=profile.user,
+                           profile=profile)
+
+
+@views.route('/users/follow/<int:follow_id>', methods=['POST'])
+def add_follow(follow_id):
+    """Add a follow for the currently-logged-in user."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    followed_user = get_active_user_or_404(follow_id)
+
+    batcher = write_batcher()
+    if batcher:
+        batcher.submit("follow", g.user.id, followed_user.id, "add")
+    else:
+        g.user.following.append(followed_user)
+        db.session.commit()
+
+    return redirect(f"/users/{g.user.id}/following")
+
+
+@views.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+def stop_following(follow_id):
+    """Have currently-logged-in-user stop following this user."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    batcher = write_batcher()
+    if batcher:
+        batcher.submit("follow", g.user.id, follow_id, "remove")
+    else:
+        followed_user = User.query.get(follow_id)
+        g.user.following.remove(followed_user)
+        db.session.commit()
+
+    return redirect(f"/users/{g.user.id}/following")
+
+
+@views.route('/users/profile', methods=["GET", "POST"])
+def profile():
+    """Update profile for current user."""
+
+    if g.user:
+
+        user_curr = User.query.get_or_404(g.user.id)
+
+        # remember the values before changes, if any
+        user_archive = {
+            "username": user_curr.username,
+            "email": user_curr.email,
+            "image_url": user_curr.image_url,
+            "header_image_url": user_curr.header_image_url,
+            "location": user_curr.location,
+            "bio": user_curr.bio
+        }
+        form = UserEditForm(obj=user_curr)
+
+        if form.validate_on_submit():
+            # user may have changed their username in the form, but the
+            #  password is associated with the unchanged username. A good
+            #  amount of this logic should move into models, but it is staying
+            #  here for now.
+            wait = login_throttle().locked_for(user_archive["username"],
+                                               request.remote_addr)
+            if wait:
+                flash(lockout_message(wait), "danger")
+                return redirect("/")
+
+            db_user = User.authenticate(user_archive["username"],
+                                        form.password.data)
+            if db_user:
+                login_throttle().success(user_archive["username"])
+                
+                user_update = {
+                    "username": form.username.data,
+                    "email": form.email.data,
+                    "image_url": form.image_url.data,
+                    "header_image_url": form.header_image_url.data,
+                    "location": form.location.data,
+                    "bio": form.bio.data
+                }
+
+                result = db_change_user(db_user, user_update, user_archive)
+                # 
+                # result = {
+                #     "successful": True no errors, False errors,
+                #     "msg": {
+                #         "msg_type": (3-value tuple for form field values. 0 has the error type
+                #           (error-integrity, error-integrity-catchall, error-unexpected), 
+                #           1 has the field name, 2 has the error message),
+                #         "msg_text": text for flash message,
+                #         "class": class for flash message, success or danger
+                #     }
+                # }
+
+                # flash message values will always exist. 
+                flash(result["msg"]["msg_text"], result["msg"]["class"])
+                
+                if (result["successful"]):
+                    user_changed(db_user)
+                    # cached messages carry the author's username and image
+                    if (db_user.username != user_archive["username"]
+                            or db_user.image_url != user_archive["image_url"]):
+                        message_cache().forget_user(db_user.id)
+                    return redirect(f"/users/{g.user.id}")
+                else:
+                    # crap. we need to disect the message structure
+                    if (result["msg"]["msg_type"][0] == "error-integrity"): 
+                        # result["msg"]["msg_type"][1] is either username or email for 
+                        #  "error-integrity"
+                        if (result["msg"]["msg_type"][1] == "username"):
+                            form.username.errors = result["msg"]["msg_type"][2]
+                        else:
+                            # email error
+                            form.email.errors = result["msg"]["msg_type"][2]
+
+                        return render_template("users/edit.html", form=form, user_id=g.user.id)
+
+                    else:
+                        return redirect("/")
+
+            else:
+                login_throttle().failure(user_archive["username"],
+                                         request.remote_addr)
+                flash(
+                    "DENIED! Password is incorrect. Your profile was NOT updated.", "danger")
+                # redirect to home page when changes were not possible.
+                return redirect("/")
+
+        else:
+            return render_template("users/edit.html", form=form, user_id=g.user.id)
+
+    else:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+
+@views.route('/users/export')
+def export_user():
+    """ Download the logged in user's messages, likes and follows as a zip
+        of NDJSON (or, with ?format=csv, CSV) files. The zip is streamed as
+        it is written; see export.py.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in EXPORT_FORMATS:
+        flash(f"Exports come as {' or '.join(EXPORT_FORMATS)}.", "danger")
+        return redirect("/users/profile")
+
+    resp = Response(stream_with_context(export_archive(g.user.id, fmt)),
+                    mimetype="application/zip")
+    resp.headers["Content-Disposition"] = \
+        f'attachment; filename="{export_filename(g.user.username, fmt)}"'
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+
+@views.route('/users/delete', methods=["POST"])
+def delete_user():
+    """Delete user.
+
+    The user is soft-deleted and logged out right away. Their messages, likes
+    and follows are removed afterwards in small, throttled batches by purge.py
+    so a large account never locks the messages or likes tables.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    do_logout()
+
+    db_soft_delete_user(User.query.get(g.user.id))
+    db.session.commit()
+    message_cache().forget_user(g.user.id)
+    # logged out in every other browser too
+    revoke_user_sessions(g.user.id)
+
+    flash(f"{g.user.username} was deleted.", "success")
+    g.user = None
+
+    return redirect("/signup")
+
+
+##############################################################################
+# Messages routes:
+
+@views.route('/messages/new', methods=["GET", "POST"])
+def messages_add():
+    """Add a message:
+
+    Show form if GET. If valid, update message and redirect to user page.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    form = MessageForm()
+
+    if form.validate_on_submit():
+        msg = Message(text=form.text.data)
+        g.user.messages.append(msg)
+        db.session.commit()
+        search_index().add(msg.id, msg.user_id, msg.text)
+
+        # tell the open streams of g.user's followers
+        current_app.extensions["pubsub"].publish(message_event(msg, g.user.username))
+
+        return redirect(f"/users/{g.user.id}")
+
+    return render_template('messages/new.html', form=form)
+
+
+@views.route('/messages/<int:message_id>', methods=["GET"])
+@replica_reads
+def messages_show(message_id):
+    """Show a message."""
+
+    # messages only ever get deleted, so they can come from the message cache;
+    #  it has no messages of deleted accounts.
+    msg = message_cache().get(message_id)
+    if msg is None:
+        abort(404)
+
+    is_following = False
+    if g.user and g.user.id != msg.user_id:
+        cache = follow_cache()
+        if cache is not None:
+            is_following = cache.is_following(g.user.id, msg.user_id)
+        else:
+            is_following = Follows.query.get((msg.user_id, g.user.id)) is not None
+
+    # like counts change all the time, so they aren't cached with the message
+    return render_template('messages/show.html', message=msg,
+                           is_following=is_following,
+                           like_count=like_counts([message_id]).get(message_id, 0))
+
+
+@views.route('/messages/<int:message_id>/likes/<user_id>', methods=["POST"])
+def messages_add_del_like(message_id, user_id):
+    """ Like or unlike a message message.
+
+        message_id is added to the user's like messagelist (liked) when it does not
+        exist in user's list of liked message.
+
+        message_id is deleted from the user's like message list (unliked) when it
+        EXISTS in user's list of liked message.
+
+        user_id servers for redirection -- we should stay on the page where the like
+        or unlike occurred. It will either have:
+        - a user id (integer) when the like occurred from a user page (users/{user_id}),
+        - 'All' when the like/unlike occurred from the all messages (home) page (/), or
+        - 'MyLikes' when the like/unlike occurred from the current user's likes page
+          (/users/{user_id}/likes).
+
+    """
+
+    if g.user:
+        msg_check = Message.query.get_or_404(message_id)
+
+        batcher = write_batcher()
+        if batcher:
+            # the like state as of the buffered changes, and the opposite
+            #  queued, in one step
+            op = batcher.toggle(
+                "like", g.user.id, message_id,
+                lambda: Likes.query.filter_by(user_id=g.user.id,
+                                              message_id=message_id).first() is not None)
+            if op == "add":
+                current_app.extensions["pubsub"].publish(
+                    like_event(message_id, g.user.id))
+
+            return like_redirect(user_id)
+
+        user_likes = get_user_likes(g.user.id)
+
+        if (message_id in user_likes):
+            # message_id in list means we need to remove the like.
+            like_no_mo = Likes.query.filter(
+                Likes.user_id == g.user.id, Likes.message_id == message_id).one_or_none()
+            db.session.delete(like_no_mo)
+            delta = -1
+
+        else:
+            # message_id NOT in list means we need to add the like.
+            new_like = Likes(message_id=message_id, user_id=g.user.id)
+            db.session.add(new_like)
+            delta = 1
+
+        # the counter commits with the likes row
+        db.session.flush()
+        bump_like_counts(db.session, [(g.user.id, message_id, delta)])
+        db.session.commit()
+
+        # for /trending
+        if delta > 0:
+            current_app.extensions["pubsub"].publish(
+                like_event(message_id, g.user.id))
+
+        return like_redirect(user_id)
+
+    else:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+
+def like_redirect(user_id):
+    """ Did the like/unlike happen on the root page or from a user page? Leave the user where
+        they were, don't redirect them somewhere else.
+    """
+
+    if user_id.isnumeric():
+        return redirect(f"/users/{user_id}")
+    else:
+        if (user_id == "MyLikes"):
+            return redirect(f"/users/{g.user.id}/likes")
+
+    return redirect("/")
+
+
+@views.route('/messages/<int:message_id>/delete', methods=["POST"])
+def messages_destroy(message_id):
+    """Delete a message."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    msg = Message.query.get(message_id)
+    db.session.delete(msg)
+    db.session.commit()
+    message_cache().forget_message(message_id)
+    search_index().remove(message_id)
+
+    return redirect(f"/users/{g.user.id}")
+
+
+##############################################################################
+# Homepage and error pages
+
+
+@views.route('/')
+@replica_reads
+def homepage():
+    """Show homepage:
+
+    - anon users: no messages
+    - logged in: 100 most recent messages of followed_users (user_being_followed_id 
+        in 'follows' table.)
+    """
+
+    if g.user:
+
+        # build a list of followed users
+        cache = follow_cache()
+        if cache is not None:
+            following = list(cache.following(g.user.id))
+        else:
+            db_following = (Follows.query.filter(
+                Follows.user_following_id == g.user.id).all())
+
+            following = []
+            for following_user in db_following:
+                following.append(following_user.user_being_followed_id)
+
+        # print(f"\n\nhomepage: following: {following}\n\n", flush=True)
+
+        messages = recent_first(Message
+                                .query
+                                .join(Message.user)
+                                .filter(Message.user_id.in_(following),
+                                        User.deleted_at.is_(None)),
+                                100)
+
+        liked_msgs = get_user_likes(g.user.id)
+        return render_template('home.html', messages=messages, likes=liked_msgs,
+                               like_counts=like_counts(msg.id for msg in messages),
+                               suggestions=follow_suggestions(g.user.id))
+
+    else:
+        return render_template('home-anon.html')
+
+
+@views.route('/images/<size>/<token>')
+def image_thumbnail(size, token):
+    """ A thumbnail of a user's image (see images.py). The token is the
+        signed original URL; thumbnails never change, so they are cached for
+        good.
+    """
+
+    url = image_source(token)
+    if url is None or size not in SIZES:
+        abort(404)
+
+    proxy = image_proxy()
+    if proxy is None:
+        return redirect(url)
+
+    try:
+        etag, data = proxy.thumbnail(url, size,
+                                     timeout=2 * current_app.config["IMAGE_FETCH_TIMEOUT"])
+    except ImageError:
+        # the browser can try the original itself
+        return redirect(url)
+
+    resp = Response(data, mimetype="image/jpeg")
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = f"public, max-age={CACHE_SECONDS}, immutable"
+    return resp.make_conditional(request)
+
+
+@views.route('/search')
+@replica_reads
+def search_page():
+    """ Messages matching the words in 'q', best match first. 'author'
+        (usernames, space or comma separated) limits them to those authors;
+        'page' pages.
+    """
+
+    q = request.args.get('q', '').strip()
+    authors = [name.lstrip('@') for value in request.args.getlist('author')
+               for name in value.replace(',', ' ').split()]
+    page = request.args.get('page', 1, type=int)
+
+    results = search_messages(q, authors=authors, page=page)
+
+    return render_template('search.html', q=q, authors=authors,
+                           results=results,
+                           like_counts=like_counts(msg.id for msg in results.results))
+
+
+@views.route('/trending')
+def trending_page():
+    """ Trending hashtags and messages, from the in-memory trackers. """
+
+    tracker = trending()
+    tags = [(tag, round(score, 1)) for tag, score in tracker.hashtags.top_k()]
+
+    messages = []
+    for message_id, score in tracker.messages.top_k():
+        msg = message_cache().get(message_id)
+        if msg is not None:
+            messages.append(msg)
+
+    return render_template('trending.html', hashtags=tags, messages=messages,
+                           like_counts=like_counts(msg.id for msg in messages))
+
+
+@views.route('/health/db')
+def health_db():
+    """ Database health for load balancers and dashboards: a round trip to the
+        database plus the connection pool saturation numbers.
+    """
+
+    try:
+        db.session.execute("SELECT 1")
+        healthy = True
+    except Exception:
+        db.session.rollback()
+        healthy = False
+
+    status = {"healthy": healthy, "pool": pool_status()}
+
+    batcher = current_app.extensions.get("write_batch")
+    if batcher:
+        status["write_batch"] = batcher.stats()
+
+    replicas = current_app.extensions.get("replicas")
+    if replicas:
+        status["replicas"] = replicas.status()
+    return jsonify(status), 200 if healthy else 503
+
+
+@views.route('/health/cache')
+def health_cache():
+    """ Hit/miss numbers of the message cache, the follow cache and the image
+        thumbnails.
+    """
+
+    stats = message_cache().stats()
+    cache = follow_cache()
+    stats["follows"] = cache.stats() if cache is not None else None
+    proxy = image_proxy()
+    stats["images"] = proxy.stats() if proxy is not None else None
+    return jsonify(stats)
+
+
+@views.route('/health/ready')
+def health_ready():
+    """ Readiness for load balancers: 503 until the templates are warmed up.
+        Also shows how long startup took.
+    """
+
+    status = current_app.extensions["templates"].status()
+    status["startup"] = current_app.extensions["startup"]
+    return jsonify(status), 200 if status["ready"] else 503
+
+
+@views.route('/health/limits')
+def health_limits():
+    """ How often the rate limiter and the login throttle turned requests
+        away, for dashboards.
+    """
+
+    return jsonify({"rate_limits": current_app.extensions["rate_limiter"].stats(),
+                    "logins": login_throttle().stats()})
+
+##############################################################################
+# Turn off all caching in Flask
+#   (useful for dev; in production, this kind of stuff is typically
+#   handled elsewhere)
+#
+# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+
+
+@views.after_app_request
+def add_header(req):
+    """Add non-caching headers on every request.
+
+    Responses that set their own Cache-Control (the JSON API revalidates with
+    ETags) keep it.
+    """
+
+    if "Cache-Control" in req.headers:
+        return req
+
+    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+    req.headers["Pragma"] = "no-cache"
+    req.headers["Expires"] = "0"
+    req.headers['Cache-Control'] = 'public, max-age=0'
+    return req
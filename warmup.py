@@ -0,0 +1,81 @@
+"""Template bytecode cache and startup warmup.
+
+Jinja compiles a template to Python the first time it is rendered, so the
+first requests a fresh worker serves pay for compiling base.html, home.html,
+users/detail.html and the rest. Two things take that off the request path:
+
+- a bytecode cache on the local filesystem (JINJA_CACHE_DIR, default a
+  per-user temp directory), so a worker loads the compiled code that an
+  earlier worker wrote instead of compiling again;
+- a warmup at startup that loads every template in templates/, which fills
+  the environment's template cache and the bytecode cache.
+
+TEMPLATE_WARMUP is "sync" (default, warm before serving), "background"
+(serve right away and warm on a thread) or "off". /health/ready answers 503
+until the warmup is done, so a load balancer only sends traffic to warm
+workers.
+"""
+
+import os
+import threading
+import time
+
+from jinja2 import FileSystemBytecodeCache
+
+
+class TemplateWarmup:
+    """Compiles the app's templates and remembers when it is done."""
+
+    def __init__(self, app):
+        self.app = app
+        self.ready = threading.Event()
+        self.templates = 0
+        self.seconds = None
+        self.errors = {}
+
+    def run(self):
+        start = time.perf_counter()
+        env = self.app.jinja_env
+
+        # only the app's own templates/, not the ones of extensions
+        for name in self.app.jinja_loader.list_templates():
+            try:
+                env.get_template(name)
+                self.templates += 1
+            except Exception as err:
+                self.errors[name] = str(err)
+
+        self.seconds = round(time.perf_counter() - start, 3)
+        self.ready.set()
+
+    def status(self):
+        return {"ready": self.ready.is_set(),
+                "templates": self.templates,
+                "seconds": self.seconds,
+                "errors": self.errors}
+
+
+def init_templates(app):
+    """Set up the bytecode cache and warm the templates per TEMPLATE_WARMUP."""
+
+    app.config.setdefault("JINJA_CACHE_DIR", None)
+    app.config.setdefault("TEMPLATE_WARMUP", "sync")
+
+    cache_dir = app.config["JINJA_CACHE_DIR"]
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+    warmup = TemplateWarmup(app)
+    app.extensions["templates"] = warmup
+
+    mode = app.config["TEMPLATE_WARMUP"]
+    if mode == "background":
+        threading.Thread(target=warmup.run, daemon=True,
+                         name="template-warmup").start()
+    elif mode == "off":
+        warmup.ready.set()
+    else:
+        warmup.run()
+
+    return warmup
@@ -0,0 +1,562 @@
+"""Write coalescing for likes and follows.
+
+With WRITE_BATCH off (the default) every like toggle and follow commits its
+own transaction, as before. The other modes hand the change to a
+WriteBatcher instead. A flusher thread collects the changes for
+WRITE_BATCH_INTERVAL_MS (or until WRITE_BATCH_MAX are waiting) and writes
+them in one transaction: one multi-row INSERT and one DELETE per table, one
+like counter update per touched counter row (see likecounts.py), one commit,
+one fsync.
+
+Durability depends on the mode:
+
+- "group": the request waits until the transaction holding its change has
+  committed. It is as durable as committing directly, but a thousand
+  concurrent likes share a handful of commits. A request whose change isn't
+  committed within WRITE_BATCH_TIMEOUT seconds stops waiting and returns as
+  in "async" mode -- the change is still buffered and will be written, so
+  asking the client to retry would apply a toggle twice. One whose change
+  had to be dropped (see below) gets a 500.
+- "async": the request returns as soon as the change is buffered. A crash
+  loses the changes of the last interval unless WRITE_BATCH_JOURNAL_DIR is
+  set. Then each change is also appended to a per-process journal file
+  before the request returns, and a worker starting up replays the journals
+  of workers that are no longer running. That covers a crashed process, not
+  a crashed host -- the journal isn't fsynced per change.
+
+Ordering: each change sets the final state of one (user, message) like or
+(user, user) follow -- "add" or "remove" -- and the last change for a key
+wins. Changes to the same key within one batch coalesce to the last one, so
+a double-clicked like toggles on and off and writes nothing. A like toggle
+(toggle()) reads the state through the buffer and queues the opposite, so
+two quick toggles see each other even before either is written. The
+database read happens outside the batcher's lock; if a change for the key
+was queued meanwhile, the toggle looks again. Across processes, the batch that commits last wins.
+
+Adds are idempotent (rows that already exist are skipped) and so are
+removes, so replaying a journal or retrying a failed batch is safe. Changes
+whose message or user was deleted before the flush are dropped. A batch that
+fails MAX_RETRIES times is written one change at a time, and the changes
+that still fail are dropped -- in "group" mode their requests get a
+WriteBatchFailed.
+"""
+
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from flask import current_app, jsonify
+from sqlalchemy import select, tuple_
+from sqlalchemy.dialects import postgresql
+
+from likecounts import bump as bump_like_counts
+from followcache import follows_committed
+
+# rows per statement, to keep the IN lists and VALUES lists reasonable
+CHUNK = 500
+
+# failed flushes of a batch before it is written one change at a time
+MAX_RETRIES = 3
+
+
+# failed tickets kept for "group" waiters that haven't looked yet
+MAX_FAILED = 10000
+
+
+class WriteBatchFailed(Exception):
+    """A "group" mode change that was dropped after its batch kept failing."""
+
+
+class Journal:
+    """Per-process append-only log of buffered changes."""
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.path = os.path.join(directory, f"writes-{os.getpid()}.log")
+        self.file = open(self.path, "a")
+
+    def append(self, key, op):
+        self.file.write(json.dumps([*key, op]) + "\n")
+        self.file.flush()
+
+    def rotate(self):
+        """Start a new log; returns the old one's name, to remove once the
+        changes in it are committed.
+        """
+
+        self.file.close()
+        flushing = f"{self.path}.{time.time_ns()}.flushing"
+        os.rename(self.path, flushing)
+        self.file = open(self.path, "a")
+        return flushing
+
+    def orphans(self):
+        """Journal files of processes that are no longer running, oldest
+        changes first.
+        """
+
+        orphans = []
+        for path in glob.glob(os.path.join(self.directory, "writes-*.log*")):
+            pid = int(os.path.basename(path).split("-")[1].split(".")[0])
+            if pid != os.getpid() and not pid_running(pid):
+                orphans.append(path)
+
+        # the .flushing files of a pid were written before its live .log
+        return sorted(orphans, key=lambda path: (path.endswith(".log"), path))
+
+
+def pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class WriteBatcher:
+    """Buffers like and follow changes and writes them in batches."""
+
+    def __init__(self, app, mode="group", interval_ms=5, max_batch=500,
+                 timeout=5.0, journal_dir=None):
+        self.app = app
+        self.mode = mode
+        self.interval = interval_ms / 1000
+        self.max_batch = max_batch
+        self.timeout = timeout
+
+        self.cond = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.pending = OrderedDict()
+        self.inflight = {}
+        # "group" mode: key -> tickets waiting for it, and tickets whose
+        #  change was dropped
+        self.waiting = {}
+        self.failed = set()
+        # key -> [toggles reading it from the database, changes queued for
+        #  it since they started]
+        self.reading = {}
+        self.submitted = 0
+        self.committed = 0
+        self.retries = 0
+        self.rotated = []
+        self.journal = Journal(journal_dir) if journal_dir else None
+
+        self.counts = {"changes": 0, "coalesced": 0, "flushes": 0,
+                       "failures": 0, "dropped": 0, "recovered": 0,
+                       "timeouts": 0}
+        self.batch_sizes = deque(maxlen=1000)
+        self.flush_ms = deque(maxlen=1000)
+
+        if self.journal:
+            self._recover()
+
+        self.thread = threading.Thread(target=self._run, daemon=True,
+                                       name="write-batch")
+        self.thread.start()
+
+    def submit(self, kind, user_id, target_id, op):
+        """Queue a change: kind "like" or "follow", op "add" or "remove".
+        In "group" mode, returns once the change is committed.
+        """
+
+        key = (kind, user_id, target_id)
+
+        with self.cond:
+            ticket = self._queue(key, op)
+            self._wait(ticket, kind)
+
+    def toggle(self, kind, user_id, target_id, is_set):
+        """ Queue the opposite of a key's current state: the buffered change
+            if there is one, else is_set() (a database read). The read is
+            done without the lock, so other writes don't wait on it; a change
+            queued for the key meanwhile makes it look again, so two quick
+            toggles can't both queue the same op. Returns the op queued.
+        """
+
+        key = (kind, user_id, target_id)
+
+        while True:
+            with self.cond:
+                current = self.pending.get(key, self.inflight.get(key))
+                if current is not None:
+                    op = "remove" if current == "add" else "add"
+                    ticket = self._queue(key, op)
+                    break
+                reading = self.reading.setdefault(key, [0, 0])
+                reading[0] += 1
+                seen = reading[1]
+
+            try:
+                was_set = is_set()
+            except Exception:
+                with self.cond:
+                    self._done_reading(key)
+                raise
+
+            with self.cond:
+                if self._done_reading(key) == seen:
+                    op = "remove" if was_set else "add"
+                    ticket = self._queue(key, op)
+                    break
+
+        with self.cond:
+            self._wait(ticket, kind)
+        return op
+
+    def pending_op(self, kind, user_id, target_id):
+        """The buffered, not yet committed change for a key, if any."""
+
+        key = (kind, user_id, target_id)
+        with self.cond:
+            return self.pending.get(key, self.inflight.get(key))
+
+    def flush(self):
+        """Write whatever is buffered now (used at exit and by tests)."""
+
+        self._flush()
+
+    def stats(self):
+        sizes = list(self.batch_sizes)
+        latencies = sorted(self.flush_ms)
+        stats = dict(self.counts, mode=self.mode, pending=len(self.pending))
+        stats["batch_size"] = {
+            "mean": round(sum(sizes) / len(sizes), 1) if sizes else 0,
+            "max": max(sizes) if sizes else 0}
+        stats["flush_ms"] = {
+            "p50": latencies[len(latencies) // 2] if latencies else 0,
+            "p95": latencies[int(len(latencies) * 0.95)] if latencies else 0,
+            "max": latencies[-1] if latencies else 0}
+        return stats
+
+    def _done_reading(self, key):
+        """A toggle's read is over: the changes queued for the key since
+        (call with the lock held).
+        """
+
+        reading = self.reading[key]
+        reading[0] -= 1
+        if not reading[0]:
+            del self.reading[key]
+        return reading[1]
+
+    def _queue(self, key, op):
+        """Buffer a change and return its ticket (call with the lock held)."""
+
+        if key in self.reading:
+            self.reading[key][1] += 1
+        if key in self.pending:
+            self.counts["coalesced"] += 1
+        self.pending[key] = op
+        self.counts["changes"] += 1
+        if self.journal:
+            self.journal.append(key, op)
+
+        self.submitted += 1
+        ticket = self.submitted
+        if self.mode == "group":
+            self.waiting.setdefault(key, []).append(ticket)
+        if len(self.pending) >= self.max_batch:
+            self.cond.notify_all()
+        return ticket
+
+    def _wait(self, ticket, kind):
+        """In "group" mode, wait for a ticket's batch (call with the lock held)."""
+
+        if self.mode != "group":
+            return
+
+        deadline = time.monotonic() + self.timeout
+        while self.committed < ticket:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                # still buffered, and written later: don't make the client
+                #  retry a change that will happen anyway
+                self.counts["timeouts"] += 1
+                self.app.logger.warning("%s change not committed in %ss",
+                                        kind, self.timeout)
+                return
+            self.cond.wait(remaining)
+
+        if ticket in self.failed:
+            self.failed.discard(ticket)
+            raise WriteBatchFailed(f"{kind} change dropped")
+
+    def _take(self):
+        """Swap out the buffer (call with both locks held)."""
+
+        batch = self.pending
+        self.pending = OrderedDict()
+        self.inflight = dict(batch)
+        tickets = self.waiting
+        self.waiting = {}
+        return batch, self.submitted, tickets
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait(self.interval)
+                if not self.pending:
+                    continue
+
+            self._flush()
+
+    def _flush(self):
+        # one batch at a time: the buffer is only swapped (and inflight
+        #  replaced) once the previous batch is written
+        with self.flush_lock:
+            with self.cond:
+                if not self.pending:
+                    return
+                batch, ticket, tickets = self._take()
+                rotated = self.journal.rotate() if self.journal else None
+
+            self._write(batch, ticket, tickets, rotated)
+
+    def _write(self, batch, ticket, tickets, rotated):
+        # a failed batch goes back in the buffer, so its journal file stays
+        #  until a later flush commits it
+        if rotated:
+            self.rotated.append(rotated)
+
+        start = time.perf_counter()
+        dropped = []
+        try:
+            with self.app.app_context():
+                if self.retries >= MAX_RETRIES:
+                    dropped = self._apply_one_by_one(batch)
+                else:
+                    apply_batch(batch)
+        except Exception:
+            self.app.logger.exception("write batch of %s failed", len(batch))
+            self.counts["failures"] += 1
+            self.retries += 1
+            with self.cond:
+                # back in the buffer, unless a newer change for the key came
+                #  in; its waiters wait for the retry
+                for key, op in batch.items():
+                    self.pending.setdefault(key, op)
+                for key, waiting in tickets.items():
+                    self.waiting[key] = waiting + self.waiting.get(key, [])
+                self.inflight = {}
+            return
+
+        for path in self.rotated:
+            os.remove(path)
+        self.rotated = []
+
+        self.retries = 0
+        self.counts["flushes"] += 1
+        self.batch_sizes.append(len(batch))
+        self.flush_ms.append(round((time.perf_counter() - start) * 1000, 2))
+
+        with self.cond:
+            for key in dropped:
+                self.failed.update(tickets.get(key, ()))
+            # waiters that timed out never collect theirs
+            while len(self.failed) > MAX_FAILED:
+                self.failed.discard(min(self.failed))
+            self.inflight = {}
+            self.committed = max(self.committed, ticket)
+            self.cond.notify_all()
+
+    def _apply_one_by_one(self, batch):
+        """Last resort for a batch that keeps failing: write each change in
+        its own transaction and drop the ones that fail. Returns the keys
+        dropped.
+        """
+
+        dropped = []
+        for key, op in batch.items():
+            try:
+                apply_batch({key: op})
+            except Exception:
+                self.app.logger.exception("dropping write %s %s", key, op)
+                self.counts["dropped"] += 1
+                dropped.append(key)
+        return dropped
+
+    def _recover(self):
+        """Queue the changes left in the journals of dead processes."""
+
+        for path in self.journal.orphans():
+            with open(path) as journal:
+                for line in journal:
+                    try:
+                        kind, user_id, target_id, op = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by the crash
+                    key = (kind, user_id, target_id)
+                    self.pending[key] = op
+                    self.journal.append(key, op)
+                    self.counts["recovered"] += 1
+            os.remove(path)
+
+
+##############################################################################
+# The SQL
+
+
+def tables():
+    """kind -> (table, user column, target column, target table, target filter)"""
+
+    from models import Likes, Follows, Message, User
+
+    return {
+        "like": (Likes.__table__, Likes.user_id, Likes.message_id,
+                 Message.id, None),
+        "follow": (Follows.__table__, Follows.user_following_id,
+                   Follows.user_being_followed_id,
+                   User.id, User.deleted_at.is_(None)),
+    }
+
+
+def chunks(items):
+    for start in range(0, len(items), CHUNK):
+        yield items[start:start + CHUNK]
+
+
+def apply_batch(batch):
+    """Write a batch of changes in one transaction."""
+
+    from models import db
+
+    grouped = {}
+    for (kind, user_id, target_id), op in batch.items():
+        grouped.setdefault((kind, op), []).append((user_id, target_id))
+
+    follow_changes = []
+
+    engine = db.engine
+    with engine.begin() as conn:
+        for kind, (table, user_col, target_col, target_id_col,
+                   target_filter) in tables().items():
+
+            for pairs in chunks(grouped.get((kind, "remove"), [])):
+                if kind == "like":
+                    removed = delete_returning(conn, table, user_col,
+                                               target_col, pairs)
+                    bump_like_counts(conn, [(user_id, message_id, -1)
+                                            for user_id, message_id in removed])
+                else:
+                    conn.execute(table.delete().where(
+                        tuple_(user_col, target_col).in_(pairs)))
+                    follow_changes.extend((user_id, target_id, "remove")
+                                          for user_id, target_id in pairs)
+
+            for pairs in chunks(grouped.get((kind, "add"), [])):
+                # skip rows that exist and targets that were deleted
+                existing = set(tuple(row) for row in conn.execute(
+                    select([user_col, target_col])
+                    .where(tuple_(user_col, target_col).in_(pairs))))
+
+                query = select([target_id_col]).where(
+                    target_id_col.in_({target for _, target in pairs}))
+                if target_filter is not None:
+                    query = query.where(target_filter)
+                targets = {row[0] for row in conn.execute(query)}
+
+                rows = [{user_col.name: user_id, target_col.name: target_id}
+                        for user_id, target_id in pairs
+                        if (user_id, target_id) not in existing
+                        and target_id in targets]
+                if not rows:
+                    continue
+
+                insert = insert_ignoring_conflicts(table, engine).values(rows)
+                if kind != "like":
+                    conn.execute(insert)
+                    follow_changes.extend((row[user_col.name],
+                                           row[target_col.name], "add")
+                                          for row in rows)
+                elif engine.dialect.name == "postgresql":
+                    # count only the rows that went in, not the ones a
+                    #  concurrent flush wrote first
+                    added = conn.execute(insert.returning(user_col, target_col))
+                    bump_like_counts(conn, [(user_id, message_id, 1)
+                                            for user_id, message_id in added])
+                else:
+                    conn.execute(insert)
+                    bump_like_counts(conn, [(row[user_col.name],
+                                             row[target_col.name], 1)
+                                            for row in rows])
+
+    # committed: the follow cache can have them now
+    follows_committed(follow_changes)
+
+
+def delete_returning(conn, table, user_col, target_col, pairs):
+    """DELETE the (user, target) pairs; returns the pairs that were there."""
+
+    where = tuple_(user_col, target_col).in_(pairs)
+    if conn.dialect.name == "postgresql":
+        return [tuple(row) for row in conn.execute(
+            table.delete().where(where).returning(user_col, target_col))]
+
+    # no DELETE ... RETURNING: read them first. Another process removing the
+    #  same likes in between would get them counted twice; likecounts.py
+    #  recounts if that ever matters off Postgres.
+    removed = [tuple(row) for row in conn.execute(
+        select([user_col, target_col]).where(where))]
+    conn.execute(table.delete().where(where))
+    return removed
+
+
+def insert_ignoring_conflicts(table, engine):
+    """INSERT that skips rows hitting a unique constraint (a concurrent
+    flush in another process may have written them first).
+    """
+
+    if engine.dialect.name == "postgresql":
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if engine.dialect.name == "sqlite":
+        return table.insert().prefix_with("OR IGNORE")
+    return table.insert()
+
+
+##############################################################################
+# Setup
+
+
+def write_batcher():
+    """The app's WriteBatcher, or None when writes aren't batched."""
+
+    return current_app.extensions.get("write_batch")
+
+
+def init_write_batch(app):
+    """Start the batcher when WRITE_BATCH is "group" or "async"."""
+
+    app.config.setdefault("WRITE_BATCH", "off")
+    app.config.setdefault("WRITE_BATCH_INTERVAL_MS", 5)
+    app.config.setdefault("WRITE_BATCH_MAX", 500)
+    app.config.setdefault("WRITE_BATCH_TIMEOUT", 5.0)
+    app.config.setdefault("WRITE_BATCH_JOURNAL_DIR", None)
+
+    mode = app.config["WRITE_BATCH"]
+    if mode not in ("group", "async"):
+        app.extensions["write_batch"] = None
+        return None
+
+    batcher = WriteBatcher(app, mode,
+                           interval_ms=app.config["WRITE_BATCH_INTERVAL_MS"],
+                           max_batch=app.config["WRITE_BATCH_MAX"],
+                           timeout=app.config["WRITE_BATCH_TIMEOUT"],
+                           journal_dir=app.config["WRITE_BATCH_JOURNAL_DIR"])
+    app.extensions["write_batch"] = batcher
+
+    atexit.register(batcher.flush)
+
+    @app.errorhandler(WriteBatchFailed)
+    def write_batch_failed(err):
+        resp = jsonify({"error": "the change could not be saved"})
+        resp.status_code = 500
+        return resp
+
+    return batcher